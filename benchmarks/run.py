@@ -0,0 +1,290 @@
+"""
+Benchmarks stacker's own overhead, offline, against the in-memory stand-ins for AWS.
+
+    python -m benchmarks.run [--quick] [--output FILE] [--compare BASELINE] [--tolerance 0.25]
+
+Every benchmark is repeated and reported as the min, median and max seconds in JSON, so two runs can be compared.
+With --compare the medians are checked against an earlier run, and the exit code is 1 if any got slower than the
+tolerance allows.
+"""
+
+import argparse
+import base64
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import yaml
+
+from stacker.cf_helper.templates import Template
+from stacker.cf_helper.utils import CloudFormationUtil, KMSSecretResolver, TemplateStager
+from stacker.deploy import DeployExecutor
+from stacker.deploy_many import DeployManyExecutor
+from stacker.version import __version__
+
+from standins import LocalCloudFormation, LocalEC2, LocalKMS, LocalS3
+
+# Where the stacker package is, so a fresh interpreter started there imports this checkout
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Sizes of the full run, and of the --quick run used to check the benchmarks still work
+SIZES = {'resources': 2000, 'secrets': 200, 'stacks': 50, 'repeat': 5}
+QUICK_SIZES = {'resources': 20, 'secrets': 5, 'stacks': 4, 'repeat': 1}
+
+
+def template(resources, parameters=0):
+    return {
+        "AWSTemplateFormatVersion": "2010-09-09",
+        "Parameters": dict(("Param{}".format(index), {"Type": "String", "Default": "default"})
+                           for index in range(parameters)),
+        "Resources": dict(("Topic{}".format(index), {
+            "Type": "AWS::SNS::Topic",
+            "Properties": {"TopicName": "topic-{}".format(index),
+                           "DisplayName": "Benchmark topic {}".format(index),
+                           "Tags": [{"Key": "Index", "Value": str(index)}]}}) for index in range(resources)),
+        "Outputs": {"FirstTopic": {"Value": "Topic0"}},
+    }
+
+
+def yaml_template(resources):
+    # Use the short form functions, as real templates do, so their constructors are part of the parse time
+    lines = ["AWSTemplateFormatVersion: '2010-09-09'", "Resources:"]
+    for index in range(resources):
+        lines += ["  Topic{}:".format(index),
+                  "    Type: AWS::SNS::Topic",
+                  "    Properties:",
+                  "      TopicName: !Sub '${{AWS::StackName}}-topic-{}'".format(index),
+                  "      DisplayName: !Join ['-', [benchmark, !Ref 'AWS::Region', '{}']]".format(index),
+                  "      Tags:",
+                  "        - Key: Index",
+                  "          Value: '{}'".format(index)]
+    lines += ["Outputs:", "  FirstTopic:", "    Value: !GetAtt Topic0.TopicName"]
+    return "\n".join(lines) + "\n"
+
+
+def encrypted_config(secrets):
+    return dict(("Param{}".format(index), "KMSEncrypted{}/KMSEncrypted".format(base64.b64encode("secret-{}".format(index))))
+                for index in range(secrets))
+
+
+@contextmanager
+def quiet():
+    # Deploys print a lot, which would swamp both the results and the timings
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def measure(function, repeat, setup=None):
+    times = []
+    for attempt in range(repeat):
+        argument = setup(attempt) if setup is not None else None
+        with quiet():
+            start = time.time()
+            function(argument)
+            times.append(time.time() - start)
+
+    times.sort()
+    return {'repeat': repeat,
+            'min': round(times[0], 6),
+            'median': round(times[len(times) // 2], 6),
+            'max': round(times[-1], 6)}
+
+
+def uncached(_):
+    # Measure the first deploy of a process, not one that has everything cached already
+    Template.clear()
+    KMSSecretResolver.clear()
+
+
+def stand_in_executor(latency, executor=None):
+    executor = executor or DeployExecutor()
+    executor.cf_client = CloudFormationUtil(LocalCloudFormation(latency=latency))
+    executor.ec2_client = LocalEC2(latency=latency)
+    executor.kms_client = LocalKMS(latency=latency)
+    executor.s3_client = LocalS3(latency=latency)
+    return executor
+
+
+class Benchmarks(object):
+
+    def __init__(self, directory, sizes, latency):
+        self.directory = directory
+        self.sizes = sizes
+        self.latency = latency
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, content):
+        with open(self.path(name), 'w') as output:
+            output.write(content)
+        return self.path(name)
+
+    def run(self):
+        results = dict()
+        for name in ['cli_startup', 'parse_json_template', 'parse_yaml_template', 'resolve_secrets', 'deploy_execute',
+                     'deploy_many_threads', 'deploy_many_coroutines']:
+            sys.stderr.write("Running {}\n".format(name))
+            results[name] = getattr(self, name)()
+        return results
+
+    def cli_startup(self):
+        # A new process each time, as importing stacker for `stacker --version` is what every command waits on
+        command = [sys.executable, '-c', "from stacker import main; main(['--version'])"]
+
+        def start(_):
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(command, cwd=ROOT, stdout=devnull, stderr=devnull)
+
+        return measure(start, self.sizes['repeat'])
+
+    def parse_json_template(self):
+        filename = self.write('template.json', json.dumps(template(self.sizes['resources']), indent=2))
+        result = measure(lambda _: DeployExecutor().load_template(filename), self.sizes['repeat'], setup=uncached)
+        result.update(resources=self.sizes['resources'], bytes=os.path.getsize(filename))
+        return result
+
+    def parse_yaml_template(self):
+        filename = self.write('template.yaml', yaml_template(self.sizes['resources']))
+        result = measure(lambda _: DeployExecutor().load_template(filename), self.sizes['repeat'], setup=uncached)
+        result.update(resources=self.sizes['resources'], bytes=os.path.getsize(filename))
+        return result
+
+    def resolve_secrets(self):
+        config = encrypted_config(self.sizes['secrets'])
+
+        def setup(attempt):
+            uncached(attempt)
+            return KMSSecretResolver(LocalKMS(latency=self.latency))
+
+        result = measure(lambda resolver: resolver.resolve(config), self.sizes['repeat'], setup=setup)
+        result.update(secrets=self.sizes['secrets'])
+        return result
+
+    def deploy_execute(self):
+        template_filename = self.write('deploy.json', json.dumps(template(self.sizes['resources'], parameters=10)))
+        config_filename = self.write('deploy-config.json', json.dumps(encrypted_config(10)))
+
+        def setup(attempt):
+            uncached(attempt)
+            TemplateStager._staged.clear()
+            executor = stand_in_executor(self.latency)
+            executor.template_bucket = 'benchmarks'
+            return attempt, executor
+
+        def deploy((attempt, executor)):
+            executor.execute(stack_name="benchmark-{}".format(attempt),
+                             template_name=template_filename,
+                             config_filename=config_filename,
+                             version="1.0.0",
+                             create=True)
+
+        result = measure(deploy, self.sizes['repeat'], setup=setup)
+        result.update(resources=self.sizes['resources'])
+        return result
+
+    def deploy_many(self, coroutines):
+        template_filename = self.write('stack.json', json.dumps(template(10)))
+
+        # Layers of ten stacks, each depending on a stack in the layer before it
+        stacks = []
+        for index in range(self.sizes['stacks']):
+            stack = {'name': "stack-{}".format(index), 'template': template_filename, 'create': True}
+            if index >= 10:
+                stack['depends_on'] = ["stack-{}".format(index - 10)]
+            stacks.append(stack)
+        manifest_filename = self.write('manifest.yaml', yaml.safe_dump({'stacks': stacks}))
+
+        def setup(attempt):
+            uncached(attempt)
+            executor = DeployManyExecutor(max_workers=10, coroutines=coroutines)
+            stand_in_executor(self.latency, executor.clients)
+            return executor
+
+        result = measure(lambda executor: executor.execute(manifest_filename, version="1.0.0"),
+                         self.sizes['repeat'], setup=setup)
+        result.update(stacks=self.sizes['stacks'], stacks_per_second=round(self.sizes['stacks'] / result['median'], 1))
+        return result
+
+    def deploy_many_threads(self):
+        return self.deploy_many(coroutines=False)
+
+    def deploy_many_coroutines(self):
+        return self.deploy_many(coroutines=True)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints how each median compares with the baseline's, returning the names of those that got too slow.
+    """
+
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+
+        ratio = results[name]['median'] / max(baseline[name]['median'], 1e-9)
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        sys.stderr.write("{} {:.4f}s -> {:.4f}s ({:.2f}x){}\n".format(name.ljust(24), baseline[name]['median'],
+                                                                       results[name]['median'], ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='benchmarks', description="Benchmarks stacker against local stand-ins for AWS")
+    parser.add_argument('--quick', default=False, action='store_true',
+                        help="Run tiny versions of every benchmark, to check they still work")
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help="Seconds added to every stand-in AWS call (default 0.005)")
+    parser.add_argument('--output', help="Write the results to this file as well as stdout")
+    parser.add_argument('--compare', help="Results of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="How much slower than the earlier run a benchmark can get (default 0.25)")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    try:
+        sizes = QUICK_SIZES if args.quick else SIZES
+        results = Benchmarks(directory, sizes, args.latency).run()
+    finally:
+        shutil.rmtree(directory)
+
+    report = {'stacker': __version__,
+              'python': platform.python_version(),
+              'latency': args.latency,
+              'sizes': sizes,
+              'results': results}
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    print output
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + "\n")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if (baseline['sizes'], baseline['latency']) != (sizes, args.latency):
+            sys.stderr.write("The baseline was run with different sizes or latency, so can't be compared\n")
+            return 1
+        if compare(results, baseline['results'], args.tolerance):
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
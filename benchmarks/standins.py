@@ -0,0 +1,176 @@
+"""
+In-memory stand-ins for the AWS clients stacker uses, so the deploy pipeline can be benchmarked offline.
+
+Each stand-in can add a fixed latency to every call, to approximate the round trip to AWS when measuring how well
+stacker overlaps calls.
+"""
+
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import botocore
+from dateutil.tz import tzutc
+
+
+class StandIn(object):
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _call(self):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class LocalCloudFormation(StandIn):
+    """
+    Keeps stacks and change sets in memory. Change sets are created complete, and executing one finishes the
+    stack straight away, so a deploy never has to wait between polls.
+    """
+
+    def __init__(self, latency=0, changes=10):
+        super(LocalCloudFormation, self).__init__(latency)
+        self.changes = changes
+        self.stacks = {}
+        self.change_sets = {}
+        self.events = {}
+
+    def describe_stacks(self, StackName):
+        self._call()
+        with self._lock:
+            if StackName not in self.stacks:
+                raise botocore.exceptions.ClientError(
+                    {"Error": {"Code": "ValidationError", "Message": "Stack with id {} does not exist".format(StackName)}},
+                    "DescribeStacks")
+            return {"Stacks": [dict(self.stacks[StackName])]}
+
+    def create_change_set(self, StackName, ChangeSetName, ChangeSetType="UPDATE", Tags=None, **kwargs):
+        self._call()
+        with self._lock:
+            if ChangeSetType == "UPDATE" and StackName not in self.stacks:
+                raise botocore.exceptions.ClientError(
+                    {"Error": {"Code": "ValidationError", "Message": "Stack [{}] does not exist".format(StackName)}},
+                    "CreateChangeSet")
+
+            changes = [{"ResourceChange": {"Action": "Add" if ChangeSetType == "CREATE" else "Modify",
+                                           "LogicalResourceId": "Resource{}".format(index),
+                                           "ResourceType": "AWS::SNS::Topic",
+                                           "Replacement": "False"}} for index in range(self.changes)]
+
+            self.change_sets[(StackName, ChangeSetName)] = {"ChangeSetName": ChangeSetName,
+                                                            "StackName": StackName,
+                                                            "ChangeSetType": ChangeSetType,
+                                                            "Status": "CREATE_COMPLETE",
+                                                            "Tags": Tags or [],
+                                                            "Changes": changes}
+            return {"Id": ChangeSetName, "StackId": self._stack_id(StackName)}
+
+    def describe_change_set(self, ChangeSetName, StackName, **kwargs):
+        self._call()
+        with self._lock:
+            change_set = self.change_sets[(StackName, ChangeSetName)]
+            return dict((key, value) for key, value in change_set.items() if key != "ChangeSetType")
+
+    def delete_change_set(self, ChangeSetName, StackName):
+        self._call()
+        with self._lock:
+            del self.change_sets[(StackName, ChangeSetName)]
+        return {}
+
+    def execute_change_set(self, ChangeSetName, StackName, ClientRequestToken=None):
+        self._call()
+        with self._lock:
+            change_set = self.change_sets.pop((StackName, ChangeSetName))
+            status = "CREATE_COMPLETE" if change_set["ChangeSetType"] == "CREATE" else "UPDATE_COMPLETE"
+
+            self.stacks[StackName] = {"StackName": StackName,
+                                      "StackId": self._stack_id(StackName),
+                                      "StackStatus": status,
+                                      "Tags": change_set["Tags"],
+                                      "Outputs": [{"OutputKey": "Name", "OutputValue": StackName}]}
+
+            events = self.events.setdefault(StackName, [])
+            for change in change_set["Changes"]:
+                events.insert(0, self._event(StackName, status, ClientRequestToken,
+                                             change["ResourceChange"]["LogicalResourceId"]))
+            events.insert(0, self._event(StackName, status, ClientRequestToken))
+        return {}
+
+    def describe_stack_events(self, StackName, NextToken=None):
+        self._call()
+        with self._lock:
+            return {"StackEvents": list(self.events.get(StackName, []))}
+
+    def _stack_id(self, stack_name):
+        return "arn:aws:cloudformation:us-east-1:123456789012:stack/{}/1".format(stack_name)
+
+    def _event(self, stack_name, status, token, logical_id=None):
+        stack_id = self._stack_id(stack_name)
+        return {"EventId": str(uuid.uuid4()),
+                "StackId": stack_id,
+                "StackName": stack_name,
+                "LogicalResourceId": logical_id or stack_name,
+                "PhysicalResourceId": stack_id if logical_id is None else "physical-" + logical_id,
+                "ResourceType": "AWS::CloudFormation::Stack" if logical_id is None else "AWS::SNS::Topic",
+                "ResourceStatus": status,
+                "ClientRequestToken": token,
+                "Timestamp": datetime.now(tzutc())}
+
+
+class LocalKMS(StandIn):
+    """
+    "Decrypts" ciphertexts by handing back their bytes, so base64 of any text is a valid secret.
+    """
+
+    def decrypt(self, CiphertextBlob):
+        self._call()
+        return {"Plaintext": CiphertextBlob}
+
+
+class LocalEC2(StandIn):
+    """
+    Finds one image for every artifact ID searched for.
+    """
+
+    def describe_images(self, Owners=None, Filters=None, ImageIds=None, **kwargs):
+        self._call()
+        images = []
+        for search in Filters or []:
+            for value in search["Values"]:
+                images.append({"ImageId": "ami-{:08x}".format(abs(hash(value)) % (1 << 32)),
+                               "Name": value,
+                               "CreationDate": "2017-01-01T00:00:00.000Z",
+                               "Tags": [{"Key": "ArtifactID", "Value": value}]})
+        return {"Images": images}
+
+
+class LocalS3(StandIn):
+    """
+    Keeps staged templates in memory.
+    """
+
+    class Meta(object):
+        region_name = 'us-east-1'
+
+    meta = Meta()
+
+    def __init__(self, latency=0):
+        super(LocalS3, self).__init__(latency)
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body):
+        self._call()
+        self.objects[(Bucket, Key)] = Body
+        return {}
+
+    def head_object(self, Bucket, Key):
+        self._call()
+        if (Bucket, Key) not in self.objects:
+            raise botocore.exceptions.ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        return {"ContentLength": len(self.objects[(Bucket, Key)])}
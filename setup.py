@@ -17,13 +17,18 @@ here = path.abspath(path.dirname(__file__))
 with open(path.join(here, 'README.md'), encoding='utf-8') as f:
     long_description = f.read()
 
+# Get the version without importing the package (and so all of its dependencies)
+version = {}
+with open(path.join(here, 'stacker', 'version.py'), encoding='utf-8') as f:
+    exec(f.read(), version)
+
 setup(
     name='stacker',
 
     # Versions should comply with PEP440.  For a discussion on single-sourcing
     # the version across setup.py and the project code, see
     # https://packaging.python.org/en/latest/single_source_version.html
-    version='0.1.0',
+    version=version['__version__'],
 
     description='A utility for deploying Cloudformation stacks and other helpful features',
     long_description=long_description,
@@ -61,7 +66,7 @@ setup(
         'Programming Language :: Python :: 2.6',
         'Programming Language :: Python :: 2.7',
     ],
-    packages=find_packages(exclude=['contrib', 'docs', 'tests']),
+    packages=find_packages(exclude=['benchmarks', 'contrib', 'docs', 'tests']),
     # packages=['stacker'],
     # package_dir={'stacker':'stacker'},
     package_data={'':['../README.md']},
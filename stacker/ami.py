@@ -1,68 +1,56 @@
 __author__ = "Steve Mactaggart"
 
+import json
+import re
 import sys
 import traceback
 
-import boto3
 import botocore
 
-from cf_helper.utils import DeployException, STSUtil
+from cf_helper.utils import AMIResolver, CredentialProvider, DeployException
 
 
 class AMIExecutor(object):
+    REGEX_AMI_ID = re.compile('^ami-[0-9a-f]+$')
 
-    def __init__(self, role=None, debug=False):
+    # Budget, in seconds, for retrying lookups that AWS throttles
+    lookup_timeout = 60
+
+    def __init__(self, role=None, owners=None, debug=False):
         super(AMIExecutor, self).__init__()
 
         self.debug = debug
         self.role = role
+        self.owners = owners
 
-        if self.role:
-            sts = STSUtil(sts_arn=self.role, debug=debug)
-            credentials = sts.authenticate_role()['Credentials']
-
-            self.ec2_client = boto3.client('ec2',
-                                           aws_access_key_id=credentials['AccessKeyId'],
-                                           aws_secret_access_key=credentials['SecretAccessKey'],
-                                           aws_session_token=credentials['SessionToken'])
+        self.ec2_client = CredentialProvider(role=self.role, debug=debug).client('ec2')
+        self.resolver = None
 
-        else:
-            self.ec2_client = boto3.client('ec2')
+    def get_resolver(self):
+        # Built on first use so tests (and callers) can swap the ec2 client out first
+        if self.resolver is None:
+            self.resolver = AMIResolver.shared(self.ec2_client, owners=self.owners, lookup_timeout=self.lookup_timeout)
+        return self.resolver
 
     def execute(self, artifact_id=None, ami_id=None):
 
         try:
-            # images = []
-            search_val = None
-
             if artifact_id:
-                search_val = artifact_id
-                images = self.ec2_client.describe_images(Filters=[
-                    {
-                        'Name': 'tag:ArtifactID',
-                        'Values': [artifact_id]
-                    }])['Images']
+                image = self.get_resolver().find_one_by_artifact_id(artifact_id)
             elif ami_id:
-                search_val = ami_id
-                images = self.ec2_client.describe_images(ImageIds=[ami_id])['Images']
+                image = self.get_resolver().find_one_by_image_id(ami_id)
             else:
                 raise DeployException("--artifact-id or --ami-id must be supplied for the search")
 
-            if len(images) == 0:
-                raise DeployException("No images found for search '{}'".format(search_val))
-            elif len(images) > 1:
-                print images
-                raise DeployException("More than 1 image found for search '{}'".format(search_val))
-            else:
-                ami_id = images[0]["ImageId"]
-                name = images[0]['Name']
-                create_date = images[0]['CreationDate']
+            ami_id = image["ImageId"]
+            name = image['Name']
+            create_date = image['CreationDate']
 
-                if self.debug:
-                    print "Located AMI '{}' - {} created {}".format(ami_id, name, create_date)
-                else:
-                    print ami_id
-                    return ami_id
+            if self.debug:
+                print "Located AMI '{}' - {} created {}".format(ami_id, name, create_date)
+            else:
+                print ami_id
+                return ami_id
 
         except botocore.exceptions.ClientError as e:
             if str(e) == "An error occurred (ValidationError) when calling the UpdateStack operation: No updates are to be performed.":
@@ -70,3 +58,42 @@ class AMIExecutor(object):
             else:
                 print "Unexpected error: %s" % e
                 sys.exit(1)
+
+    def execute_many(self, artifact_ids=None, ami_ids=None):
+        """
+        Looks up many AMIs at once, printing a line of JSON for each search.
+
+        Returns True only if every search found exactly one image.
+        """
+
+        artifact_ids = artifact_ids or []
+        ami_ids = ami_ids or []
+
+        if len(artifact_ids) == 0 and len(ami_ids) == 0:
+            raise DeployException("--artifact-id, --ami-id or --from-file must be supplied for the search")
+
+        resolver = self.get_resolver()
+        searches = [('artifact-id', artifact_id, images)
+                    for artifact_id, images in sorted(resolver.find_by_artifact_ids(artifact_ids).items())]
+        searches += [('ami-id', ami_id, images)
+                     for ami_id, images in sorted(resolver.find_by_image_ids(ami_ids).items())]
+
+        all_found = True
+        for search_type, search_val, images in searches:
+            result = {'Search': search_val, 'SearchType': search_type}
+
+            if len(images) == 1:
+                result.update(ImageId=images[0]['ImageId'],
+                              Name=images[0]['Name'],
+                              CreationDate=images[0]['CreationDate'])
+            else:
+                all_found = False
+                if len(images) == 0:
+                    result['Error'] = "No images found for search '{}'".format(search_val)
+                else:
+                    result['Error'] = "More than 1 image found for search '{}'".format(search_val)
+                    result['ImageIds'] = sorted(image['ImageId'] for image in images)
+
+            print json.dumps(result, sort_keys=True)
+
+        return all_found
@@ -0,0 +1,333 @@
+import functools
+import heapq
+import itertools
+import sys
+import time
+import types
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from Queue import Empty, Queue
+
+import botocore
+
+import output
+from utils import DeployException, StackEventTracker, Waiter, is_throttling_error, print_stack_outputs
+
+
+class Return(Exception):
+    """
+    Raised by a coroutine to hand a value back to whatever yielded it, as generators can't return values.
+    """
+
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+
+class Call(object):
+    """
+    Yielded by a coroutine to run a blocking function, such as an AWS API call, on one of the engine's workers.
+    """
+
+    def __init__(self, function, *args, **kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+
+class Sleep(object):
+    """
+    Yielded by a coroutine to pause it for delay seconds without holding up any other coroutine.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+
+
+class Task(object):
+    """
+    A coroutine running on an Engine. Yielding a task from another coroutine waits for it to finish.
+    """
+
+    def __init__(self, coroutine, name=None):
+        self.name = name
+        self.stack = [coroutine]
+        self.done = False
+        self.result = None
+        self.error = None
+        self.waiters = []
+
+    def get(self):
+        """
+        Returns the value the coroutine finished with, or raises the error it failed with.
+        """
+
+        if not self.done:
+            raise DeployException("Task '{}' has not finished".format(self.name))
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+
+class Engine(object):
+    """
+    Runs many coroutines from a single thread.
+
+    Coroutines are generators that yield what they are waiting for: a Call to run a blocking function, a Sleep,
+    another coroutine to run it and get its Return value, or a Task to wait for it. Calls run on a pool of
+    max_concurrency workers, which is also the limit on how many are in flight at once across every coroutine.
+    Everything else, including waiting between polls, only costs an entry in a heap, so one process can follow
+    hundreds of stack operations.
+    """
+
+    # Queue.get() can only be interrupted with Ctrl-C when it is given a timeout
+    QUEUE_TIMEOUT = 60 * 60 * 24
+
+    def __init__(self, max_concurrency=10):
+        self.max_concurrency = max_concurrency
+        self._pending = 0
+        self._ready = deque()
+        self._timers = []
+        self._calls = deque()
+        self._in_flight = 0
+        self._results = Queue()
+        self._sequence = itertools.count()
+
+    def spawn(self, coroutine, name=None):
+        task = Task(coroutine, name)
+        self._pending += 1
+        self._ready.append((task, None, None))
+        return task
+
+    def run_until_complete(self, coroutine):
+        task = self.spawn(coroutine)
+        self.run()
+        return task.get()
+
+    def run(self):
+        """
+        Runs every spawned coroutine to completion. Errors are kept on each coroutine's Task.
+        """
+
+        pool = ThreadPool(processes=self.max_concurrency)
+        try:
+            while True:
+                while self._ready:
+                    self._step(*self._ready.popleft())
+
+                while self._calls and self._in_flight < self.max_concurrency:
+                    self._in_flight += 1
+                    pool.apply_async(self._invoke, self._calls.popleft())
+
+                if self._pending == 0:
+                    break
+
+                if self._in_flight == 0 and not self._timers:
+                    raise DeployException("{} tasks are waiting on each other and can never finish"
+                                          .format(self._pending))
+
+                timeout = self.QUEUE_TIMEOUT
+                if self._timers:
+                    timeout = max(0, self._timers[0][0] - time.time())
+
+                output.flush()
+                if self._in_flight > 0:
+                    self._collect(timeout)
+                else:
+                    time.sleep(timeout)
+
+                now = time.time()
+                while self._timers and self._timers[0][0] <= now:
+                    self._ready.append((heapq.heappop(self._timers)[2], None, None))
+        finally:
+            pool.close()
+            pool.join()
+
+    def _collect(self, timeout):
+        try:
+            result = self._results.get(True, timeout)
+        except Empty:
+            return
+
+        # Pick up everything else that has finished too, so their coroutines all move on in this pass
+        while True:
+            self._in_flight -= 1
+            self._ready.append(result)
+            try:
+                result = self._results.get_nowait()
+            except Empty:
+                return
+
+    def _invoke(self, task, call):
+        try:
+            self._results.put((task, call.function(*call.args, **call.kwargs), None))
+        except Exception:
+            self._results.put((task, None, sys.exc_info()))
+
+    def _step(self, task, value, error):
+        while True:
+            coroutine = task.stack[-1]
+            try:
+                if error is not None:
+                    instruction = coroutine.throw(*error)
+                else:
+                    instruction = coroutine.send(value)
+            except Return as returned:
+                value, error = returned.value, None
+            except StopIteration:
+                value, error = None, None
+            except Exception:
+                value, error = None, sys.exc_info()
+            else:
+                value, error = None, None
+
+                if isinstance(instruction, types.GeneratorType):
+                    task.stack.append(instruction)
+                elif isinstance(instruction, Call):
+                    self._calls.append((task, instruction))
+                    return
+                elif isinstance(instruction, Sleep):
+                    heapq.heappush(self._timers, (time.time() + instruction.delay, next(self._sequence), task))
+                    return
+                elif isinstance(instruction, Task):
+                    if not instruction.done:
+                        instruction.waiters.append(task)
+                        return
+                    value, error = instruction.result, instruction.error
+                else:
+                    error = (TypeError, TypeError("Coroutines can't yield {!r}".format(instruction)), None)
+                continue
+
+            # The coroutine has finished, so hand its outcome to whatever yielded it
+            task.stack.pop()
+            if not task.stack:
+                self._finish(task, value, error)
+                return
+
+    def _finish(self, task, value, error):
+        task.done = True
+        task.result = value
+        task.error = error
+        self._pending -= 1
+
+        for waiter in task.waiters:
+            self._ready.append((waiter, value, error))
+
+
+class BlockingCloudFormationUtil(object):
+    """
+    Lets a coroutine use a CloudFormationUtil as it is, so there is one deployment coroutine whichever util is used.
+
+    Every method, including the proxied client methods, returns a Call to be yielded, which runs the method, waits
+    between polls and all, on one of the engine's workers.
+    """
+
+    def __init__(self, cf_client):
+        self.cf_client = cf_client
+
+    def __getattr__(self, name):
+        if name == 'cf_client':
+            raise AttributeError(name)
+        return functools.partial(Call, getattr(self.cf_client, name))
+
+
+class AsyncCloudFormationUtil(object):
+    """
+    The coroutine counterpart of CloudFormationUtil, for following many stacks from one Engine.
+
+    Every method, including the proxied client methods, returns a coroutine to be yielded. API calls run on the
+    engine's workers and the waits between polls are engine timers, so a stack that is waiting doesn't hold a thread.
+    """
+
+    # How long a single throttled API call is retried for
+    call_timeout = 60
+
+    def __init__(self, cf_client):
+        self.cf_client = cf_client
+
+    def __getattr__(self, name):
+        if name == 'cf_client':
+            raise AttributeError(name)
+
+        function = getattr(self.cf_client, name)
+
+        def call(*args, **kwargs):
+            return self.call(Waiter(timeout=self.call_timeout), function, *args, **kwargs)
+
+        return call
+
+    def call(self, waiter, function, *args, **kwargs):
+        """
+        Calls an AWS API function, backing off on the engine rather than in a worker if we are throttled.
+        """
+
+        while True:
+            try:
+                result = yield Call(function, *args, **kwargs)
+            except botocore.exceptions.ClientError as error:
+                if not is_throttling_error(error):
+                    raise
+                delay = waiter.backoff()
+                if delay is None:
+                    raise
+            else:
+                raise Return(result)
+
+            yield Sleep(delay)
+
+    def wait_for_change_set_to_complete(self, stack_name, change_set_name, timeout=600, min_delay=1, max_delay=15,
+                                        debug=True):
+
+        waiter = Waiter(timeout=timeout, min_delay=min_delay, max_delay=max_delay)
+
+        while True:
+            change_set = yield self.call(waiter, self.cf_client.describe_change_set,
+                                         ChangeSetName=change_set_name,
+                                         StackName=stack_name)
+
+            state = change_set['Status']
+
+            if debug:
+                print "({}s) - ChangeSet [{}] for {} is {}".format(waiter.elapsed(), change_set_name, stack_name, state)
+
+            if "IN_PROGRESS" in state or "PENDING" in state:
+                delay = waiter.next_delay()
+                if delay is None:
+                    raise DeployException("Timeout waiting for stack '{}' ChangeSet to be created, "
+                                          "last status was '{}'".format(stack_name, state))
+                yield Sleep(delay)
+            elif "FAILED" in state or "UPDATE_ROLLBACK_COMPLETE" == state:
+                raise DeployException("Stack '{}' ChangeSet failed, "
+                                      "last status was '{}' - {}".format(stack_name, state, change_set["StatusReason"]))
+            else:
+                raise Return(change_set)
+
+    def wait_for_deploy_to_complete(self, stack_name, show_outputs=True, client_request_token=None, since=None,
+                                    timeout=4500, min_delay=2, max_delay=30, label=None):
+
+        tracker = StackEventTracker(self.cf_client, stack_name,
+                                    client_request_token=client_request_token, since=since, label=label)
+
+        waiter = Waiter(timeout=timeout, min_delay=min_delay, max_delay=max_delay)
+
+        while True:
+            events = yield self.call(waiter, tracker.poll)
+            for event in events:
+                tracker.report(event)
+
+            state = tracker.stack_status
+            if state is not None and "IN_PROGRESS" not in state:
+                if "FAILED" in state or "ROLLBACK_COMPLETE" in state:
+                    raise DeployException("Stack '{}' modification failed, "
+                                          "last status was '{}'".format(stack_name, state))
+                break
+
+            delay = waiter.next_delay()
+            if delay is None:
+                raise DeployException("Timeout waiting for stack '{}' to complete modification, "
+                                      "last status was '{}'".format(stack_name, state))
+            yield Sleep(delay)
+
+        if show_outputs:
+            response = yield self.call(waiter, self.cf_client.describe_stacks, StackName=stack_name)
+            print_stack_outputs(response['Stacks'][0], label=label)
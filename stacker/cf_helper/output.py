@@ -0,0 +1,164 @@
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from redaction import REDACTOR
+
+
+class OutputSink(object):
+    """
+    The one place everything stacker reports is written to.
+
+    Text that is printed arrives here through sys.stdout. In text mode it is passed straight on, and in json mode
+    each line of it becomes a "message" event, so the output is all JSON lines along with the events sent to
+    event(). Nothing is flushed on every write; flush() is called where someone watching would want to see
+    progress, such as before waiting on AWS.
+    """
+
+    FORMATS = ['text', 'json']
+
+    # The sink the running command writes to, set by the CLI
+    current = None
+
+    def __init__(self, stream, format='text', redactor=REDACTOR):
+        self.stream = stream
+        self.format = format
+        self.redactor = redactor
+        self._partial = ""
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        with self._lock:
+            if self.format != 'json':
+                self.stream.write(data)
+                return
+
+            lines = (self._partial + data).split("\n")
+            self._partial = lines.pop()
+            for line in lines:
+                self._emit({'event': 'message', 'message': line})
+
+    def event(self, event, **fields):
+        if self.format != 'json':
+            return
+        fields = event_fields(event, **fields)
+        with self._lock:
+            self._emit(fields)
+
+    def flush(self):
+        with self._lock:
+            self.stream.flush()
+
+    def release(self):
+        """
+        Writes out any unfinished line, for when nothing else is going to be written.
+        """
+
+        if self._partial:
+            self.write("\n")
+        self.flush()
+
+    def _emit(self, fields):
+        # Events don't pass through the redacting stream that printed text does
+        self.stream.write(self.redactor.redact(json.dumps(fields, sort_keys=True, default=str)) + "\n")
+
+
+def event_fields(event, **fields):
+    """
+    Returns the JSON object written for an event.
+    """
+
+    fields = dict((key, value) for key, value in fields.items() if value is not None)
+    fields.update(event=event, time=round(time.time(), 3))
+    return fields
+
+
+def structured():
+    """
+    Whether the running command's output is JSON events rather than text.
+    """
+
+    return OutputSink.current is not None and OutputSink.current.format == 'json'
+
+
+def event(event, **fields):
+    """
+    Sends an event when the output is JSON, and does nothing otherwise.
+    """
+
+    if OutputSink.current is not None:
+        OutputSink.current.event(event, **fields)
+
+
+def print_event(event_name, **fields):
+    """
+    Sends the event when the output is JSON, and otherwise prints it as a line of JSON amongst the text.
+    """
+
+    if structured():
+        event(event_name, **fields)
+    else:
+        print json.dumps(event_fields(event_name, **fields), sort_keys=True, default=str)
+
+
+def report(text, event_name, **fields):
+    """
+    Prints text, or sends the event in its place when the output is JSON.
+    """
+
+    if structured():
+        event(event_name, **fields)
+    else:
+        print text
+
+
+def labelled(text, label):
+    """
+    Starts each line of text with [label], so the lines of deployments printing at the same time can be told apart.
+    """
+
+    if label is None:
+        return text
+    return "\n".join("[{}] {}".format(label, line).rstrip() for line in text.split("\n"))
+
+
+def flush():
+    """
+    Shows everything reported so far, for the points where stacker is about to wait.
+    """
+
+    sys.stdout.flush()
+
+
+class _NoEvent(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NO_EVENT = _NoEvent()
+
+
+@contextmanager
+def _phase(phase, labels):
+    start = time.time()
+    status = 'FAILED'
+    try:
+        yield
+        status = 'COMPLETE'
+    finally:
+        event('phase', phase=phase, status=status, seconds=round(time.time() - start, 3), **labels)
+
+
+def phase(phase, **labels):
+    """
+    Sends a phase event, with how long it took and whether it failed, when the output is JSON.
+    """
+
+    if not structured():
+        return NO_EVENT
+    return _phase(phase, labels)
@@ -0,0 +1,117 @@
+import re
+import threading
+
+
+class Redactor(object):
+    """
+    Masks a set of secrets in text with a single compiled regex, so the cost of a pass doesn't grow with the
+    number of secrets.
+
+    Longer secrets are matched before shorter ones, so a secret that contains another is masked whole.
+    """
+
+    MASK = "*****"
+
+    def __init__(self, secrets=()):
+        self.secrets = set()
+        self.pattern = None
+        self.longest = 0
+        self.multiline = False
+        self._lock = threading.Lock()
+        self.add(secrets)
+
+    def add(self, secrets):
+        with self._lock:
+            new_secrets = set(secret for secret in secrets if secret) - self.secrets
+            if not new_secrets:
+                return
+
+            self.secrets |= new_secrets
+            ordered = sorted(self.secrets, key=len, reverse=True)
+            self.pattern = re.compile("|".join(re.escape(secret) for secret in ordered))
+            self.longest = len(ordered[0])
+            self.multiline = any("\n" in secret for secret in ordered)
+
+    def clear(self):
+        with self._lock:
+            self.secrets = set()
+            self.pattern = None
+            self.longest = 0
+            self.multiline = False
+
+    def redact(self, text):
+        pattern = self.pattern
+        if pattern is None:
+            return text
+        return pattern.sub(self.MASK, text)
+
+
+# Every secret decrypted by this process, for masking everything it prints
+REDACTOR = Redactor()
+
+
+class RedactingStream(object):
+    """
+    Wraps an output stream so everything written to it is masked by a Redactor, in one pass as it is written.
+
+    A secret can be split across two writes, so the end of each write that could be the start of a secret is held
+    back until the next one. Unless a secret spans lines, everything up to the last newline is always written
+    straight away, so line by line output isn't delayed.
+    """
+
+    def __init__(self, stream, redactor=REDACTOR):
+        self.stream = stream
+        self.redactor = redactor
+        self.softspace = 0
+        self._pending = ""
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        with self._lock:
+            text = self._pending + data
+            pattern = self.redactor.pattern
+
+            if pattern is None:
+                self._pending = ""
+                self.stream.write(text)
+                return
+
+            # Anything that starts before the cut has room for even the longest secret, so can be decided now
+            cut = max(0, len(text) - (self.redactor.longest - 1))
+            if not self.redactor.multiline:
+                cut = max(cut, text.rfind("\n") + 1)
+
+            output = []
+            position = 0
+            for match in pattern.finditer(text):
+                if match.start() >= cut:
+                    break
+                output += [text[position:match.start()], self.redactor.MASK]
+                position = match.end()
+
+            cut = max(cut, position)
+            output += [text[position:cut]]
+            self._pending = text[cut:]
+            self.stream.write("".join(output))
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        self.stream.flush()
+
+    def release(self):
+        """
+        Writes out anything held back, for when nothing else is going to be written.
+        """
+
+        with self._lock:
+            pending, self._pending = self._pending, ""
+            self.stream.write(self.redactor.redact(pending))
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        if name == 'stream':
+            raise AttributeError(name)
+        return getattr(self.stream, name)
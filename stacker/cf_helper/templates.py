@@ -0,0 +1,179 @@
+import errno
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from datetime import date, datetime
+
+import yaml
+
+from utils import LRUCache
+
+# LibYAML is many times faster than the pure Python parser, so use it whenever PyYAML was built with it
+try:
+    from yaml import CSafeLoader as BaseLoader
+except ImportError:
+    from yaml import SafeLoader as BaseLoader
+
+
+def function_constructor(name):
+    """
+    Builds a constructor that turns a short form function tag into its long form, e.g. !Ref into {"Ref": ...}.
+    """
+
+    def construct_function(loader, node):
+        if isinstance(node, yaml.ScalarNode):
+            value = loader.construct_scalar(node)
+        elif isinstance(node, yaml.SequenceNode):
+            value = loader.construct_sequence(node, deep=True)
+        else:
+            value = loader.construct_mapping(node, deep=True)
+        return {name: value}
+
+    return construct_function
+
+
+def construct_get_att(loader, node):
+    # The short form of GetAtt is a single "Resource.Attribute" string rather than a list
+    if isinstance(node, yaml.ScalarNode):
+        return {u"Fn::GetAtt": loader.construct_scalar(node).split(u".", 1)}
+    return {u"Fn::GetAtt": loader.construct_sequence(node, deep=True)}
+
+
+class TemplateLoader(BaseLoader):
+    """
+    A YAML loader that understands the CloudFormation short form function tags.
+    """
+    pass
+
+
+for function in [u"Base64", u"Cidr", u"FindInMap", u"GetAZs", u"ImportValue", u"Join", u"Select", u"Split", u"Sub",
+                 u"Transform", u"And", u"Equals", u"If", u"Not", u"Or"]:
+    TemplateLoader.add_constructor(u"!" + function, function_constructor(u"Fn::" + function))
+
+TemplateLoader.add_constructor(u"!Ref", function_constructor(u"Ref"))
+TemplateLoader.add_constructor(u"!Condition", function_constructor(u"Condition"))
+TemplateLoader.add_constructor(u"!GetAtt", construct_get_att)
+
+
+def load_yaml(stream):
+    return yaml.load(stream, Loader=TemplateLoader)
+
+
+def serialize(cloudformation):
+    """
+    Returns the template as compact JSON with its keys sorted, so the same template always gives the same bytes.
+    """
+
+    return json.dumps(cloudformation, sort_keys=True, separators=(',', ':'), default=_serialize_value)
+
+
+def _serialize_value(value):
+    # Unquoted dates in YAML, like AWSTemplateFormatVersion: 2010-09-09, are parsed as dates
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError("{!r} can't be sent to CloudFormation".format(value))
+
+
+class Template(object):
+    """
+    A parsed template along with the JSON body that is fingerprinted and, with the fingerprint added, sent to
+    CloudFormation.
+
+    Templates are kept for the life of the process by the hash of their source, so a template used by many stacks
+    is only parsed and serialized once. Only the most recently used are kept.
+    """
+
+    _templates = LRUCache(max_entries=64)
+    _lock = threading.Lock()
+
+    def __init__(self, data):
+        self.data = data
+        self.body = serialize(data)
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._templates.clear()
+
+    @classmethod
+    def load(cls, content, parse):
+        key = (hashlib.sha256(content).hexdigest(), parse)
+
+        with cls._lock:
+            template = cls._templates.get(key)
+        if template is None:
+            template = cls(parse(content))
+            with cls._lock:
+                cls._templates[key] = template
+        return template
+
+
+class TemplateCache(object):
+    """
+    Keeps parsed templates on disk so repeat deploys of an unchanged template don't parse it again.
+
+    Entries are keyed by the template's path, and only used if the hash of the file's content still matches.
+    Hashing is much cheaper than parsing, and unlike the modification time and size it can't miss an edit.
+
+    Entries hold the template's JSON body rather than a pickle, so a planted entry can't run code when it is read.
+    """
+
+    DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'stacker', 'templates')
+
+    # Bump whenever the shape of the entries changes so old entries are ignored
+    VERSION = 3
+
+    def __init__(self, path=None):
+        self.path = path or self.DEFAULT_PATH
+
+    def load(self, filename, parse):
+        """
+        Returns the Template in filename, calling parse with the file's content to get it if it isn't cached.
+        """
+
+        with open(filename, 'rb') as template_file:
+            content = template_file.read()
+        digest = hashlib.sha256(content).hexdigest()
+
+        entry_filename = os.path.join(self.path, hashlib.sha1(os.path.realpath(filename)).hexdigest() + '.json')
+        entry = self._read_entry(entry_filename)
+        if entry is not None and entry.get('digest') == digest:
+            return Template(json.loads(entry['body']))
+
+        template = parse(content)
+        self._write_entry(entry_filename, {'version': self.VERSION,
+                                           'digest': digest,
+                                           'body': template.body})
+        return template
+
+    def _read_entry(self, entry_filename):
+        try:
+            with open(entry_filename, 'rb') as entry_file:
+                entry = json.load(entry_file)
+        except Exception:
+            return None
+
+        if not isinstance(entry, dict) or entry.get('version') != self.VERSION:
+            return None
+        return entry
+
+    def _write_entry(self, entry_filename, entry):
+        try:
+            os.makedirs(self.path, 0700)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        # The directory may have been made by someone else, so make sure nobody else can plant entries in it
+        os.chmod(self.path, 0700)
+
+        # Write to a temporary file first so other processes never read a partial entry
+        fd, temp_filename = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as entry_file:
+                json.dump(entry, entry_file)
+            os.rename(temp_filename, entry_filename)
+        except Exception:
+            os.remove(temp_filename)
+            raise
@@ -0,0 +1,159 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+import output
+from utils import THROTTLING_CODES
+
+
+class Timings(object):
+    """
+    Records how long each phase of a run takes, and how many AWS calls, retries and throttles each operation had.
+
+    Phases are timed with span(), and clients are counted once they have been attach()ed, which hooks into
+    botocore's events rather than wrapping the clients. Everything can be recorded from many threads at once.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = []
+        self.operations = {}
+        self.clients = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, phase, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            entry = dict((key, value) for key, value in labels.items() if value is not None)
+            entry['phase'] = phase
+            entry['seconds'] = round(time.time() - start, 3)
+            with self._lock:
+                self.phases.append(entry)
+
+    def attach(self, client):
+        """
+        Counts the calls made with a client. Attaching the same client again does nothing.
+        """
+
+        with self._lock:
+            if client in self.clients:
+                return
+            self.clients.append(client)
+
+        for event, handler in self._handlers():
+            client.meta.events.register(event, handler, unique_id=self._unique_id(event))
+
+    def detach(self):
+        """
+        Stops counting the calls made with every attached client, which outlive us when they are shared.
+        """
+
+        with self._lock:
+            clients, self.clients = self.clients, []
+
+        for client in clients:
+            for event, handler in self._handlers():
+                client.meta.events.unregister(event, handler, unique_id=self._unique_id(event))
+
+    def _handlers(self):
+        return [('before-call', self._before_call),
+                ('before-send', self._before_send),
+                ('needs-retry', self._needs_retry),
+                ('after-call', self._after_call),
+                ('after-call-error', self._after_call)]
+
+    def _unique_id(self, event):
+        return 'stacker-timings-{}-{}'.format(event, id(self))
+
+    def report(self):
+        phase_totals = dict()
+        for entry in self.phases:
+            phase_totals[entry['phase']] = round(phase_totals.get(entry['phase'], 0) + entry['seconds'], 3)
+
+        operations = []
+        for (service, operation), counts in sorted(self.operations.items()):
+            entry = dict(counts)
+            entry.update(service=service, operation=operation, seconds=round(counts['seconds'], 3),
+                         retries=counts['attempts'] - counts['calls'])
+            operations.append(entry)
+
+        return {'total_seconds': round(time.time() - self.started, 3),
+                'phase_totals': phase_totals,
+                'phases': self.phases,
+                'operations': operations}
+
+    def write(self, filename):
+        """
+        Writes the report as JSON to filename, or stdout when filename is -.
+        """
+
+        if filename == '-' and output.structured():
+            output.event('timings', **self.report())
+            return
+
+        report = json.dumps(self.report(), indent=2, sort_keys=True)
+        if filename == '-':
+            print report
+        else:
+            with open(filename, 'w') as report_file:
+                report_file.write(report + "\n")
+
+    def _counts(self, event_name):
+        # Event names look like before-call.cloudformation.DescribeStacks
+        key = tuple(event_name.split('.')[1:3])
+
+        counts = self.operations.get(key)
+        if counts is None:
+            counts = {'calls': 0, 'attempts': 0, 'throttles': 0, 'errors': 0, 'seconds': 0.0}
+            self.operations[key] = counts
+        return counts
+
+    def _before_call(self, event_name, context=None, **kwargs):
+        if context is not None:
+            context['stacker_started'] = time.time()
+        with self._lock:
+            self._counts(event_name)['calls'] += 1
+
+    def _before_send(self, event_name, **kwargs):
+        with self._lock:
+            self._counts(event_name)['attempts'] += 1
+
+    def _needs_retry(self, event_name, response=None, **kwargs):
+        if response is None or response[1].get('Error', {}).get('Code') not in THROTTLING_CODES:
+            return
+        with self._lock:
+            self._counts(event_name)['throttles'] += 1
+
+    def _after_call(self, event_name, context=None, **kwargs):
+        started = (context or {}).get('stacker_started')
+        with self._lock:
+            counts = self._counts(event_name)
+            if started is not None:
+                counts['seconds'] += time.time() - started
+            if event_name.startswith('after-call-error'):
+                counts['errors'] += 1
+
+
+class _NotTimed(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NOT_TIMED = _NotTimed()
+
+
+def span(timings, phase, **labels):
+    """
+    Times a phase when timings is a Timings, and does nothing when it is None.
+    """
+
+    if timings is None:
+        return NOT_TIMED
+    return timings.span(phase, **labels)
@@ -1,33 +1,358 @@
+import base64
+import errno
+import hashlib
+import json
+import os
+import random
+import re
 import time
 import boto3
+import botocore
 import getpass
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+
+from botocore.config import Config
+from botocore.credentials import RefreshableCredentials
+from botocore.session import get_session
+from botocore.utils import parse_timestamp
+from dateutil.tz import tzutc
+
+import output
+from redaction import REDACTOR
 
 class DeployException(Exception):
     pass
 
+def botocore_version():
+    return tuple(int(part) for part in re.findall(r'\d+', botocore.__version__)[:2])
+
+class LRUCache(object):
+    """
+    A mapping that holds at most max_entries, forgetting the least recently used entry to make room for a new one.
+
+    It does no locking of its own, callers already hold a lock around their lookups.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self._entries:
+            return default
+        value = self._entries.pop(key)
+        self._entries[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __delitem__(self, key):
+        del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def values(self):
+        return self._entries.values()
+
+    def clear(self):
+        self._entries.clear()
+
 class STSUtil(object):
 
-    def __init__(self, sts_arn, debug=False):
+    def __init__(self, sts_arn, debug=False, cache=None):
         self.sts_arn = sts_arn
         self.debug = debug
+        self.cache = cache
 
     def authenticate_role(self):
-        sts_client = boto3.client("sts")
-
         current_user = getpass.getuser()
         assuming_user = "deploy@"+current_user
+
+        if self.cache is not None:
+            credentials = self.cache.get(self.sts_arn, assuming_user)
+            if credentials is not None:
+                if self.debug:
+                    print "Using cached credentials for role {} as {}".format(self.sts_arn, assuming_user)
+                self.role = {'Credentials': credentials}
+                return self.role
+
+        sts_client = boto3.client("sts")
+
         if self.debug:
             print "Assuming role of {} as {}".format(self.sts_arn, assuming_user)
         self.role = sts_client.assume_role(RoleArn=self.sts_arn,
                                            RoleSessionName=assuming_user)
 
+        if self.cache is not None:
+            self.cache.put(self.sts_arn, assuming_user, self.role['Credentials'])
+
         return self.role
 
+class CredentialFileCache(object):
+    """
+    Keeps temporary role credentials on disk so back to back stacker runs don't each have to call STS.
+
+    Entries are only handed out while they have more than expiry_window left to run, which matches the
+    point at which botocore would want to refresh them anyway. Expired entries are removed as they are found.
+    """
+
+    DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'stacker', 'credentials')
+
+    def __init__(self, path=None, expiry_window=timedelta(minutes=15)):
+        self.path = path or self.DEFAULT_PATH
+        self.expiry_window = expiry_window
+
+    def key(self, role_arn, session_name):
+        return hashlib.sha256("{}|{}".format(role_arn, session_name)).hexdigest()
+
+    def get(self, role_arn, session_name):
+        filename = os.path.join(self.path, self.key(role_arn, session_name) + '.json')
+
+        try:
+            with open(filename) as cache_file:
+                entry = json.load(cache_file)
+        except (IOError, ValueError):
+            return None
+
+        if entry.get('RoleArn') != role_arn or entry.get('RoleSessionName') != session_name:
+            return None
+
+        credentials = entry['Credentials']
+        credentials['Expiration'] = parse_timestamp(credentials['Expiration'])
+
+        if self._expired(credentials):
+            self._remove(filename)
+            return None
+
+        return credentials
+
+    def put(self, role_arn, session_name, credentials):
+        self._make_cache_dir()
+
+        entry = {
+            'RoleArn': role_arn,
+            'RoleSessionName': session_name,
+            'Credentials': {
+                'AccessKeyId': credentials['AccessKeyId'],
+                'SecretAccessKey': credentials['SecretAccessKey'],
+                'SessionToken': credentials['SessionToken'],
+                'Expiration': credentials['Expiration'].isoformat(),
+            }
+        }
+
+        # Write to a private temporary file first so other processes never see a partial entry
+        fd, temp_filename = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump(entry, cache_file)
+            os.chmod(temp_filename, 0600)
+            os.rename(temp_filename, os.path.join(self.path, self.key(role_arn, session_name) + '.json'))
+        except Exception:
+            self._remove(temp_filename)
+            raise
+
+        self.evict_expired()
+
+    def evict_expired(self):
+        try:
+            filenames = os.listdir(self.path)
+        except OSError:
+            return
+
+        for filename in filenames:
+            if not filename.endswith('.json'):
+                continue
+            filename = os.path.join(self.path, filename)
+            try:
+                with open(filename) as cache_file:
+                    expiration = parse_timestamp(json.load(cache_file)['Credentials']['Expiration'])
+            except (IOError, ValueError, KeyError):
+                continue
+            if expiration <= datetime.now(tzutc()):
+                self._remove(filename)
+
+    def _expired(self, credentials):
+        return credentials['Expiration'] - self.expiry_window <= datetime.now(tzutc())
+
+    def _make_cache_dir(self):
+        try:
+            os.makedirs(self.path, 0700)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        os.chmod(self.path, 0700)
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+class CredentialProvider(object):
+    """
+    Hands out boto clients that all share a single session per IAM role.
+
+    The role is assumed at most once per process, and the credentials are refreshed by botocore
+    shortly before they expire, so every client created here can be held for the life of the process.
+    Sessions and clients are also kept per AWS_* environment, which a server sets to the sender's for each command.
+    Clients are kept per role, service, region and client settings, so everything that talks to the same endpoint
+    shares one client and its pool of open connections. Only the most recently used sessions and clients are kept, so a
+    long lived `stacker serve` doesn't grow without bound.
+    """
+
+    _sessions = LRUCache(max_entries=32)
+    _clients = LRUCache(max_entries=256)
+    _lock = threading.Lock()
+
+    # Set to a CredentialFileCache to share assumed role credentials between processes
+    file_cache = None
+
+    # Set to a Timings to count the calls made with every client
+    timings = None
+
+    # Settings for every client. The pool should be at least as big as the number of threads sharing a client,
+    # otherwise urllib3 throws connections away and each call pays for a new TLS handshake.
+    max_pool_connections = 10
+    connect_timeout = 10
+    read_timeout = 60
+    max_attempts = 5
+    retry_mode = 'standard'
+
+    def __init__(self, role=None, debug=False, max_pool_connections=None):
+        self.role = role
+        self.debug = debug
+        # Callers sharing clients between more threads than usual ask for a bigger pool for just their clients
+        if max_pool_connections is not None:
+            self.max_pool_connections = max_pool_connections
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._sessions.clear()
+            cls._clients.clear()
+
+    @classmethod
+    def environment(cls):
+        # Sessions take their credentials, profile and region from these when they are created
+        return tuple(sorted((key, value) for key, value in os.environ.items() if key.startswith('AWS_')))
+
+    def settings(self):
+        return self.max_pool_connections, self.connect_timeout, self.read_timeout, self.max_attempts, self.retry_mode
+
+    def config(self):
+        options = dict(max_pool_connections=self.max_pool_connections,
+                       connect_timeout=self.connect_timeout,
+                       read_timeout=self.read_timeout)
+
+        # Retries can only be configured from botocore 1.6, older releases reject the option and keep their defaults
+        if botocore_version() >= (1, 6):
+            options['retries'] = {'max_attempts': self.max_attempts}
+
+        # Retry modes arrived in botocore 1.15, older releases reject them and always retry the legacy way
+        if botocore_version() >= (1, 15):
+            options['retries']['mode'] = self.retry_mode
+
+        # Older botocore releases can't turn on TCP keep-alive, but still reuse connections from the pool
+        if 'tcp_keepalive' in Config.OPTION_DEFAULTS:
+            options['tcp_keepalive'] = True
+
+        return Config(**options)
+
+    def session(self):
+        with self._lock:
+            return self._get_session()
+
+    def client(self, service_name, region_name=None, **kwargs):
+        # boto3 sessions aren't thread safe, so only one thread builds a client from them at a time
+        with self._lock:
+            session = self._get_session()
+            region_name = region_name or session.region_name
+
+            # Clients made with any other arguments, such as their own config, aren't shared
+            if kwargs:
+                kwargs['config'] = self.config().merge(kwargs['config']) if 'config' in kwargs else self.config()
+                client = session.client(service_name, region_name=region_name, **kwargs)
+            else:
+                # A client made before the settings changed, say a bigger pool, isn't what the caller asked for
+                key = (self.role, self.environment(), service_name, region_name, self.settings())
+                client = self._clients.get(key)
+                if client is None:
+                    client = session.client(service_name, region_name=region_name, config=self.config())
+                    self._clients[key] = client
+
+            if self.timings is not None:
+                self.timings.attach(client)
+            return client
+
+    def _get_session(self):
+        key = (self.role, self.environment())
+        session = self._sessions.get(key)
+        if session is None:
+            if self.role:
+                session = self._create_role_session()
+            # If no role is specified the current environments will be used
+            else:
+                session = boto3.Session()
+            self._sessions[key] = session
+        return session
+
+    def _create_role_session(self):
+        sts = STSUtil(sts_arn=self.role, debug=self.debug, cache=self.file_cache)
+
+        def refresh():
+            credentials = sts.authenticate_role()['Credentials']
+            return {
+                'access_key': credentials['AccessKeyId'],
+                'secret_key': credentials['SecretAccessKey'],
+                'token': credentials['SessionToken'],
+                'expiry_time': credentials['Expiration'].isoformat(),
+            }
+
+        credentials = RefreshableCredentials.create_from_metadata(metadata=refresh(),
+                                                                  refresh_using=refresh,
+                                                                  method='sts-assume-role')
+
+        botocore_session = get_session()
+        botocore_session._credentials = credentials
+
+        return boto3.Session(botocore_session=botocore_session)
+
+# Every stack status but DELETE_COMPLETE, so list_stacks leaves out the stacks deleted in the last 90 days
+LIVE_STACK_STATUSES = [
+    'CREATE_IN_PROGRESS', 'CREATE_FAILED', 'CREATE_COMPLETE',
+    'ROLLBACK_IN_PROGRESS', 'ROLLBACK_FAILED', 'ROLLBACK_COMPLETE',
+    'DELETE_IN_PROGRESS', 'DELETE_FAILED',
+    'UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_COMPLETE', 'UPDATE_FAILED',
+    'UPDATE_ROLLBACK_IN_PROGRESS', 'UPDATE_ROLLBACK_FAILED', 'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS',
+    'UPDATE_ROLLBACK_COMPLETE',
+    'REVIEW_IN_PROGRESS',
+    'IMPORT_IN_PROGRESS', 'IMPORT_COMPLETE',
+    'IMPORT_ROLLBACK_IN_PROGRESS', 'IMPORT_ROLLBACK_FAILED', 'IMPORT_ROLLBACK_COMPLETE',
+]
+
 class CloudFormationUtil(object):
 
     def __init__(self, cf_client):
         self.cf_client = cf_client
 
+    def __getattr__(self, name):
+        # Anything not implemented by this helper is passed straight through to the boto client
+        if name == 'cf_client':
+            raise AttributeError(name)
+        return getattr(self.cf_client, name)
+
     def has_parameter(self, parameter_set, paramater_name):
 
         for param in parameter_set:
@@ -35,74 +360,680 @@ class CloudFormationUtil(object):
                 return True
         return False
 
-    def wait_for_change_set_to_complete(self, stack_name, change_set_name, loop_timeout=1, max_loops=30, debug=True):
-
-        still_checking = True
-        loop_count = 1
+    def wait_for_change_set_to_complete(self, stack_name, change_set_name, timeout=600, min_delay=1, max_delay=15,
+                                        debug=True):
 
-        stack = None
-        while still_checking:
+        waiter = Waiter(timeout=timeout, min_delay=min_delay, max_delay=max_delay)
 
-            stack = self.cf_client.describe_change_set(
-                ChangeSetName=change_set_name,
-                StackName=stack_name,
-                )
+        while True:
+            change_set = waiter.call(self.cf_client.describe_change_set,
+                                     ChangeSetName=change_set_name,
+                                     StackName=stack_name)
 
-            state = stack['Status']
+            state = change_set['Status']
 
             if debug:
-                print "({}/{}) - ChangeSet [{}] for {} is {}".format(loop_count, max_loops, change_set_name, stack_name, state)
+                print "({}s) - ChangeSet [{}] for {} is {}".format(waiter.elapsed(), change_set_name, stack_name, state)
 
             if "IN_PROGRESS" in state or "PENDING" in state:
-                still_checking = True
+                if not waiter.wait():
+                    raise DeployException("Timeout waiting for stack '{}' ChangeSet to be created, "
+                                          "last status was '{}'".format(stack_name, state))
             elif "FAILED" in state or "UPDATE_ROLLBACK_COMPLETE" == state:
                 raise DeployException("Stack '{}' ChangeSet failed, "
-                                      "last status was '{}' - {}".format(stack_name, state, stack["StatusReason"]))
+                                      "last status was '{}' - {}".format(stack_name, state, change_set["StatusReason"]))
             else:
-                still_checking = False
+                return change_set
 
-            if still_checking:
-                if loop_count+1 > max_loops:
-                    raise DeployException("Timeout waiting for stack '{}' to complete modification, "
-                                          "last status was '{}'".format(stack_name, state))
-                loop_count += 1
+    def stack_summaries(self, timeout=60):
+        """
+        Yields a summary of every stack that hasn't been deleted, fetching them a page of list_stacks at a time.
+        """
 
-                time.sleep(loop_timeout)
+        for page in self._pages(self.cf_client.list_stacks, timeout, StackStatusFilter=LIVE_STACK_STATUSES):
+            for summary in page.get('StackSummaries', []):
+                yield summary
 
-    def wait_for_deploy_to_complete(self, stack_name, show_outputs=True, loop_timeout=15, max_loops=300):
+    def all_stacks(self, timeout=60):
+        """
+        Yields the details and outputs of every stack, fetching them a page of describe_stacks at a time.
+        """
 
-        still_checking = True
+        for page in self._pages(self.cf_client.describe_stacks, timeout):
+            for stack in page.get('Stacks', []):
+                yield stack
 
-        loop_count = 1
+    def _pages(self, function, timeout, **kwargs):
+        while True:
+            # Each page gets its own budget, the caller may take a while with the page before it
+            page = Waiter(timeout=timeout).call(function, **kwargs)
+            yield page
 
-        stack = None
-        while still_checking:
+            if not page.get('NextToken'):
+                return
+            kwargs['NextToken'] = page['NextToken']
 
-            stack = self.cf_client.describe_stacks(StackName=stack_name)['Stacks'][0]
-            state = stack['StackStatus']
+    def wait_for_deploy_to_complete(self, stack_name, show_outputs=True, client_request_token=None, since=None,
+                                    timeout=4500, min_delay=2, max_delay=30, label=None):
+        """
+        Streams the stack's events as they happen until the stack reaches a stable state.
 
-            print "({}/{}) - {} is {}".format(loop_count, max_loops, stack_name, state)
-            if "IN_PROGRESS" in state:
-                still_checking = True
-            elif "FAILED" in state or "UPDATE_ROLLBACK_COMPLETE" == state:
-                raise DeployException("Stack '{}' modification failed, "
+        Polling starts quickly so short updates are reported promptly, then slows down for long running ones.
+        Printed lines start with the label when one is given.
+        """
+
+        tracker = StackEventTracker(self.cf_client, stack_name,
+                                    client_request_token=client_request_token, since=since, label=label)
+
+        waiter = Waiter(timeout=timeout, min_delay=min_delay, max_delay=max_delay)
+
+        while True:
+            for event in waiter.call(tracker.poll):
+                tracker.report(event)
+
+            state = tracker.stack_status
+            if state is not None and "IN_PROGRESS" not in state:
+                if "FAILED" in state or "ROLLBACK_COMPLETE" in state:
+                    raise DeployException("Stack '{}' modification failed, "
+                                          "last status was '{}'".format(stack_name, state))
+                break
+
+            if not waiter.wait():
+                raise DeployException("Timeout waiting for stack '{}' to complete modification, "
                                       "last status was '{}'".format(stack_name, state))
+
+        if show_outputs:
+            print_stack_outputs(waiter.call(self.cf_client.describe_stacks, StackName=stack_name)['Stacks'][0],
+                                label=label)
+
+def print_stack_outputs(stack, label=None):
+    if output.structured():
+        output.event('stack_outputs', stack=stack.get('StackName'),
+                     outputs=dict((entry['OutputKey'], entry['OutputValue']) for entry in stack.get('Outputs', [])))
+        return
+
+    if 'Outputs' in stack:
+        lines = ["", "Stack Outputs", "-------------"]
+        lines += ["  {}: {}".format(entry['OutputKey'], entry['OutputValue']) for entry in stack['Outputs']]
+        print output.labelled("\n".join(lines + ["", ""]), label)
+
+class StackEventTracker(object):
+    """
+    Follows the events of a single stack operation.
+
+    Each poll only pages back through describe_stack_events as far as the last event already seen, so the
+    cost of a poll depends on how much has happened since the previous one rather than on the stack's history.
+    Events are limited to the operation started with client_request_token when it is given, and printed events
+    start with the label when one is given.
+    """
+
+    # Allows for clock differences between us and CloudFormation when deciding how far back to page
+    CLOCK_SKEW = timedelta(minutes=5)
+
+    def __init__(self, cf_client, stack_name, client_request_token=None, since=None, label=None):
+        self.cf_client = cf_client
+        self.stack_name = stack_name
+        self.client_request_token = client_request_token
+        self.label = label
+
+        if since is None:
+            since = datetime.now(tzutc())
+        # Without a token to filter on, the start time is the only way of telling which events are ours
+        self.since = since - self.CLOCK_SKEW if client_request_token else since
+
+        self.last_event_id = None
+        self.stack_status = None
+
+    def poll(self):
+        """
+        Returns the events since the previous poll, oldest first.
+        """
+
+        new_events = []
+        next_token = None
+
+        while True:
+            if next_token:
+                response = self.cf_client.describe_stack_events(StackName=self.stack_name, NextToken=next_token)
             else:
-                still_checking = False
+                response = self.cf_client.describe_stack_events(StackName=self.stack_name)
 
-            if still_checking:
-                if loop_count+1 > max_loops:
-                    raise DeployException("Timeout waiting for stack '{}' to complete modification, "
-                                          "last status was '{}'".format(stack_name, state))
-                loop_count += 1
-
-                time.sleep(loop_timeout)
-
-        if show_outputs and 'Outputs' in stack:
-            print ""
-            print "Stack Outputs"
-            print "-------------"
-            for output in stack['Outputs']:
-                print "  {}: {}".format(output['OutputKey'], output['OutputValue'])
-            print ""
-            print ""
+            reached_seen = False
+            for event in response['StackEvents']:
+                if event['EventId'] == self.last_event_id or event['Timestamp'] < self.since:
+                    reached_seen = True
+                    break
+                new_events += [event]
+
+            next_token = response.get('NextToken')
+            if reached_seen or not next_token:
+                break
+
+        if len(new_events) > 0:
+            self.last_event_id = new_events[0]['EventId']
+
+        new_events.reverse()
+
+        if self.client_request_token:
+            new_events = [event for event in new_events
+                          if event.get('ClientRequestToken') == self.client_request_token]
+
+        for event in new_events:
+            if self.is_stack_event(event):
+                self.stack_status = event['ResourceStatus']
+
+        return new_events
+
+    def is_stack_event(self, event):
+        # Events about the stack itself (rather than its resources) have the stack as their physical resource
+        return event.get('PhysicalResourceId') == event['StackId']
+
+    def report(self, event):
+        output.report(self.format_event(event), 'stack_event',
+                      stack=self.stack_name,
+                      resource=event['LogicalResourceId'],
+                      resource_type=event['ResourceType'],
+                      status=event['ResourceStatus'],
+                      reason=event.get('ResourceStatusReason'),
+                      timestamp=event['Timestamp'])
+
+    def format_event(self, event):
+        line = "{} {} {} ({})".format(event['Timestamp'].strftime("%H:%M:%S"),
+                                      event['ResourceStatus'].ljust(30),
+                                      event['LogicalResourceId'],
+                                      event['ResourceType'])
+        if event.get('ResourceStatusReason'):
+            line += " - {}".format(event['ResourceStatusReason'])
+        return output.labelled(line, self.label)
+
+class KMSSecretResolver(object):
+    """
+    Decrypts the KMSEncrypted values in a set of config parameters.
+
+    All ciphertexts are collected up front and the distinct ones are decrypted concurrently. Plaintexts are
+    remembered for the life of the process, so stacks that share secrets only decrypt them once. They are kept per
+    KMS client, so a plaintext is only handed to callers whose credentials decrypted it.
+    """
+
+    REGEX_ENCRYPTED = re.compile('KMSEncrypted(.*)/KMSEncrypted')
+
+    # How many plaintexts are remembered
+    MAX_PLAINTEXTS = 1024
+
+    _plaintexts = LRUCache(max_entries=MAX_PLAINTEXTS)
+    _lock = threading.Lock()
+
+    def __init__(self, kms_client, max_workers=8):
+        self.kms_client = kms_client
+        self.max_workers = max_workers
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._plaintexts.clear()
+
+    def resolve(self, config_params):
+        """
+        Returns a copy of the parameters with encrypted values replaced by their plaintext, and the list of
+        plaintexts so they can be hidden from any output.
+        """
+
+        ciphertexts = dict()
+        for key, value in config_params.items():
+            if not isinstance(value, basestring):
+                continue
+            # Check if the value contains KMS encrypted value (KMSEncrypted /KMSEncrypted tag pair)
+            encryption_check = self.REGEX_ENCRYPTED.search(value)
+            if encryption_check:
+                ciphertexts[key] = encryption_check.group(1)
+
+        plaintexts = dict()
+        with self._lock:
+            for ciphertext in set(ciphertexts.values()):
+                entry = self._plaintexts.get(self._key(ciphertext))
+                if entry is not None:
+                    plaintexts[ciphertext] = entry[1]
+        pending = sorted(set(ciphertexts.values()) - set(plaintexts))
+
+        if len(pending) == 1:
+            plaintexts[pending[0]] = self._decrypt(pending[0])
+        elif len(pending) > 1:
+            pool = ThreadPool(processes=min(self.max_workers, len(pending)))
+            try:
+                plaintexts.update(zip(pending, pool.map(self._decrypt, pending)))
+            finally:
+                pool.close()
+                pool.join()
+
+        resolved = dict(config_params)
+        secrets = []
+        for key, ciphertext in ciphertexts.items():
+            resolved[key] = plaintexts[ciphertext]
+            secrets += [resolved[key]]
+
+        return resolved, secrets
+
+    def _decrypt(self, ciphertext):
+        plaintext = self.kms_client.decrypt(CiphertextBlob=base64.b64decode(ciphertext))["Plaintext"]
+        # Mask the plaintext in everything printed from now on, not just the parameters
+        REDACTOR.add([plaintext])
+        with self._lock:
+            # The entry holds on to its client, so the client's id can't be reused while the entry is kept
+            self._plaintexts[self._key(ciphertext)] = (self.kms_client, plaintext)
+        return plaintext
+
+    def _key(self, ciphertext):
+        return id(self.kms_client), ciphertext
+
+class AMIResolver(object):
+    """
+    Finds AMIs by their ArtifactID tag or image id, remembering what it found for ttl seconds.
+
+    Tag searches can be limited to images from the given owners, so EC2 doesn't have to search every image visible
+    to the account, and any number of tags are searched for with a single paginated describe_images call.
+    """
+
+    ARTIFACT_TAG = 'ArtifactID'
+
+    # EC2 limits how many values a single filter can have
+    MAX_FILTER_VALUES = 200
+
+    # How many lookups each resolver remembers
+    MAX_LOOKUPS = 4096
+
+    _resolvers = LRUCache(max_entries=64)
+    _resolvers_lock = threading.Lock()
+
+    def __init__(self, ec2_client, owners=None, ttl=300, lookup_timeout=60):
+        self.ec2_client = ec2_client
+        # No owners searches every image the account can see, including those shared with it
+        self.owners = owners
+        self.ttl = ttl
+        self.lookup_timeout = lookup_timeout
+
+        self._index = LRUCache(max_entries=self.MAX_LOOKUPS)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, ec2_client, owners=None, lookup_timeout=60):
+        """
+        Returns the resolver for this client and owners, so everything searching with them shares its lookups.
+        """
+
+        # Each resolver holds on to its client, so the client's id can't be reused while the resolver is kept
+        key = (id(ec2_client), tuple(owners or ()), lookup_timeout)
+        with cls._resolvers_lock:
+            resolver = cls._resolvers.get(key)
+            if resolver is None:
+                resolver = cls(ec2_client, owners=owners, lookup_timeout=lookup_timeout)
+                cls._resolvers[key] = resolver
+            return resolver
+
+    @classmethod
+    def clear(cls):
+        with cls._resolvers_lock:
+            cls._resolvers.clear()
+
+    def find_by_artifact_ids(self, artifact_ids):
+        """
+        Returns a dict of each artifact id to the images tagged with it.
+        """
+
+        def search(missing):
+            filters = [{'Name': 'tag:' + self.ARTIFACT_TAG, 'Values': missing}]
+            if self.owners:
+                return self._describe_images(Owners=self.owners, Filters=filters)
+            return self._describe_images(Filters=filters)
+
+        def matches(image):
+            return [tag['Value'] for tag in image.get('Tags', []) if tag['Key'] == self.ARTIFACT_TAG]
+
+        return self._find('tag', artifact_ids, search, matches)
+
+    def find_by_image_ids(self, image_ids):
+        """
+        Returns a dict of each image id to the images found for it.
+        """
+
+        def search(missing):
+            if len(missing) == 1:
+                return self._describe_images(ImageIds=missing)
+            # Unlike ImageIds, a filter doesn't fail the whole call when one of the images doesn't exist
+            return self._describe_images(Filters=[{'Name': 'image-id', 'Values': missing}])
+
+        def matches(image):
+            return [image['ImageId']]
+
+        return self._find('id', image_ids, search, matches)
+
+    def find_one_by_artifact_id(self, artifact_id):
+        return self._single(artifact_id, self.find_by_artifact_ids([artifact_id])[artifact_id])
+
+    def find_one_by_image_id(self, image_id):
+        return self._single(image_id, self.find_by_image_ids([image_id])[image_id])
+
+    def _find(self, kind, values, search, matches):
+        now = time.time()
+        results = dict()
+
+        with self._lock:
+            for value in values:
+                entry = self._index.get((kind, value))
+                if entry is not None and entry[0] > now:
+                    results[value] = entry[1]
+
+        missing = sorted(set(value for value in values if value not in results))
+        for start in range(0, len(missing), self.MAX_FILTER_VALUES):
+            batch = missing[start:start + self.MAX_FILTER_VALUES]
+            found = dict((value, []) for value in batch)
+
+            for image in search(batch):
+                # EC2 already matched the image, so with a single value there is nothing to sort out
+                for value in (batch if len(batch) == 1 else matches(image)):
+                    if value in found:
+                        found[value] += [image]
+
+            with self._lock:
+                for value, images in found.items():
+                    # Don't remember misses, the image may well be about to be created
+                    if len(images) > 0:
+                        self._index[(kind, value)] = (now + self.ttl, images)
+
+            results.update(found)
+
+        return results
+
+    def _describe_images(self, **kwargs):
+        waiter = Waiter(timeout=self.lookup_timeout)
+        images = []
+
+        while True:
+            response = waiter.call(self.ec2_client.describe_images, **kwargs)
+            images += response['Images']
+
+            if not response.get('NextToken'):
+                return images
+            kwargs['NextToken'] = response['NextToken']
+
+    def _single(self, search_val, images):
+        if len(images) == 0:
+            raise DeployException("No images found for search '{}'".format(search_val))
+        elif len(images) > 1:
+            print images
+            raise DeployException("More than 1 image found for search '{}'".format(search_val))
+        return images[0]
+
+class StackOutputIndex(object):
+    """
+    Resolves config parameters that refer to another stack's outputs, written as StackOutput:stack-name.OutputKey.
+
+    Each referenced stack is described once however many parameters refer to it, and its outputs are remembered
+    for the life of the process, so every stack deployed with the same client shares the lookups. A stack that is
+    deployed here is forgotten, so later references see its new outputs.
+    """
+
+    REGEX_REFERENCE = re.compile('^StackOutput:([A-Za-z][-A-Za-z0-9]*)\.([A-Za-z0-9]+)$')
+
+    # How many stacks' outputs each index remembers
+    MAX_STACKS = 1024
+
+    _indexes = LRUCache(max_entries=64)
+    _indexes_lock = threading.Lock()
+
+    def __init__(self, cf_client, lookup_timeout=60, max_workers=8):
+        self.cf_client = cf_client
+        self.lookup_timeout = lookup_timeout
+        self.max_workers = max_workers
+
+        self._outputs = LRUCache(max_entries=self.MAX_STACKS)
+        self._fetching = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, cf_client, lookup_timeout=60):
+        """
+        Returns the index for this client, so everything deploying with it shares its lookups.
+        """
+
+        # Each index holds on to its client, so the client's id can't be reused while the index is kept
+        key = id(cf_client)
+        with cls._indexes_lock:
+            index = cls._indexes.get(key)
+            if index is None:
+                index = cls(cf_client, lookup_timeout=lookup_timeout)
+                cls._indexes[key] = index
+            return index
+
+    @classmethod
+    def clear(cls):
+        with cls._indexes_lock:
+            cls._indexes.clear()
+
+    @classmethod
+    def references(cls, config_params, keys=None):
+        """
+        Returns a dict of each parameter that refers to a stack output to its (stack name, output key), looking only
+        at the given keys if there are any.
+        """
+
+        references = dict()
+        for key, value in config_params.items():
+            if keys is not None and key not in keys:
+                continue
+            if not isinstance(value, basestring):
+                continue
+            reference = cls.REGEX_REFERENCE.match(value)
+            if reference:
+                references[key] = reference.groups()
+        return references
+
+    def resolve(self, config_params, keys=None):
+        """
+        Returns a copy of the parameters with stack output references replaced by the outputs' values. Only the
+        given keys are resolved if there are any, so references the template doesn't use cost nothing.
+        """
+
+        references = self.references(config_params, keys)
+
+        stack_names = sorted(set(stack_name for stack_name, _ in references.values()))
+        if len(stack_names) > 1:
+            pool = ThreadPool(processes=min(self.max_workers, len(stack_names)))
+            try:
+                outputs = dict(zip(stack_names, pool.map(self.outputs, stack_names)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            outputs = dict((stack_name, self.outputs(stack_name)) for stack_name in stack_names)
+
+        resolved = dict(config_params)
+        for key, (stack_name, output_key) in references.items():
+            if output_key not in outputs[stack_name]:
+                raise DeployException("Stack '{}' has no output '{}' for parameter {}"
+                                      .format(stack_name, output_key, key))
+            resolved[key] = outputs[stack_name][output_key]
+
+        return resolved
+
+    def outputs(self, stack_name):
+        """
+        Returns a dict of the stack's output keys to their values, describing the stack only if no one has yet.
+        """
+
+        with self._lock:
+            if stack_name in self._outputs:
+                return self._outputs.get(stack_name)
+            # Anyone else after the same stack waits for the one describe_stacks call rather than making their own
+            fetching = self._fetching.setdefault(stack_name, threading.Lock())
+
+        with fetching:
+            try:
+                with self._lock:
+                    if stack_name in self._outputs:
+                        return self._outputs.get(stack_name)
+
+                outputs = self._describe(stack_name)
+
+                with self._lock:
+                    self._outputs[stack_name] = outputs
+                return outputs
+            finally:
+                # Even when the describe failed, so the lock isn't kept for a stack that is never fetched
+                with self._lock:
+                    if self._fetching.get(stack_name) is fetching:
+                        del self._fetching[stack_name]
+
+    def forget(self, stack_name):
+        with self._lock:
+            if stack_name in self._outputs:
+                del self._outputs[stack_name]
+
+    def _describe(self, stack_name):
+        try:
+            stack = Waiter(timeout=self.lookup_timeout).call(self.cf_client.describe_stacks,
+                                                             StackName=stack_name)['Stacks'][0]
+        except botocore.exceptions.ClientError as error:
+            if "does not exist" in str(error):
+                raise DeployException("Cannot find stack '{}' to read its outputs".format(stack_name))
+            raise
+
+        return dict((entry['OutputKey'], entry['OutputValue']) for entry in stack.get('Outputs', []))
+
+class TemplateStager(object):
+    """
+    Uploads templates to S3 so they can be passed to CloudFormation by URL.
+
+    Templates are stored under the hash of their content, so a template that has been uploaded before
+    (by this process or any other) is never uploaded again.
+    """
+
+    MAX_TEMPLATE_BODY_SIZE = 51200
+
+    # Keys known to already be in S3, so repeat deploys within a process don't even need to check
+    _staged = set()
+    # Region of each bucket, which need not be the region being deployed to
+    _regions = {}
+    _lock = threading.Lock()
+
+    def __init__(self, s3_client, bucket, prefix="stacker/templates"):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def key(self, cloudformation):
+        return "{}/{}.template".format(self.prefix, hashlib.sha256(cloudformation).hexdigest())
+
+    def stage(self, cloudformation):
+        key = self.key(cloudformation)
+
+        with self._lock:
+            staged = (self.bucket, key) in self._staged
+
+        if not staged:
+            if not self.exists(key):
+                self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=cloudformation)
+            with self._lock:
+                self._staged.add((self.bucket, key))
+
+        return self.url(key)
+
+    def exists(self, key):
+        try:
+            self.s3_client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except botocore.exceptions.ClientError as error:
+            if error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def region(self):
+        with self._lock:
+            if self.bucket in self._regions:
+                return self._regions[self.bucket]
+
+        # Buckets in us-east-1 have no location constraint, and old buckets in eu-west-1 have 'EU'
+        location = self.s3_client.get_bucket_location(Bucket=self.bucket).get('LocationConstraint')
+        region = {None: 'us-east-1', '': 'us-east-1', 'EU': 'eu-west-1'}.get(location, location)
+        with self._lock:
+            self._regions[self.bucket] = region
+        return region
+
+    def url(self, key):
+        region = self.region()
+        if region == 'us-east-1':
+            return "https://{}.s3.amazonaws.com/{}".format(self.bucket, key)
+        return "https://{}.s3.{}.amazonaws.com/{}".format(self.bucket, region, key)
+
+class Waiter(object):
+    """
+    Paces a polling loop against an overall deadline rather than a fixed number of loops.
+
+    The delay between polls grows exponentially from min_delay up to max_delay, with some jitter so that
+    many deploys running at once don't all poll in lock step. AWS throttling errors double the delay and
+    are retried for as long as the deadline allows.
+    """
+
+    def __init__(self, timeout, min_delay=1, max_delay=30, multiplier=1.5, jitter=0.2):
+        self.started = time.time()
+        self.deadline = self.started + timeout
+        self.delay = min_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def elapsed(self):
+        return int(time.time() - self.started)
+
+    def wait(self):
+        """
+        Sleeps until the next poll is due, returning False instead if that would be past the deadline.
+        """
+
+        delay = self.next_delay()
+        if delay is None:
+            return False
+
+        output.flush()
+        time.sleep(delay)
+        return True
+
+    def next_delay(self):
+        """
+        Returns how long to wait before the next poll, or None if that would be past the deadline.
+        """
+
+        delay = self.delay * (1 - self.jitter * random.random())
+        if time.time() + delay > self.deadline:
+            return None
+
+        self.delay = min(self.max_delay, self.delay * self.multiplier)
+        return delay
+
+    def backoff(self):
+        """
+        Returns how long to wait before retrying a throttled call, or None if that would be past the deadline.
+        """
+
+        self.delay = min(self.max_delay, self.delay * 2)
+        return self.next_delay()
+
+    def call(self, function, *args, **kwargs):
+        """
+        Calls an AWS API function, retrying it if we are throttled.
+        """
+
+        while True:
+            try:
+                return function(*args, **kwargs)
+            except botocore.exceptions.ClientError as error:
+                if not is_throttling_error(error):
+                    raise
+                delay = self.backoff()
+                if delay is None:
+                    raise
+                time.sleep(delay)
+
+THROTTLING_CODES = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException')
+
+def is_throttling_error(error):
+    return error.response.get('Error', {}).get('Code') in THROTTLING_CODES
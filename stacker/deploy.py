@@ -1,124 +1,117 @@
 __author__ = "Steve Mactaggart && Elliott Gorrell"
 
-import base64
+import functools
+import hashlib
 import json
 import re
 import sys
+import time
 import traceback
+import uuid
+from contextlib import contextmanager
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
-import boto3
 import botocore
-import yaml
 
-from cf_helper import secure_print
-from cf_helper.utils import DeployException, CloudFormationUtil, STSUtil
+from cf_helper import output, secure_print
+from cf_helper.engine import AsyncCloudFormationUtil, BlockingCloudFormationUtil, Call, Engine, Return
+from cf_helper.templates import Template, load_yaml, serialize
+from cf_helper.timings import span
+from cf_helper.utils import DeployException, AMIResolver, CloudFormationUtil, CredentialProvider, \
+    KMSSecretResolver, StackOutputIndex, TemplateStager
+
+class Deployment(object):
+    """
+    The config and template for a deployment, loaded and resolved ready to be sent to CloudFormation.
+    """
+
+    def __init__(self, config_params, secrets, version, cloudformation, raw_cloudformation, encrypted=None):
+        self.config_params = config_params
+        self.secrets = secrets
+        # The KMS encrypted parameters as they were written, which stand in for their plaintexts in the fingerprint
+        self.encrypted = encrypted or {}
+        self.version = version
+        self.cloudformation = cloudformation
+        self.raw_cloudformation = raw_cloudformation
 
 class DeployExecutor(object):
     REGEX_YAML = re.compile('.+\.yaml|.+.yml')
     REGEX_JSON = re.compile('.+\.json')
 
+    # Outputs aren't copied onto resources the way stack tags are, so the fingerprint is kept in one
+    FINGERPRINT_OUTPUT = 'StackerFingerprint'
+    STABLE_STATUSES = ['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'IMPORT_COMPLETE']
+
+    # Kept change sets are named from this and their fingerprint, so a later run can find the one it needs
+    KEPT_CHANGE_SET_PREFIX = 'Stacker-'
+
     cf_client = None
     ec2_client = None
     kms_client = None
+    s3_client = None
+    ami_resolver = None
 
     role = None
 
-    def execute(self, stack_name, template_name, config_filename=None,
-                role=None, add_parameters=None, version=None, ami_id=None, ami_tag_value=None,
-                scope=None, create=False, delete=False, dry_run=False,
-                debug=False):
+    # Connections each AWS client keeps open, or None for CredentialProvider's default
+    max_pool_connections = None
 
-        self.role = role
+    # The region to connect to, or None for the environment's default region
+    region = None
 
-        try:
-            config_params = dict()
+    # Accounts whose AMIs can be found by tag, see AMIResolver
+    ami_owners = None
 
-            if config_filename is not None:
-                if debug:
-                    print "Resolving config file {} using scope {}".format(config_filename, scope)
-
-                config_params = self.load_parameters(config_filename, scope)
+    # S3 bucket that templates too large to send inline are uploaded to
+    template_bucket = None
 
-            # First override any of the defaults with those supplied at the command line
-            if add_parameters is None or len(add_parameters) == 0:
-                adds = {}
-            else:
-                adds = dict(item.split("=") for item in add_parameters)
-                config_params.update(adds)
-
-            self.create_boto_clients()
+    # Set to a TemplateCache to reuse parsed templates between runs
+    template_cache = None
 
-            if version:
-                config_params["VersionParam"] = version
-            else:
-                version = datetime.now().isoformat('-').replace(":", "-")
-
-            if ami_id:
-                config_params["AMIParam"] = ami_id
-            elif ami_tag_value:
-                config_params["AMIParam"] = self.get_ami_id_by_tag(ami_tag_value)
-
-
-            secrets = []
-            for key in config_params:
-                # Check that config file doesn't have scopes (Parameters for more than one Cloudformation file)
-                if type(config_params[key]) is dict:
-                    raise DeployException("Objects were found with nested values, you will need to specify which set of parameters to use with \"--scope <object_name>\"".format(key))
-
-                # Check if the value contains KMS encrypted value (KMSEncrypted /KMSEncrypted tag pair)
-                # if true, decrypt and replace the value
-                encryption_check = re.search('KMSEncrypted(.*)/KMSEncrypted', config_params[key])
-
-                if encryption_check:
-                    decrypted_value = self.kms_client.decrypt(CiphertextBlob=base64.b64decode(encryption_check.group(1)))["Plaintext"]
-                    config_params[key] = decrypted_value
-                    secrets += [decrypted_value]
-
-            cloudformation = self.load_cloudformation(template_name)
-            raw_cloudformation = str(cloudformation)
-
-            # Go through parameters needed and fill them in from the parameters provided in the config file
-            # They need to be re-formated from the python dictionary into boto3 useable format
-            parameters = self.import_params_from_config(cloudformation, config_params, create, secrets)
-
-            print "Using stack parameters"
-            # This hides any encrypted values that were decrypted with KMS
-            print secure_print(json.dumps(parameters, indent=2), secrets)
-
-            if create:
-                change_set_name = "Create-{}".format(version.replace(".", "-"))
-                changeset = self.get_change_set(stack_name, raw_cloudformation, parameters, change_set_name, create)
-
-            elif delete:
-                if not dry_run:
-                    result = self.cf_client.delete_stack(StackName=stack_name)
-                    print result
-                else:
-                    print "[Dry-Run] Not deleting stack."
-            else:
-                change_set_name = "Update-{}".format(version.replace(".", "-"))
-                changeset = self.get_change_set(stack_name, raw_cloudformation, parameters, change_set_name)
+    # Set to a Timings to record how long each phase of a deployment takes
+    timings = None
 
-            if changeset is not None:
-                self.cf_client.wait_for_change_set_to_complete(change_set_name=change_set_name,
-                                                                    stack_name=stack_name,
-                                                                    debug=False)
+    # Keep dry run change sets, and execute a matching kept change set rather than creating a new one. Only the
+    # newest change_set_retention kept change sets of each stack are left in place.
+    keep_change_sets = False
+    change_set_retention = 5
 
-                change_set_details = self.cf_client.describe_change_set(ChangeSetName=change_set_name,
-                                                                   StackName=stack_name)
+    # How changes are printed: text for people, or json for a change event per change as with --output json
+    change_set_format = 'text'
 
-                self.print_change_set(change_set_details)
+    # Set when other deployments print at the same time, so text lines say which stack and region they're from
+    concurrent = False
 
-                if dry_run:
-                    response = self.cf_client.delete_change_set(ChangeSetName=change_set_name,
-                                                           StackName=stack_name)
-                else:
-                    response = self.cf_client.execute_change_set(ChangeSetName=change_set_name,
-                                                            StackName=stack_name)
+    # Budgets, in seconds, for the AWS side of the deployment
+    change_set_timeout = 600
+    stack_timeout = 4500
+    lookup_timeout = 60
 
-                    self.cf_client.wait_for_deploy_to_complete(stack_name=stack_name)
+    def execute(self, stack_name, template_name, config_filename=None,
+                role=None, add_parameters=None, version=None, ami_id=None, ami_tag_value=None,
+                scope=None, create=False, delete=False, dry_run=False,
+                debug=False, force=False, regions=None):
 
+        try:
+            deploy = self.deploy
+            if regions:
+                deploy = functools.partial(self.deploy_regions, regions)
+
+            deploy(stack_name=stack_name,
+                   template_name=template_name,
+                   config_filename=config_filename,
+                   role=role,
+                   add_parameters=add_parameters,
+                   version=version,
+                   ami_id=ami_id,
+                   ami_tag_value=ami_tag_value,
+                   scope=scope,
+                   create=create,
+                   delete=delete,
+                   dry_run=dry_run,
+                   debug=debug,
+                   force=force)
 
         except botocore.exceptions.ClientError as e:
             if str(e) == "An error occurred (ValidationError) when calling the UpdateStack operation: No updates are to be performed.":
@@ -136,6 +129,363 @@ class DeployExecutor(object):
             traceback.print_exc(file=sys.stdout)
             sys.exit(1)
 
+    def deploy(self, stack_name, template_name, config_filename=None,
+               role=None, add_parameters=None, version=None, ami_id=None, ami_tag_value=None,
+               scope=None, create=False, delete=False, dry_run=False,
+               debug=False, force=False):
+        """
+        Runs a single stack deployment, raising any errors back to the caller rather than exiting.
+        """
+
+        if role is not None:
+            self.role = role
+
+        self.create_boto_clients()
+
+        deployment = self.prepare(template_name, config_filename, add_parameters, version, scope, debug)
+
+        self.deploy_prepared(stack_name, deployment, ami_id=ami_id, ami_tag_value=ami_tag_value,
+                             create=create, delete=delete, dry_run=dry_run, force=force)
+
+    def deploy_regions(self, regions, stack_name, template_name, config_filename=None,
+                       role=None, add_parameters=None, version=None, ami_id=None, ami_tag_value=None,
+                       scope=None, create=False, delete=False, dry_run=False,
+                       debug=False, force=False):
+        """
+        Deploys the same stack to several regions at once.
+
+        The config and template are loaded (and any secrets decrypted) once, then each region runs the rest of
+        the deployment concurrently with its own clients.
+        """
+
+        if role is not None:
+            self.role = role
+
+        deployment = self.prepare(template_name, config_filename, add_parameters, version, scope, debug)
+
+        def deploy_region(region):
+            executor = self.for_region(region)
+            executor.concurrent = len(regions) > 1
+            start = time.time()
+            result = {'region': region, 'status': "COMPLETE", 'error': None}
+
+            try:
+                executor.create_boto_clients()
+                executor.deploy_prepared(stack_name, deployment, ami_id=ami_id, ami_tag_value=ami_tag_value,
+                                         create=create, delete=delete, dry_run=dry_run, force=force)
+            except Exception as error:
+                if debug:
+                    traceback.print_exc()
+                print "ERROR: Region {} failed: {}".format(region, error)
+                result['status'] = "FAILED"
+                result['error'] = str(error)
+
+            result['duration'] = time.time() - start
+            return result
+
+        pool = ThreadPool(processes=len(regions))
+        try:
+            results = pool.map(deploy_region, regions)
+        finally:
+            pool.close()
+            pool.join()
+
+        if output.structured():
+            for result in results:
+                output.event('result', stack=stack_name, region=result['region'], status=result['status'],
+                             seconds=round(result['duration'], 3), error=result['error'])
+        else:
+            print ""
+            print "Region summary for {}".format(stack_name)
+            print "-------------------" + "-" * len(stack_name)
+            for result in results:
+                print "  {} {} ({:.1f}s)".format(result['status'].ljust(9), result['region'], result['duration'])
+                if result['error'] is not None:
+                    print "            {}".format(result['error'])
+            print ""
+
+        failed = [result['region'] for result in results if result['status'] != "COMPLETE"]
+        if len(failed) > 0:
+            raise DeployException("{} of {} regions were not deployed: {}".format(len(failed), len(regions),
+                                                                                  ", ".join(failed)))
+
+        return results
+
+    def for_region(self, region):
+        """
+        Returns a new executor with the same settings as this one, that connects to the given region.
+        """
+
+        executor = DeployExecutor()
+        executor.region = region
+        executor.role = self.role
+        executor.ami_owners = self.ami_owners
+        executor.template_bucket = self.template_bucket
+        executor.keep_change_sets = self.keep_change_sets
+        executor.change_set_retention = self.change_set_retention
+        executor.change_set_format = self.change_set_format
+        executor.change_set_timeout = self.change_set_timeout
+        executor.stack_timeout = self.stack_timeout
+        executor.lookup_timeout = self.lookup_timeout
+        return executor
+
+    def prepare(self, template_name, config_filename=None, add_parameters=None, version=None, scope=None,
+                debug=False):
+        """
+        Does the part of a deployment that is the same whichever stack or region it goes to.
+        """
+
+        config_params = dict()
+
+        if config_filename is not None:
+            if debug:
+                print "Resolving config file {} using scope {}".format(config_filename, scope)
+
+            with self.span('load_config', template=template_name):
+                config_params = self.load_parameters(config_filename, scope)
+
+        # First override any of the defaults with those supplied at the command line
+        if add_parameters is None or len(add_parameters) == 0:
+            adds = {}
+        else:
+            adds = dict(item.split("=") for item in add_parameters)
+            config_params.update(adds)
+
+        if version:
+            config_params["VersionParam"] = version
+        else:
+            version = datetime.now().isoformat('-').replace(":", "-")
+
+        for key in config_params:
+            # Check that config file doesn't have scopes (Parameters for more than one Cloudformation file)
+            if type(config_params[key]) is dict:
+                raise DeployException("Objects were found with nested values, you will need to specify which set of parameters to use with \"--scope <object_name>\"".format(key))
+
+        encrypted = dict((key, value) for key, value in config_params.items()
+                         if isinstance(value, basestring) and KMSSecretResolver.REGEX_ENCRYPTED.search(value))
+
+        # Decrypt any KMS encrypted values, keeping the plaintexts so they can be hidden in the output
+        with self.span('kms_decrypt', template=template_name):
+            if self.kms_client is None:
+                self.kms_client = self._boto_connect('kms')
+            config_params, secrets = KMSSecretResolver(self.kms_client).resolve(config_params)
+
+        with self.span('load_template', template=template_name):
+            template = self.load_template(template_name)
+
+        return Deployment(config_params=config_params,
+                          secrets=secrets,
+                          version=version,
+                          cloudformation=template.data,
+                          raw_cloudformation=template.body,
+                          encrypted=encrypted)
+
+    def deploy_prepared(self, stack_name, deployment, ami_id=None, ami_tag_value=None,
+                        create=False, delete=False, dry_run=False, force=False):
+        """
+        Deploys a prepared template and config to a stack using this executor's clients.
+        """
+
+        return Engine(max_concurrency=1).run_until_complete(
+            self.deploy_coroutine(stack_name, deployment, ami_id=ami_id, ami_tag_value=ami_tag_value,
+                                  create=create, delete=delete, dry_run=dry_run, force=force))
+
+    def coroutine_client(self):
+        """
+        The CloudFormation client as the coroutines below use it, where every method returns something to yield.
+        """
+
+        return BlockingCloudFormationUtil(self.cf_client)
+
+    def deploy_coroutine(self, stack_name, deployment, ami_id=None, ami_tag_value=None,
+                         create=False, delete=False, dry_run=False, force=False):
+        """
+        Deploys a prepared template and config to a stack as a coroutine, so that one Engine can drive many
+        deployments at the same time.
+        """
+
+        cf_client = self.coroutine_client()
+        config_params = dict(deployment.config_params)
+        secrets = deployment.secrets
+        version = deployment.version
+        cloudformation = deployment.cloudformation
+        raw_cloudformation = deployment.raw_cloudformation
+
+        if ami_id:
+            config_params["AMIParam"] = ami_id
+        elif ami_tag_value:
+            with self.span('ami_lookup', stack=stack_name):
+                config_params["AMIParam"] = yield Call(self.get_ami_id_by_tag, ami_tag_value)
+
+        # Outputs are read in the region being deployed to, so this can't be done once in prepare
+        used = cloudformation.get('Parameters', {})
+        if StackOutputIndex.references(config_params, used):
+            with self.span('stack_output_lookup', stack=stack_name):
+                config_params = yield Call(self.stack_output_index().resolve, config_params, used)
+
+        # Go through parameters needed and fill them in from the parameters provided in the config file
+        # They need to be re-formated from the python dictionary into boto3 useable format
+        parameters = self.import_params_from_config(cloudformation, config_params, create, secrets)
+
+        # This hides any encrypted values that were decrypted with KMS
+        print self.labelled(stack_name, "Using stack parameters\n" +
+                            secure_print(json.dumps(parameters, indent=2), secrets))
+
+        fingerprint = self.fingerprint(raw_cloudformation, parameters, deployment.encrypted)
+
+        if not create and not delete:
+            with self.span('describe_stack', stack=stack_name):
+                stack = yield self.get_stack(stack_name)
+
+            if stack is not None:
+                if not force and self.is_up_to_date(stack, fingerprint):
+                    self.report_stack(stack_name, "UP_TO_DATE",
+                                      "Stack {} is up to date - no changes to deploy".format(stack_name))
+                    return
+
+        if delete:
+            if not dry_run:
+                with self.span('delete_stack', stack=stack_name):
+                    result = yield cf_client.delete_stack(StackName=stack_name)
+                print self.labelled(stack_name, str(result))
+                self.forget_stack_outputs(stack_name)
+                self.report_stack(stack_name, "DELETING")
+            else:
+                print self.labelled(stack_name, "[Dry-Run] Not deleting stack.")
+                self.report_stack(stack_name, "DRY_RUN")
+            return
+
+        change_set_name = self.change_set_name("Create" if create else "Update", version, fingerprint)
+        with self.span('create_change_set', stack=stack_name):
+            yield self.get_change_set(stack_name, self.fingerprinted(cloudformation, fingerprint), parameters,
+                                      change_set_name, create)
+
+        with self.span('wait_change_set', stack=stack_name):
+            # The wait ends on the first page of the completed change set, which is where printing starts
+            first_page = yield cf_client.wait_for_change_set_to_complete(change_set_name=change_set_name,
+                                                                         stack_name=stack_name,
+                                                                         timeout=self.change_set_timeout,
+                                                                         debug=False)
+
+        yield self.print_change_set(stack_name, change_set_name, first_page)
+
+        if dry_run and self.keep_change_sets:
+            print self.labelled(stack_name,
+                                "[Dry-Run] Keeping change set {} for the deploy to execute".format(change_set_name))
+            self.report_stack(stack_name, "DRY_RUN")
+        elif dry_run:
+            yield cf_client.delete_change_set(ChangeSetName=change_set_name, StackName=stack_name)
+            self.report_stack(stack_name, "DRY_RUN")
+        else:
+            # The token is stamped on every event this execution causes, letting us follow just those events
+            token = "stacker-{}".format(uuid.uuid4())
+            with self.span('execute_change_set', stack=stack_name):
+                yield cf_client.execute_change_set(ChangeSetName=change_set_name,
+                                                   StackName=stack_name,
+                                                   ClientRequestToken=token)
+
+            with self.span('wait_stack', stack=stack_name):
+                yield cf_client.wait_for_deploy_to_complete(stack_name=stack_name,
+                                                            client_request_token=token,
+                                                            timeout=self.stack_timeout,
+                                                            label=self.label(stack_name))
+            self.forget_stack_outputs(stack_name)
+            self.report_stack(stack_name, "COMPLETE")
+
+    @contextmanager
+    def span(self, phase, **labels):
+        """
+        Times a phase of the deployment when timings are being recorded, and reports it when the output is JSON.
+        """
+
+        with span(self.timings, phase, region=self.region, **labels), \
+                output.phase(phase, region=self.region, **labels):
+            yield
+
+    def report_stack(self, stack_name, status, text=None):
+        """
+        Prints how the deployment of a stack ended, or reports it as a stack event when the output is JSON.
+        """
+
+        if output.structured():
+            output.event('stack', stack=stack_name, region=self.region, status=status)
+        elif text is not None:
+            print self.labelled(stack_name, text)
+
+    def label(self, stack_name):
+        """
+        What each line printed about the stack starts with, when other deployments are printing at the same time.
+        """
+
+        if not self.concurrent:
+            return None
+        if self.region is None:
+            return stack_name
+        return "{}@{}".format(stack_name, self.region)
+
+    def labelled(self, stack_name, text):
+        return output.labelled(text, self.label(stack_name))
+
+    def change_set_name(self, change_set_type, version, fingerprint):
+        if self.keep_change_sets:
+            return "{}{}-{}".format(self.KEPT_CHANGE_SET_PREFIX, change_set_type, fingerprint)
+        return "{}-{}".format(change_set_type, version.replace(".", "-"))
+
+    def fingerprint(self, cloudformation, parameters, encrypted=None):
+        """
+        A hash of everything we send to CloudFormation, used to tell whether the stack already has it.
+
+        The hash is published as a stack output, so KMS encrypted parameters are hashed as their ciphertext rather
+        than their plaintext, which anyone who can read the outputs could otherwise guess and check against it.
+        """
+
+        encrypted = encrypted or {}
+        hashed = []
+        for param in parameters or []:
+            if param['ParameterKey'] in encrypted and 'ParameterValue' in param:
+                param = dict(param, ParameterValue=encrypted[param['ParameterKey']])
+            hashed += [param]
+
+        canonical = json.dumps({'Template': cloudformation,
+                                'Parameters': sorted(hashed, key=lambda param: param['ParameterKey'])},
+                               sort_keys=True, separators=(',', ':'))
+
+        return hashlib.sha256(canonical).hexdigest()
+
+    def fingerprinted(self, cloudformation, fingerprint):
+        """
+        Returns the template body to send, with the fingerprint added to its outputs.
+        """
+
+        outputs = dict(cloudformation.get('Outputs') or {})
+        outputs[self.FINGERPRINT_OUTPUT] = {
+            'Description': 'Fingerprint of the template and parameters stacker last deployed',
+            'Value': fingerprint
+        }
+
+        return serialize(dict(cloudformation, Outputs=outputs))
+
+    def get_stack(self, stack_name):
+        try:
+            response = yield self.coroutine_client().describe_stacks(StackName=stack_name)
+        except botocore.exceptions.ClientError as error:
+            if "does not exist" in str(error):
+                raise Return(None)
+            raise
+
+        raise Return(response['Stacks'][0])
+
+    def is_up_to_date(self, stack, fingerprint):
+        # A stack that failed or rolled back may not match its outputs, so only trust stacks that deployed cleanly
+        if stack['StackStatus'] not in self.STABLE_STATUSES:
+            return False
+
+        for entry in stack.get('Outputs', []):
+            if entry['OutputKey'] == self.FINGERPRINT_OUTPUT:
+                return entry['OutputValue'] == fingerprint
+
+        return False
+
     def create_boto_clients(self):
         if self.ec2_client is None:
             self.ec2_client = self._boto_connect('ec2')
@@ -146,25 +496,14 @@ class DeployExecutor(object):
             self.kms_client = self._boto_connect('kms')
 
     def _boto_connect(self, client_type):
-        if self.role:
-            sts = STSUtil(sts_arn=self.role, debug=True)
-            credentials = sts.authenticate_role()['Credentials']
-            client = boto3.client(client_type,
-                                     aws_access_key_id=credentials['AccessKeyId'],
-                                     aws_secret_access_key=credentials['SecretAccessKey'],
-                                     aws_session_token=credentials['SessionToken'])
-
-        # If no role is specified the current environments will be used
-        else:
-            client = boto3.client(client_type)
-
-        return client
+        return CredentialProvider(role=self.role, debug=True, max_pool_connections=self.max_pool_connections) \
+            .client(client_type, region_name=self.region)
 
     def load_parameters(self, config_filename, scope=None):
         try:
             with open(config_filename) as config_file:
                 if re.match(self.REGEX_YAML, config_filename):
-                    config_data = yaml.load(config_file)
+                    config_data = load_yaml(config_file)
                 elif re.match(self.REGEX_JSON, config_filename):
                     config_data = json.load(config_file)
                 else:
@@ -184,22 +523,25 @@ class DeployExecutor(object):
             raise DeployException("Unable to open config file '{}'\n{}".format(config_filename, error))
 
     def get_ami_id_by_tag(self, ami_tag_value):
-        images = self.ec2_client.describe_images(Filters=[
-            {'Name': 'tag:ArtifactID',
-             'Values': [ami_tag_value]}
-        ])['Images']
-
-        if len(images) == 0:
-            raise DeployException("No images found for search '{}'".format(ami_tag_value))
-        elif len(images) > 1:
-            print images
-            raise DeployException("More than 1 image found for search '{}'".format(ami_tag_value))
-        else:
-            ami_id = images[0]["ImageId"]
-            print "Located AMI {} - {} created {}".format(ami_id, images[0]['Name'], images[0]['CreationDate'])
+        if self.ami_resolver is None:
+            self.ami_resolver = AMIResolver.shared(self.ec2_client, owners=self.ami_owners,
+                                                   lookup_timeout=self.lookup_timeout)
+
+        image = self.ami_resolver.find_one_by_artifact_id(ami_tag_value)
+
+        ami_id = image["ImageId"]
+        print "Located AMI {} - {} created {}".format(ami_id, image['Name'], image['CreationDate'])
 
         return ami_id
 
+    def stack_output_index(self):
+        # Keyed by the boto client, which every executor with the same role and region shares
+        return StackOutputIndex.shared(self.cf_client.cf_client, lookup_timeout=self.lookup_timeout)
+
+    def forget_stack_outputs(self, stack_name):
+        # Stacks deployed after this one, say those that depend on it, need to see its new outputs
+        self.stack_output_index().forget(stack_name)
+
     def import_params_from_config(self, cloudformation, config_params, create, secrets = []):
         parameters = []
         if 'Parameters' in cloudformation:
@@ -234,75 +576,225 @@ class DeployExecutor(object):
             print "Specified template has no stack parameters"
 
     def get_change_set(self, stack_name, cloudformation, parameters, change_set_name, create = False):
+        if self.keep_change_sets:
+            changeset = yield self.find_change_set(stack_name, change_set_name)
+            if changeset is not None:
+                raise Return(changeset)
+
+        # Large templates are staged in S3 first, which blocks, so it runs on one of the engine's workers
+        change_set_args = yield Call(self.get_change_set_args, stack_name, cloudformation, parameters,
+                                     change_set_name, create)
+
+        changeset = yield self.coroutine_client().create_change_set(**change_set_args)
+
+        if self.keep_change_sets:
+            yield self.remove_stale_change_sets(stack_name, change_set_name)
+
+        raise Return(changeset)
+
+    def find_change_set(self, stack_name, change_set_name):
+        """
+        Returns a kept change set with this name if it can still be executed. One that can't is deleted, so it can
+        be created again.
+        """
+
+        cf_client = self.coroutine_client()
+        try:
+            change_set = yield cf_client.describe_change_set(ChangeSetName=change_set_name, StackName=stack_name)
+        except botocore.exceptions.ClientError as error:
+            if self.is_missing_change_set(error):
+                raise Return(None)
+            raise
+
+        if self.is_reusable(change_set):
+            print self.labelled(stack_name, "Reusing kept change set {} for {}".format(change_set_name, stack_name))
+            raise Return(change_set)
+
+        yield cf_client.delete_change_set(ChangeSetName=change_set_name, StackName=stack_name)
+        raise Return(None)
+
+    def remove_stale_change_sets(self, stack_name, change_set_name):
+        """
+        Deletes the stack's oldest kept change sets, leaving the newest change_set_retention including this one.
+        """
+
+        cf_client = self.coroutine_client()
+        summaries = []
+        kwargs = dict(StackName=stack_name)
+        while True:
+            response = yield cf_client.list_change_sets(**kwargs)
+            summaries += response.get('Summaries', [])
+            if not response.get('NextToken'):
+                break
+            kwargs['NextToken'] = response['NextToken']
+
+        for stale in self.stale_change_sets(summaries, change_set_name):
+            yield cf_client.delete_change_set(ChangeSetName=stale, StackName=stack_name)
+
+    def is_missing_change_set(self, error):
+        return error.response.get('Error', {}).get('Code') == 'ChangeSetNotFound' or "does not exist" in str(error)
+
+    def is_reusable(self, change_set):
+        # Sets still being created are reusable too, as we wait for them to complete before executing them
+        return (change_set['Status'] in ['CREATE_PENDING', 'CREATE_IN_PROGRESS', 'CREATE_COMPLETE'] and
+                change_set.get('ExecutionStatus') in ['AVAILABLE', 'UNAVAILABLE'])
+
+    def stale_change_sets(self, summaries, change_set_name):
+        kept = [summary for summary in summaries
+                if summary['ChangeSetName'].startswith(self.KEPT_CHANGE_SET_PREFIX) and
+                summary['ChangeSetName'] != change_set_name]
+        kept.sort(key=lambda summary: summary['CreationTime'], reverse=True)
+
+        return [summary['ChangeSetName'] for summary in kept[max(self.change_set_retention - 1, 0):]]
+
+    def get_change_set_args(self, stack_name, cloudformation, parameters, change_set_name, create=False):
+        change_set_args = dict(
+            StackName=stack_name,
+            Parameters=parameters,
+            Capabilities=[
+                'CAPABILITY_IAM',
+            ],
+            ChangeSetName=change_set_name,
+        )
+
+        change_set_args.update(self.get_template_source(cloudformation))
+
         if create:
-            changeset = self.cf_client.create_change_set(
-                StackName=stack_name,
-                TemplateBody=cloudformation,
-                Parameters=parameters,
-                Capabilities=[
-                    'CAPABILITY_IAM',
-                ],
-                ChangeSetName=change_set_name,
-                ChangeSetType="CREATE"
-                )
-        else:
-            changeset = self.cf_client.create_change_set(
-                StackName=stack_name,
-                TemplateBody=cloudformation,
-                Parameters=parameters,
-                Capabilities=[
-                    'CAPABILITY_IAM',
-                ],
-                ChangeSetName=change_set_name,
-            )
-
-        return changeset
-
-    def print_change_set(self, change_set_details):
-        if len(change_set_details['Changes']) > 0:
-            print "-------------------------------"
-            print "CloudFormation changes to apply"
-            print "-------------------------------"
-            for x in change_set_details['Changes']:
-                change = x["ResourceChange"]
-
-                if change["Action"] == "Add":
-                    replace_mode = "New resource"
-                elif change["Action"] == "Modify":
-                    replace_mode = change["Replacement"]
-                    if replace_mode == "False":
-                        replace_mode = "Update in place"
-                    elif replace_mode == "False":
-                        replace_mode = "Full replacement"
-                    elif replace_mode == "Conditional":
-                        replace_mode = "Conditionally replace"
-                else:
-                    replace_mode = "Delete resource"
+            change_set_args['ChangeSetType'] = "CREATE"
+
+        return change_set_args
+
+    def get_template_source(self, cloudformation):
+        # CloudFormation only accepts small templates inline, anything bigger has to be read from S3
+        if len(cloudformation) <= TemplateStager.MAX_TEMPLATE_BODY_SIZE:
+            return {'TemplateBody': cloudformation}
+
+        if self.template_bucket is None:
+            raise DeployException("The template is {} bytes, which is over CloudFormation's {} byte limit for inline "
+                                  "templates. Use --template-bucket to upload it to S3 instead."
+                                  .format(len(cloudformation), TemplateStager.MAX_TEMPLATE_BODY_SIZE))
+
+        if self.s3_client is None:
+            self.s3_client = self._boto_connect('s3')
+
+        stager = TemplateStager(self.s3_client, self.template_bucket)
+        return {'TemplateURL': stager.stage(cloudformation)}
+
+    def print_change_set(self, stack_name, change_set_name, first_page):
+        """
+        Prints the changes in each page of a change set as the page arrives.
+
+        Later pages are only fetched as the ones before are printed, so large change sets start printing straight
+        away and are never held in memory whole.
+        """
+
+        page, printed = first_page, 0
+        while True:
+            printed = self.print_changes(stack_name, page, printed)
+            if not page.get('NextToken'):
+                break
+            page = yield self.coroutine_client().describe_change_set(ChangeSetName=change_set_name,
+                                                                     StackName=stack_name,
+                                                                     NextToken=page['NextToken'])
+        self.print_change_set_end(stack_name, printed)
+
+    def print_changes(self, stack_name, page, printed):
+        """
+        Prints the changes in one page of a change set, given how many have been printed before it, and returns how
+        many have been printed now.
+        """
+
+        for x in page['Changes']:
+            change = x["ResourceChange"]
+
+            # --change-set-format json prints the same change events as --output json, even with text output
+            if output.structured() or self.change_set_format == 'json':
+                output.print_event('change', stack=page.get('StackName'), change_set=page.get('ChangeSetName'),
+                                   **change)
+                printed += 1
+                continue
+
+            if printed == 0:
+                print self.labelled(stack_name, "-------------------------------\n"
+                                                "CloudFormation changes to apply\n"
+                                                "-------------------------------")
+            printed += 1
+
+            if change["Action"] == "Add":
+                replace_mode = "New resource"
+            elif change["Action"] == "Modify":
+                replace_mode = change["Replacement"]
+                if replace_mode == "False":
+                    replace_mode = "Update in place"
+                elif replace_mode == "True":
+                    replace_mode = "Full replacement"
+                elif replace_mode == "Conditional":
+                    replace_mode = "Conditionally replace"
+            else:
+                replace_mode = "Delete resource"
 
-                change_mode = "[{} - {}]".format(change["Action"], replace_mode)
+            change_mode = "[{} - {}]".format(change["Action"], replace_mode)
 
-                print "{} {}/{} ({})".format(change_mode.ljust(34), change["LogicalResourceId"],
-                                             change.get("PhysicalResourceId", ""), change["ResourceType"])
+            print self.labelled(stack_name, "{} {}/{} ({})".format(change_mode.ljust(34), change["LogicalResourceId"],
+                                                                   change.get("PhysicalResourceId", ""),
+                                                                   change["ResourceType"]))
 
-            print ""
+        return printed
+
+    def print_change_set_end(self, stack_name, printed):
+        if self.change_set_format == 'json' or output.structured():
+            return
+        if printed > 0:
+            print self.labelled(stack_name, "")
         else:
-            print "No CloudFormation changes detected"
+            print self.labelled(stack_name, "No CloudFormation changes detected")
 
     def load_cloudformation(self, template_name):
+        return self.load_template(template_name).data
+
+    def load_template(self, template_name):
+        if re.match(self.REGEX_YAML, template_name):
+            parse = load_yaml
+        elif re.match(self.REGEX_JSON, template_name):
+            parse = json.loads
+        else:
+            raise DeployException("Unable to open CloudFormation template '{}'\n"
+                                  "Cloudformation template must be a JSON or YAML file".format(template_name))
+
         try:
-            with open(template_name, "r") as myfile:
-                if re.match(self.REGEX_YAML, template_name):
-                    cloudformation = yaml.load(myfile)
-                elif re.match(self.REGEX_JSON, template_name):
-                    cloudformation = json.load(myfile)
-                else:
-                    raise DeployException("Cloudformation template must be a JSON or YAML file")
+            if self.template_cache is not None:
+                template = self.template_cache.load(template_name, lambda content: Template.load(content, parse))
+            else:
+                with open(template_name, "rb") as myfile:
+                    template = Template.load(myfile.read(), parse)
 
         except Exception as error:
             raise DeployException("Unable to open CloudFormation template '{}'\n{}".format(template_name, error))
 
 
-        if cloudformation is None:
+        if template.data is None:
             raise DeployException("It looks like the CloudFormation template file is empty")
 
-        return cloudformation
+        return template
+
+
+class AsyncDeployExecutor(DeployExecutor):
+    """
+    Runs deploy_coroutine against an AsyncCloudFormationUtil, so a stack waiting on CloudFormation is an engine timer
+    rather than a blocked worker, and one Engine can drive many deployments at the same time.
+
+    Its cf_client is an AsyncCloudFormationUtil. Work that has no coroutine counterpart, like looking up AMIs and
+    staging templates in S3, runs on the engine's workers.
+    """
+
+    def create_boto_clients(self):
+        super(AsyncDeployExecutor, self).create_boto_clients()
+        if not isinstance(self.cf_client, AsyncCloudFormationUtil):
+            self.cf_client = AsyncCloudFormationUtil(self.cf_client)
+
+    def stack_output_index(self):
+        # The async util wraps the CloudFormationUtil that wraps the boto client
+        return StackOutputIndex.shared(self.cf_client.cf_client.cf_client, lookup_timeout=self.lookup_timeout)
+
+    def coroutine_client(self):
+        return self.cf_client
@@ -0,0 +1,352 @@
+import json
+import os
+import re
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+
+from cf_helper import output
+from cf_helper.engine import AsyncCloudFormationUtil, Call, Engine, Return
+from cf_helper.templates import load_yaml
+from cf_helper.utils import AMIResolver, CredentialProvider, DeployException
+from deploy import AsyncDeployExecutor, DeployExecutor
+
+
+class StackDefinition(object):
+    """
+    A single entry in a deploy-many manifest, mirroring the options of the deploy sub-command.
+    """
+
+    def __init__(self, name, template, config=None, scope=None, depends_on=None,
+                 ami_id=None, ami_tag=None, add_parameters=None, create=False):
+        self.name = name
+        self.template = template
+        self.config = config
+        self.scope = scope
+        self.depends_on = depends_on or []
+        self.ami_id = ami_id
+        self.ami_tag = ami_tag
+        self.add_parameters = add_parameters
+        self.create = create
+
+
+class DeployManyExecutor(object):
+    REGEX_YAML = re.compile('.+\.yaml|.+.yml')
+    REGEX_JSON = re.compile('.+\.json')
+
+    STATUS_COMPLETE = "COMPLETE"
+    STATUS_FAILED = "FAILED"
+    STATUS_SKIPPED = "SKIPPED"
+
+    # Queue.get() can only be interrupted with Ctrl-C when it is given a timeout
+    QUEUE_TIMEOUT = 60 * 60 * 24
+
+    def __init__(self, role=None, max_workers=4, change_set_timeout=None, stack_timeout=None, template_bucket=None,
+                 ami_owners=None, coroutines=False, keep_change_sets=False,
+                 change_set_format='text', debug=False):
+        super(DeployManyExecutor, self).__init__()
+
+        self.role = role
+        self.max_workers = max_workers
+        self.change_set_timeout = DeployExecutor.change_set_timeout if change_set_timeout is None \
+            else change_set_timeout
+        self.stack_timeout = DeployExecutor.stack_timeout if stack_timeout is None else stack_timeout
+        self.template_bucket = template_bucket
+        self.coroutines = coroutines
+        self.keep_change_sets = keep_change_sets
+        self.change_set_format = change_set_format
+        self.debug = debug
+
+        self.clients = DeployExecutor()
+        self.clients.role = role
+        self.clients.ami_owners = ami_owners
+
+    def execute(self, manifest_filename, version=None, dry_run=False, force=False):
+        stacks = self.load_manifest(manifest_filename)
+        order = self.build_graph(stacks)
+
+        # All stacks share a single set of boto clients rather than each connecting for itself, so make sure
+        # there's a connection for each worker
+        self.clients.max_pool_connections = max(CredentialProvider.max_pool_connections, self.max_workers)
+        self.clients.create_boto_clients()
+        if self.template_bucket is not None:
+            self.clients.s3_client = self.clients._boto_connect('s3')
+
+        # Look every AMI up in one go, rather than once per stack
+        ami_tags = sorted(set(stack.ami_tag for stack in stacks if stack.ami_tag))
+        if len(ami_tags) > 0:
+            self.clients.ami_resolver = AMIResolver.shared(self.clients.ec2_client, owners=self.clients.ami_owners,
+                                                           lookup_timeout=self.clients.lookup_timeout)
+            with self.clients.span('ami_lookup'):
+                self.clients.ami_resolver.find_by_artifact_ids(ami_tags)
+
+        if self.coroutines:
+            results = self.run_stacks(stacks, order, version, dry_run, force)
+        else:
+            results = self.deploy_stacks(stacks, order, version, dry_run, force)
+        self.print_summary(order, results)
+
+        failed = [name for name in order if results[name]['status'] != self.STATUS_COMPLETE]
+        if len(failed) > 0:
+            raise DeployException("{} of {} stacks were not deployed: {}".format(len(failed), len(order),
+                                                                                 ", ".join(failed)))
+
+        return results
+
+    def load_manifest(self, manifest_filename):
+        try:
+            with open(manifest_filename) as manifest_file:
+                if re.match(self.REGEX_YAML, manifest_filename):
+                    manifest = load_yaml(manifest_file)
+                elif re.match(self.REGEX_JSON, manifest_filename):
+                    manifest = json.load(manifest_file)
+                else:
+                    raise DeployException("Manifest must be a YAML or JSON file")
+
+        except Exception as error:
+            raise DeployException("Unable to open manifest file '{}'\n{}".format(manifest_filename, error))
+
+        if isinstance(manifest, dict):
+            manifest = manifest.get('stacks')
+
+        if not manifest:
+            raise DeployException("It looks like the manifest '{}' does not define any stacks".format(manifest_filename))
+
+        # Template and config paths are relative to the manifest, not wherever stacker was run from
+        base_dir = os.path.dirname(os.path.abspath(manifest_filename))
+
+        stacks = []
+        for entry in manifest:
+            if 'name' not in entry or 'template' not in entry:
+                raise DeployException("Every stack in the manifest needs a 'name' and a 'template': {}".format(entry))
+
+            depends_on = entry.get('depends_on') or []
+            if not isinstance(depends_on, list):
+                depends_on = [depends_on]
+
+            stacks += [StackDefinition(name=entry['name'],
+                                       template=os.path.join(base_dir, entry['template']),
+                                       config=os.path.join(base_dir, entry['config']) if entry.get('config') else None,
+                                       scope=entry.get('scope'),
+                                       depends_on=depends_on,
+                                       ami_id=entry.get('ami_id'),
+                                       ami_tag=entry.get('ami_tag'),
+                                       add_parameters=entry.get('add_parameters'),
+                                       create=entry.get('create', False))]
+
+        return stacks
+
+    def build_graph(self, stacks):
+        """
+        Validates the dependencies between stacks and returns the stack names in a valid deployment order.
+        """
+
+        names = [stack.name for stack in stacks]
+        if len(set(names)) != len(names):
+            duplicates = sorted(set(name for name in names if names.count(name) > 1))
+            raise DeployException("Stacks are defined more than once in the manifest: {}".format(", ".join(duplicates)))
+
+        remaining = dict()
+        for stack in stacks:
+            for dependency in stack.depends_on:
+                if dependency not in names:
+                    raise DeployException("Stack '{}' depends on '{}' which is not in the manifest"
+                                          .format(stack.name, dependency))
+            remaining[stack.name] = set(stack.depends_on)
+
+        order = []
+        ready = [name for name in names if not remaining[name]]
+        while ready:
+            name = ready.pop(0)
+            order += [name]
+            for stack in stacks:
+                if name in remaining[stack.name]:
+                    remaining[stack.name].remove(name)
+                    if not remaining[stack.name]:
+                        ready += [stack.name]
+
+        if len(order) != len(names):
+            cycle = [name for name in names if name not in order]
+            raise DeployException("Circular dependency between stacks: {}".format(", ".join(cycle)))
+
+        return order
+
+    def deploy_stacks(self, stacks, order, version, dry_run=False, force=False):
+        definitions = dict((stack.name, stack) for stack in stacks)
+        waiting_on = dict((stack.name, set(stack.depends_on)) for stack in stacks)
+        dependants = dict((name, [stack.name for stack in stacks if name in stack.depends_on]) for name in order)
+
+        results = dict()
+        completed = Queue()
+        pool = ThreadPool(processes=self.max_workers)
+
+        def submit(name):
+            if self.debug:
+                print "Starting deployment of stack {}".format(name)
+            pool.apply_async(self._deploy_stack, (definitions[name], version, dry_run, force), callback=completed.put)
+
+        def skip(name, reason):
+            for dependant in dependants[name]:
+                if dependant not in results:
+                    results[dependant] = {'status': self.STATUS_SKIPPED, 'error': reason, 'duration': 0}
+                    skip(dependant, reason)
+
+        try:
+            running = 0
+            for name in order:
+                if not waiting_on[name]:
+                    submit(name)
+                    running += 1
+
+            # Only block on the stacks that something else is waiting for; everything else runs as soon as a
+            # worker is free
+            while running > 0:
+                output.flush()
+                result = completed.get(True, self.QUEUE_TIMEOUT)
+                running -= 1
+
+                name = result['name']
+                results[name] = result
+
+                if result['status'] != self.STATUS_COMPLETE:
+                    skip(name, "Dependency '{}' was not deployed".format(name))
+                    continue
+
+                for dependant in dependants[name]:
+                    waiting_on[dependant].discard(name)
+                    if not waiting_on[dependant] and dependant not in results:
+                        submit(dependant)
+                        running += 1
+        finally:
+            pool.close()
+            pool.join()
+
+        return results
+
+    def run_stacks(self, stacks, order, version, dry_run=False, force=False):
+        """
+        Deploys the stacks as coroutines on a single Engine, rather than a thread per stack.
+
+        Stacks waiting on their dependencies or on CloudFormation cost nothing, and max_workers limits the AWS
+        calls in flight across every stack instead of how many stacks are deployed at once.
+        """
+
+        definitions = dict((stack.name, stack) for stack in stacks)
+        cf_client = AsyncCloudFormationUtil(self.clients.cf_client)
+        engine = Engine(max_concurrency=self.max_workers)
+
+        # The order puts every stack after its dependencies, so their tasks always exist already
+        tasks = dict()
+        for name in order:
+            stack = definitions[name]
+            dependencies = [(dependency, tasks[dependency]) for dependency in stack.depends_on]
+            tasks[name] = engine.spawn(self._deploy_stack_coroutine(stack, dependencies, cf_client,
+                                                                    version, dry_run, force), name=name)
+
+        engine.run()
+
+        return dict((name, task.get()) for name, task in tasks.items())
+
+    def _deploy_stack_coroutine(self, stack, dependencies, cf_client, version, dry_run, force):
+        for dependency, task in dependencies:
+            dependency_result = yield task
+            if dependency_result['status'] == self.STATUS_SKIPPED:
+                raise Return({'name': stack.name, 'status': self.STATUS_SKIPPED,
+                              'error': dependency_result['error'], 'duration': 0})
+            if dependency_result['status'] != self.STATUS_COMPLETE:
+                raise Return({'name': stack.name, 'status': self.STATUS_SKIPPED,
+                              'error': "Dependency '{}' was not deployed".format(dependency), 'duration': 0})
+
+        if self.debug:
+            print "Starting deployment of stack {}".format(stack.name)
+
+        executor = self._create_executor(AsyncDeployExecutor)
+        executor.cf_client = cf_client
+
+        start = time.time()
+        result = {'name': stack.name, 'status': self.STATUS_COMPLETE, 'error': None}
+
+        try:
+            deployment = yield Call(executor.prepare, stack.template, stack.config, stack.add_parameters,
+                                    version, stack.scope, self.debug)
+            yield executor.deploy_coroutine(stack.name, deployment,
+                                            ami_id=stack.ami_id,
+                                            ami_tag_value=stack.ami_tag,
+                                            create=stack.create,
+                                            dry_run=dry_run,
+                                            force=force)
+        except Exception as error:
+            if self.debug:
+                traceback.print_exc()
+            print "ERROR: Stack {} failed: {}".format(stack.name, error)
+            result['status'] = self.STATUS_FAILED
+            result['error'] = str(error)
+
+        result['duration'] = time.time() - start
+        raise Return(result)
+
+    def _create_executor(self, executor_class=DeployExecutor):
+        executor = executor_class()
+        executor.role = self.role
+        executor.max_pool_connections = self.clients.max_pool_connections
+        executor.cf_client = self.clients.cf_client
+        executor.ec2_client = self.clients.ec2_client
+        executor.kms_client = self.clients.kms_client
+        executor.change_set_timeout = self.change_set_timeout
+        executor.stack_timeout = self.stack_timeout
+        executor.template_bucket = self.template_bucket
+        executor.keep_change_sets = self.keep_change_sets
+        executor.change_set_format = self.change_set_format
+        executor.s3_client = self.clients.s3_client
+        executor.ami_resolver = self.clients.ami_resolver
+        executor.ami_owners = self.clients.ami_owners
+        executor.concurrent = True
+        return executor
+
+    def _deploy_stack(self, stack, version, dry_run, force):
+        executor = self._create_executor()
+
+        start = time.time()
+        result = {'name': stack.name, 'status': self.STATUS_COMPLETE, 'error': None}
+
+        try:
+            executor.deploy(stack_name=stack.name,
+                            template_name=stack.template,
+                            config_filename=stack.config,
+                            add_parameters=stack.add_parameters,
+                            version=version,
+                            ami_id=stack.ami_id,
+                            ami_tag_value=stack.ami_tag,
+                            scope=stack.scope,
+                            create=stack.create,
+                            dry_run=dry_run,
+                            debug=self.debug,
+                            force=force)
+        except Exception as error:
+            if self.debug:
+                traceback.print_exc()
+            print "ERROR: Stack {} failed: {}".format(stack.name, error)
+            result['status'] = self.STATUS_FAILED
+            result['error'] = str(error)
+
+        result['duration'] = time.time() - start
+        return result
+
+    def print_summary(self, order, results):
+        if output.structured():
+            for name in order:
+                result = results[name]
+                output.event('result', stack=name, status=result['status'], seconds=round(result['duration'], 3),
+                             error=result['error'])
+            return
+
+        print ""
+        print "Deployment summary"
+        print "------------------"
+        for name in order:
+            result = results[name]
+            print "  {} {} ({:.1f}s)".format(result['status'].ljust(9), name, result['duration'])
+            if result['error'] is not None:
+                print "            {}".format(result['error'])
+        print ""
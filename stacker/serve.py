@@ -0,0 +1,195 @@
+"""
+A long lived stacker that runs deploy, ami and status commands sent to it over a Unix socket.
+
+Clients, assumed role credentials, parsed templates and AMI lookups are kept between commands, so a command sent
+here skips the interpreter start up, imports, role assumption and parsing that a fresh stacker pays for.
+
+Each request is one line of JSON with the command's arguments, working directory and AWS_* environment variables. The reply is a line of JSON
+for each piece of output, then one with the exit code.
+"""
+
+import errno
+import json
+import os
+import socket
+import SocketServer
+import sys
+import traceback
+from StringIO import StringIO
+
+from cf_helper.output import OutputSink
+from cf_helper.redaction import REDACTOR, RedactingStream
+
+
+def aws_environment():
+    """
+    Returns the environment variables that choose the AWS credentials, profile and region a command runs with.
+    """
+
+    return dict((key, value) for key, value in os.environ.items() if key.startswith('AWS_'))
+
+
+class SocketOutput(object):
+    """
+    Sends everything written to it on to the client as output messages, a message each time it is flushed.
+    """
+
+    # Send a message anyway once this much has been written, so the buffer can't grow without bound
+    MAX_BUFFER = 64 * 1024
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.connected = True
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.MAX_BUFFER:
+            self.flush()
+
+    def flush(self):
+        data, self._buffer, self._buffered = u"".join(self._buffer), [], 0
+        if data:
+            self.send({'output': data})
+
+    def send(self, message):
+        # A client that goes away, say a cancelled CI job, shouldn't leave a deploy half done
+        if not self.connected:
+            return
+        try:
+            self.wfile.write(json.dumps(message) + "\n")
+            self.wfile.flush()
+        except socket.error:
+            self.connected = False
+
+
+class CommandHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        output = SocketOutput(self.wfile)
+        code = self.server.run(request, output)
+        output.send({'exit': code})
+
+
+class StackerServer(SocketServer.UnixStreamServer):
+    """
+    Runs one command at a time. Commands print to sys.stdout and open files relative to the working directory,
+    which the whole process shares, so further clients wait their turn.
+    """
+
+    def __init__(self, socket_path, command):
+        self.socket_path = socket_path
+        self.command = command
+
+        directory = os.path.dirname(socket_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._remove_stale_socket()
+
+        # The server acts with our credentials, so only we can connect to it
+        umask = os.umask(0077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, socket_path, CommandHandler)
+        finally:
+            os.umask(umask)
+
+    def run(self, request, output):
+        stdout, stdin, cwd, sink = sys.stdout, sys.stdin, os.getcwd(), OutputSink.current
+        environment = aws_environment()
+        code = 0
+
+        # The command runs with the sender's credentials, profile and region rather than the server's
+        self._set_aws_environment(request.get('environment', {}))
+
+        OutputSink.current = OutputSink(output)
+        sys.stdout = RedactingStream(OutputSink.current)
+        if request.get('stdin') is not None:
+            sys.stdin = StringIO(request['stdin'])
+        try:
+            os.chdir(request['cwd'])
+            self.command(request['argv'])
+        except SystemExit as exit:
+            if isinstance(exit.code, int):
+                code = exit.code
+            else:
+                code = 0 if exit.code is None else 1
+        except Exception as error:
+            traceback.print_exc(file=sys.stdout)
+            print "ERROR: {0}".format(error)
+            code = 1
+        finally:
+            sys.stdout.release()
+            OutputSink.current.release()
+            sys.stdout, sys.stdin, OutputSink.current = stdout, stdin, sink
+            # Everything the command printed has been masked, so the secrets it decrypted needn't be kept
+            REDACTOR.clear()
+            os.chdir(cwd)
+            self._set_aws_environment(environment)
+
+        return code
+
+    def _set_aws_environment(self, environment):
+        for key in aws_environment():
+            del os.environ[key]
+        os.environ.update(environment)
+
+    def close(self):
+        self.server_close()
+        try:
+            os.remove(self.socket_path)
+        except OSError:
+            pass
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.socket_path):
+            return
+
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except socket.error as error:
+            if error.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+                raise
+            # Left behind by a server that didn't shut down cleanly
+            os.remove(self.socket_path)
+        else:
+            raise socket.error(errno.EADDRINUSE, "A server is already listening on {}".format(self.socket_path))
+        finally:
+            probe.close()
+
+
+def forward(socket_path, argv, stdin=None, output=None):
+    """
+    Sends a command to the server, writing its output to output (stdout by default) as it arrives, and returns its
+    exit code.
+    """
+
+    output = output or sys.stdout
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except socket.error as error:
+        output.write("ERROR: Can't reach a stacker server on {}: {}\n".format(socket_path, error.strerror))
+        return 1
+
+    try:
+        connection.sendall(json.dumps({'argv': argv, 'cwd': os.getcwd(), 'stdin': stdin,
+                                       'environment': aws_environment()}) + "\n")
+
+        replies = connection.makefile('r')
+        for line in iter(replies.readline, ''):
+            message = json.loads(line)
+            if 'exit' in message:
+                return message['exit']
+            output.write(message['output'].encode('utf-8'))
+            output.flush()
+    finally:
+        connection.close()
+
+    output.write("ERROR: The stacker server closed the connection before the command finished\n")
+    return 1
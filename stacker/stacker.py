@@ -1,15 +1,16 @@
-from cf_helper.utils import DeployException
-
 __author__ = 'steve.mactaggart & elliott.gorrell'
 
 import argparse
 import os
 import sys, traceback
 
-import pkg_resources  # part of setuptools
+from version import __version__
+
+# Where `stacker serve` listens, and where --server finds it, unless told otherwise
+DEFAULT_SOCKET = os.path.join(os.path.expanduser('~'), '.cache', 'stacker', 'server.sock')
 
-from deploy import DeployExecutor
-from ami import AMIExecutor
+# The sub-command modules pull in boto3, botocore and yaml, which are slow to import. They are only imported
+# once we know which sub-command is being run, so --help and --version stay fast.
 
 def build_deploy_parser(parser):
 
@@ -40,6 +41,11 @@ def build_deploy_parser(parser):
     parser.add_argument('--ami-tag',
                         help="The tag value of the AMI to search for",
                         required=False)
+    parser.add_argument('--ami-owner',
+                        help="Only find AMIs by tag from this account (or 'self', 'amazon', etc), use more than once "
+                             "to search several accounts. Defaults to every AMI this account can see",
+                        action='append',
+                        required=False)
     parser.add_argument('--scope',
                         help="The scope for the config parameters",
                         required=False)
@@ -48,6 +54,22 @@ def build_deploy_parser(parser):
                         required=False,
                         default=False,
                         action='store_true')
+    parser.add_argument('--change-set-format',
+                        help="Print each change as text, or as a JSON change event like --output json (default text)",
+                        choices=['text', 'json'],
+                        default='text',
+                        required=False)
+    parser.add_argument('--keep-change-sets',
+                        help="On a dry run keep the changeset, named from the template and parameters, so a later "
+                             "deploy of the same thing executes it instead of creating another",
+                        required=False,
+                        default=False,
+                        action='store_true')
+    parser.add_argument('--force',
+                        help="Deploy even if the stack already matches the template and parameters",
+                        required=False,
+                        default=False,
+                        action='store_true')
     parser.add_argument('--add-parameters',
                         help='Used to supply additional parameters not in the config file. Needs to be in the format "key=value"',
                         nargs='*',
@@ -55,13 +77,37 @@ def build_deploy_parser(parser):
     parser.add_argument('--version','-v',
                         help="The build number of this deployment",
                         required=False)
+    parser.add_argument('--template-bucket',
+                        help="The S3 bucket to upload templates that are too large to send inline to",
+                        required=False)
+    parser.add_argument('--change-set-timeout',
+                        help="How many seconds to wait for a changeset to be created (default 600)",
+                        type=int,
+                        required=False)
+    parser.add_argument('--stack-timeout',
+                        help="How many seconds to wait for a stack update to complete (default 4500)",
+                        type=int,
+                        required=False)
+    parser.add_argument('--region',
+                        help="The regions to deploy the stack to at the same time. Defaults to the current region",
+                        nargs='+',
+                        required=False)
 
-    parser.set_defaults(func=execute_deploy)
+    parser.set_defaults(func=execute_deploy, forward=True)
 
 
 def execute_deploy(args):
+    from deploy import DeployExecutor
 
     executor = DeployExecutor()
+    if args.change_set_timeout is not None:
+        executor.change_set_timeout = args.change_set_timeout
+    if args.stack_timeout is not None:
+        executor.stack_timeout = args.stack_timeout
+    executor.template_bucket = args.template_bucket
+    executor.ami_owners = args.ami_owner
+    executor.keep_change_sets = args.keep_change_sets
+    executor.change_set_format = args.change_set_format
     executor.execute(stack_name=args.name,
                      config_filename=args.config,
                      template_name=args.template,
@@ -73,7 +119,98 @@ def execute_deploy(args):
                      scope=args.scope,
                      create=args.create,
                      delete=args.delete,
-                     dry_run=args.dry_run)
+                     dry_run=args.dry_run,
+                     force=args.force,
+                     regions=args.region)
+
+
+def build_deploy_many_parser(parser):
+
+    parser.add_argument('--debug', '-d',
+                        default=False,
+                        help='Show debug log messages',
+                        action="store_true")
+    parser.add_argument('--manifest', '-m',
+                        required=True,
+                        help="The path of the YAML or JSON file listing the stacks to deploy")
+    parser.add_argument('--ami-owner',
+                        help="Only find AMIs by tag from this account (or 'self', 'amazon', etc), use more than once "
+                             "to search several accounts. Defaults to every AMI this account can see",
+                        action='append',
+                        required=False)
+    parser.add_argument('--max-workers',
+                        help="The maximum number of stacks to deploy at the same time, or with --coroutines the "
+                             "maximum number of AWS calls to make at once",
+                        type=int,
+                        default=4,
+                        required=False)
+    parser.add_argument('--coroutines',
+                        help="Follow every stack from a single thread. Suits manifests with hundreds of stacks",
+                        required=False,
+                        default=False,
+                        action='store_true')
+    parser.add_argument('--dry-run',
+                        help="Produces a changeset for each stack however does not update",
+                        required=False,
+                        default=False,
+                        action='store_true')
+    parser.add_argument('--change-set-format',
+                        help="Print each change as text, or as a JSON change event like --output json (default text)",
+                        choices=['text', 'json'],
+                        default='text',
+                        required=False)
+    parser.add_argument('--keep-change-sets',
+                        help="On a dry run keep the changeset, named from the template and parameters, so a later "
+                             "deploy of the same thing executes it instead of creating another",
+                        required=False,
+                        default=False,
+                        action='store_true')
+    parser.add_argument('--force',
+                        help="Deploy stacks even if they already match their template and parameters",
+                        required=False,
+                        default=False,
+                        action='store_true')
+    parser.add_argument('--version','-v',
+                        help="The build number of this deployment",
+                        required=False)
+    parser.add_argument('--template-bucket',
+                        help="The S3 bucket to upload templates that are too large to send inline to",
+                        required=False)
+    parser.add_argument('--change-set-timeout',
+                        help="How many seconds to wait for a changeset to be created (default 600)",
+                        type=int,
+                        required=False)
+    parser.add_argument('--stack-timeout',
+                        help="How many seconds to wait for a stack update to complete (default 4500)",
+                        type=int,
+                        required=False)
+
+    parser.set_defaults(func=execute_deploy_many)
+
+
+def execute_deploy_many(args):
+    from cf_helper.utils import DeployException
+    from deploy_many import DeployManyExecutor
+
+    executor = DeployManyExecutor(role=args.role,
+                                  max_workers=args.max_workers,
+                                  change_set_timeout=args.change_set_timeout,
+                                  stack_timeout=args.stack_timeout,
+                                  template_bucket=args.template_bucket,
+                                  ami_owners=args.ami_owner,
+                                  coroutines=args.coroutines,
+                                  keep_change_sets=args.keep_change_sets,
+                                  change_set_format=args.change_set_format,
+                                  debug=args.debug)
+
+    try:
+        executor.execute(manifest_filename=args.manifest,
+                         version=args.version,
+                         dry_run=args.dry_run,
+                         force=args.force)
+    except DeployException as error:
+        print "ERROR: {0}".format(error)
+        sys.exit(1)
 
 
 def build_ami_parser(parser):
@@ -83,22 +220,70 @@ def build_ami_parser(parser):
                         help='Show debug log messages',
                         action="store_true")
     parser.add_argument('--ami-id',
-                        help="The AMI ID to search for (used to test across account permissions)",
+                        help="The AMI IDs to search for (used to test across account permissions)",
+                        nargs='+',
                         required=False)
     parser.add_argument('--artifact-id',
-                        help="The tag value of the AMI to search for",
+                        help="The tag values of the AMIs to search for",
+                        nargs='+',
+                        required=False)
+    parser.add_argument('--from-file',
+                        help="A file (or - for stdin) of AMI IDs and tag values to search for, one per line",
                         required=False)
+    parser.add_argument('--json',
+                        help="Print each result as a line of JSON. Always on when searching for more than one AMI",
+                        default=False,
+                        action='store_true')
+    parser.add_argument('--ami-owner',
+                        help="Only find AMIs by tag from this account (or 'self', 'amazon', etc), use more than once "
+                             "to search several accounts. Defaults to every AMI this account can see",
+                        action='append',
+                        required=False)
+
+    parser.set_defaults(func=execute_ami, forward=True)
+
+
+def read_ami_searches(filename):
+    """
+    Splits the lines of a file into AMI IDs and tag values, skipping blank lines and # comments.
+    """
+
+    from ami import AMIExecutor
 
-    parser.set_defaults(func=execute_ami)
+    if filename == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(filename) as search_file:
+            lines = search_file.readlines()
+
+    searches = [line.strip() for line in lines if line.strip() and not line.strip().startswith('#')]
+
+    ami_ids = [search for search in searches if AMIExecutor.REGEX_AMI_ID.match(search)]
+    artifact_ids = [search for search in searches if not AMIExecutor.REGEX_AMI_ID.match(search)]
+
+    return ami_ids, artifact_ids
 
 
 def execute_ami(args):
+    from ami import AMIExecutor
+    from cf_helper.utils import DeployException
+
+    executor = AMIExecutor(role=args.role, owners=args.ami_owner)
 
-    executor = AMIExecutor(role=args.role)
+    ami_ids = list(args.ami_id or [])
+    artifact_ids = list(args.artifact_id or [])
+    if args.from_file:
+        file_ami_ids, file_artifact_ids = read_ami_searches(args.from_file)
+        ami_ids += file_ami_ids
+        artifact_ids += file_artifact_ids
 
     try:
-        executor.execute(ami_id=args.ami_id,
-                         artifact_id=args.artifact_id)
+        if args.json or args.from_file or len(ami_ids) + len(artifact_ids) > 1:
+            if not executor.execute_many(artifact_ids=artifact_ids, ami_ids=ami_ids):
+                sys.exit(1)
+        else:
+            executor.execute(ami_id=ami_ids[0] if ami_ids else None,
+                             artifact_id=artifact_ids[0] if artifact_ids else None)
     except DeployException as error:
         print "ERROR: {0}".format(error)
     except Exception as error:
@@ -109,28 +294,230 @@ def execute_ami(args):
         sys.exit(1)
 
 
-def main(argv=None):
+def build_status_parser(parser):
+
+    parser.add_argument('--debug', '-d',
+                        default=False,
+                        help='Show debug log messages',
+                        action="store_true")
+    parser.add_argument('--prefix',
+                        help="Only show stacks whose names start with this. Use more than once for several prefixes",
+                        action='append',
+                        required=False)
+    parser.add_argument('--tag',
+                        help='Only show stacks with this tag, in the format "key=value", or "key" for any value. '
+                             'Use more than once to require several tags',
+                        action='append',
+                        required=False)
+    parser.add_argument('--region',
+                        help="The regions to show the stacks of. Defaults to the current region",
+                        nargs='+',
+                        required=False)
+
+    parser.set_defaults(func=execute_status, forward=True)
 
-    # Python filesystem hack required to enable stream flushing on demand
-    sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
 
+def execute_status(args):
+    from cf_helper.utils import DeployException
+    from status import StatusExecutor
+
+    executor = StatusExecutor(role=args.role, debug=args.debug)
     try:
-        # create the top-level parser
-        parser = argparse.ArgumentParser(prog='stacker', description="A set of utilities for Deploying Cloudformation Stacks")
-        parser.add_argument('--debug', '-d', default=False, help='Show debug log messages', action="store_true")
-        parser.add_argument('--role', help='The AWS IAM Role to assume.')
-        parser.add_argument('--version','-v', help="Prints the version", dest="show_version", action="version", version=pkg_resources.require("Stacker")[0].version)
+        executor.execute(prefixes=args.prefix, tags=args.tag, regions=args.region)
+    except DeployException as error:
+        print "ERROR: {0}".format(error)
+        sys.exit(1)
+
+
+def build_serve_parser(parser):
+
+    parser.add_argument('--socket',
+                        help="The Unix socket to listen on (default {})".format(DEFAULT_SOCKET),
+                        default=DEFAULT_SOCKET,
+                        required=False)
+
+    parser.set_defaults(func=execute_serve)
+
+
+def execute_serve(args):
+    import signal
+    from serve import StackerServer
+
+    # Import every command up front, so the commands sent here don't pay for it and don't depend on the
+    # working directory they are sent from
+    import ami, deploy, status
+
+    server = StackerServer(args.socket, run_forwarded)
+    print "Listening on {}".format(args.socket)
+
+    # Stop cleanly when asked to, so the socket is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
+
+
+def build_parser():
+    # create the top-level parser
+    parser = argparse.ArgumentParser(prog='stacker', description="A set of utilities for Deploying Cloudformation Stacks")
+    parser.add_argument('--debug', '-d', default=False, help='Show debug log messages', action="store_true")
+    parser.add_argument('--role', help='The AWS IAM Role to assume.')
+    parser.add_argument('--credential-cache', default=False, action="store_true",
+                        help='Cache the assumed role credentials on disk (under ~/.cache/stacker) for reuse by later runs.')
+    parser.add_argument('--template-cache', default=False, action="store_true",
+                        help='Cache parsed templates on disk (under ~/.cache/stacker) for reuse by later runs.')
+    parser.add_argument('--max-pool-connections', type=int,
+                        help='How many connections each AWS client keeps open for reuse (default 10).')
+    parser.add_argument('--retry-mode', choices=['legacy', 'standard', 'adaptive'],
+                        help='How AWS clients retry failed and throttled calls (default standard). Needs botocore 1.15 '
+                             'or later, older releases always retry the legacy way.')
+    parser.add_argument('--timings', default=False, action="store_true",
+                        help='Print a JSON report of how long each phase took and the AWS calls made at the end of '
+                             'the output.')
+    parser.add_argument('--timings-file', metavar='FILE',
+                        help='Write the --timings report to FILE instead.')
+    parser.add_argument('--output', choices=['text', 'json'], default='text',
+                        help='Print text, or a line of JSON for each event: phases, changes, stack events and '
+                             'results, with anything else printed as message events (default text).')
+    parser.add_argument('--server', default=False, action="store_true",
+                        help='Send deploy, ami and status commands to a `stacker serve` instead of running them here. '
+                             'Also turned on by --server-socket or $STACKER_SERVER.')
+    parser.add_argument('--server-socket', metavar='SOCKET',
+                        help='The socket the server listens on (default $STACKER_SERVER, '
+                             'or {}).'.format(DEFAULT_SOCKET))
+    parser.add_argument('--version','-v', help="Prints the version", dest="show_version", action="version", version=__version__)
 
-        subparsers = parser.add_subparsers()
+    subparsers = parser.add_subparsers()
 
-        parser_deploy = subparsers.add_parser('deploy', help='Deploy or update a Cloudformation stack')
-        build_deploy_parser(parser_deploy)
+    parser_deploy = subparsers.add_parser('deploy', help='Deploy or update a Cloudformation stack')
+    build_deploy_parser(parser_deploy)
 
-        parser_ami = subparsers.add_parser('ami', help='Utilities for AWS AMI management.')
-        build_ami_parser(parser_ami)
+    parser_deploy_many = subparsers.add_parser('deploy-many', help='Deploy or update many Cloudformation stacks in parallel')
+    build_deploy_many_parser(parser_deploy_many)
 
-        args = parser.parse_args(argv)
+    parser_ami = subparsers.add_parser('ami', help='Utilities for AWS AMI management.')
+    build_ami_parser(parser_ami)
+
+    parser_status = subparsers.add_parser('status', help='Show the status, last update and outputs of many stacks')
+    build_status_parser(parser_status)
+
+    parser_serve = subparsers.add_parser('serve', help='Keep AWS clients, credentials and templates warm for deploy, '
+                                                       'ami and status commands sent with --server')
+    build_serve_parser(parser_serve)
+
+    return parser
+
+
+def run(args):
+    """
+    Applies the global settings and runs the sub-command.
+    """
+
+    from cf_helper.output import OutputSink
+    if OutputSink.current is not None:
+        OutputSink.current.format = args.output
+
+    if args.credential_cache:
+        from cf_helper.utils import CredentialFileCache, CredentialProvider
+        CredentialProvider.file_cache = CredentialFileCache()
+    if args.max_pool_connections is not None:
+        from cf_helper.utils import CredentialProvider
+        CredentialProvider.max_pool_connections = args.max_pool_connections
+    if args.retry_mode is not None:
+        from cf_helper.utils import CredentialProvider
+        CredentialProvider.retry_mode = args.retry_mode
+    if args.template_cache:
+        from cf_helper.templates import TemplateCache
+        from deploy import DeployExecutor
+        DeployExecutor.template_cache = TemplateCache()
+
+    timings_file = args.timings_file or ('-' if args.timings else None)
+    if timings_file is None:
         args.func(args)
+        return
+
+    from cf_helper.timings import Timings
+    from cf_helper.utils import CredentialProvider
+    from deploy import DeployExecutor
+    timings = Timings()
+    CredentialProvider.timings = timings
+    DeployExecutor.timings = timings
+
+    try:
+        args.func(args)
+    finally:
+        # Failed runs are often the ones worth looking at, so the report is written even when exiting early
+        timings.write(timings_file)
+
+        # A server runs many commands, so the next one mustn't be counted here too
+        CredentialProvider.timings = None
+        DeployExecutor.timings = None
+        timings.detach()
+
+
+def server_socket(args):
+    """
+    Returns the socket of the server to send the command to, or None to run it here.
+    """
+
+    socket_path = args.server_socket or os.environ.get('STACKER_SERVER')
+    if socket_path is None and args.server:
+        socket_path = DEFAULT_SOCKET
+    return socket_path
+
+
+def run_forwarded(argv):
+    """
+    Runs a command sent to `stacker serve`.
+    """
+
+    args = build_parser().parse_args(argv)
+    if not getattr(args, 'forward', False):
+        raise ValueError("Only deploy, ami and status commands can be sent to the server")
+
+    # Other stacks may have been deployed since the last command, so their outputs are read afresh. Decrypted
+    # secrets aren't kept from one command to the next.
+    from cf_helper.utils import CredentialProvider, KMSSecretResolver, StackOutputIndex
+    from deploy import DeployExecutor
+    StackOutputIndex.clear()
+    KMSSecretResolver.clear()
+
+    # The global flags of one command mustn't carry over to the ones after it
+    settings = [(CredentialProvider, 'file_cache'),
+                (CredentialProvider, 'max_pool_connections'),
+                (CredentialProvider, 'retry_mode'),
+                (DeployExecutor, 'template_cache')]
+    saved = [(owner, name, getattr(owner, name)) for owner, name in settings]
+    try:
+        run(args)
+    finally:
+        for owner, name, value in saved:
+            setattr(owner, name, value)
+
+
+def main(argv=None):
+
+    # Everything printed goes through the one sink, which is flushed where there is progress to show rather than
+    # on every write. It is masked on the way, so no secret decrypted during the run can end up in the output.
+    from cf_helper.output import OutputSink
+    from cf_helper.redaction import RedactingStream
+    sink = OutputSink(sys.stdout)
+    OutputSink.current = sink
+    stdout = RedactingStream(sink)
+    sys.stdout = stdout
+
+    try:
+        args = build_parser().parse_args(argv)
+
+        # Only the thin client runs here, so none of the AWS libraries are imported
+        socket_path = server_socket(args)
+        if socket_path is not None and getattr(args, 'forward', False):
+            from serve import forward
+            stdin = sys.stdin.read() if getattr(args, 'from_file', None) == '-' else None
+            sys.exit(forward(socket_path, sys.argv[1:] if argv is None else list(argv), stdin=stdin))
+
+        run(args)
 
     except Exception as error:
         traceback.print_exc(file=sys.stdout)
@@ -138,6 +525,9 @@ def main(argv=None):
         print "ERROR: {0}".format(error)
         traceback.print_exc(file=sys.stdout)
         sys.exit(1)
+    finally:
+        stdout.release()
+        sink.release()
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,142 @@
+from multiprocessing.pool import ThreadPool
+
+import botocore
+
+from cf_helper import output
+from cf_helper.utils import CloudFormationUtil, CredentialProvider, DeployException, Waiter
+
+
+class StatusExecutor(object):
+    """
+    Reports the status, last update time and outputs of every stack, or of those matching a name prefix or tags.
+
+    Stacks are read a page at a time with list_stacks and describe_stacks rather than described one by one, so an
+    account with a thousand stacks takes a handful of calls.
+    """
+
+    # When a prefix matches no more than this many stacks, describing each of them is fewer calls than paging
+    # through every stack in the region
+    MAX_SINGLE_DESCRIBES = 5
+
+    # Budget, in seconds, for retrying calls that AWS throttles
+    lookup_timeout = 60
+
+    def __init__(self, role=None, debug=False):
+        self.role = role
+        self.debug = debug
+
+    def execute(self, prefixes=None, tags=None, regions=None):
+        """
+        Prints the status of the matching stacks in each region, and returns them.
+        """
+
+        tags = parse_tag_filters(tags)
+        regions = regions or [None]
+
+        def region_status(region):
+            return self.snapshot(self.client(region), prefixes=prefixes, tags=tags, region=region)
+
+        pool = ThreadPool(processes=len(regions))
+        try:
+            snapshots = pool.map(region_status, regions)
+        finally:
+            pool.close()
+            pool.join()
+
+        stacks = [stack for snapshot in snapshots for stack in snapshot]
+        if output.structured():
+            for stack in stacks:
+                output.event('stack_status', **stack)
+        else:
+            print_status(stacks, show_region=regions != [None])
+        return stacks
+
+    def client(self, region):
+        return CloudFormationUtil(CredentialProvider(role=self.role, debug=self.debug)
+                                  .client('cloudformation', region_name=region))
+
+    def snapshot(self, cf_client, prefixes=None, tags=None, region=None):
+        """
+        Returns the status of the stacks whose names start with one of the prefixes and that have all of the tags,
+        sorted by name.
+        """
+
+        stacks = [stack for stack in self.describe(cf_client, prefixes) if has_tags(stack, tags)]
+        return sorted([stack_status(stack, region) for stack in stacks], key=lambda status: status['stack'])
+
+    def describe(self, cf_client, prefixes=None):
+        if not prefixes:
+            return list(cf_client.all_stacks(timeout=self.lookup_timeout))
+
+        # Summaries are enough to tell which stacks match, then only those are described
+        matching = [summary['StackId'] for summary in cf_client.stack_summaries(timeout=self.lookup_timeout)
+                    if summary['StackName'].startswith(tuple(prefixes))]
+        if not matching:
+            return []
+        if len(matching) > self.MAX_SINGLE_DESCRIBES:
+            matching = set(matching)
+            return [stack for stack in cf_client.all_stacks(timeout=self.lookup_timeout)
+                    if stack['StackId'] in matching]
+
+        stacks = []
+        waiter = Waiter(timeout=self.lookup_timeout)
+        for stack_id in matching:
+            try:
+                stacks += waiter.call(cf_client.describe_stacks, StackName=stack_id)['Stacks']
+            except botocore.exceptions.ClientError as error:
+                # Deleted since it was listed
+                if "does not exist" not in str(error):
+                    raise
+        return stacks
+
+
+def parse_tag_filters(tags):
+    """
+    Turns "Key=Value" and "Key" filters into a dict of tag key to value, or to None to match any value.
+    """
+
+    filters = {}
+    for tag in tags or []:
+        key, separator, value = tag.partition("=")
+        if not key:
+            raise DeployException("Tag filters must be in the format \"key=value\" or \"key\", not '{}'".format(tag))
+        filters[key] = value if separator else None
+    return filters
+
+
+def has_tags(stack, tags):
+    stack_tags = dict((tag['Key'], tag['Value']) for tag in stack.get('Tags', []))
+    for key, value in (tags or {}).items():
+        if key not in stack_tags or (value is not None and stack_tags[key] != value):
+            return False
+    return True
+
+
+def stack_status(stack, region=None):
+    last_updated = stack.get('LastUpdatedTime') or stack.get('CreationTime')
+    return {
+        'region': region,
+        'stack': stack['StackName'],
+        'status': stack['StackStatus'],
+        'reason': stack.get('StackStatusReason'),
+        'last_updated': last_updated.isoformat() if last_updated else None,
+        'outputs': dict((entry['OutputKey'], entry['OutputValue']) for entry in stack.get('Outputs', [])),
+        'tags': dict((tag['Key'], tag['Value']) for tag in stack.get('Tags', [])),
+    }
+
+
+def print_status(stacks, show_region=False):
+    if not stacks:
+        print "No matching stacks"
+        return
+
+    name_width = max(len(stack['stack']) for stack in stacks)
+    status_width = max(len(stack['status']) for stack in stacks)
+    for stack in stacks:
+        columns = [stack['stack'].ljust(name_width), stack['status'].ljust(status_width),
+                   (stack['last_updated'] or "")[:19].replace("T", " ")]
+        if show_region:
+            columns.insert(0, stack['region'])
+        print "  ".join(columns).rstrip()
+        for key, value in sorted(stack['outputs'].items()):
+            print "    {}: {}".format(key, value)
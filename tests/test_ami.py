@@ -1,9 +1,14 @@
 from unittest import TestCase
 
+import json
+import os
+import tempfile
+from StringIO import StringIO
+
 import pytest
-from mock import call, MagicMock
+from mock import call, MagicMock, patch
 
-from stacker import ami
+from stacker import ami, stacker
 from stacker.cf_helper import utils as cf_utils
 
 class AMIExecutorTest(TestCase):
@@ -107,4 +112,114 @@ class AMIExecutorTest(TestCase):
         self.assertEqual([call.describe_images(ImageIds=['ami-1234'])],
                          executor.ec2_client.mock_calls)
 
-        self.assertEqual("More than 1 image found for search 'ami-1234'", ex.value.message)
\ No newline at end of file
+        self.assertEqual("More than 1 image found for search 'ami-1234'", ex.value.message)
+
+class AMIResolverTest(TestCase):
+
+    def image(self, image_id, artifact_id):
+        return {"ImageId": image_id, "Name": "image-" + artifact_id, "CreationDate": "today",
+                "Tags": [{"Key": "ArtifactID", "Value": artifact_id}]}
+
+    def test_many_artifact_ids_resolved_in_one_call(self):
+        ec2_client = MagicMock()
+        ec2_client.describe_images = MagicMock(side_effect=[
+            {"Images": [self.image("ami-1", "app-1")], "NextToken": "page-2"},
+            {"Images": [self.image("ami-2", "app-2")]}])
+
+        resolver = cf_utils.AMIResolver(ec2_client, owners=["123456789012"])
+        found = resolver.find_by_artifact_ids(["app-1", "app-2", "app-3"])
+
+        self.assertEqual(["ami-1"], [image["ImageId"] for image in found["app-1"]])
+        self.assertEqual(["ami-2"], [image["ImageId"] for image in found["app-2"]])
+        self.assertEqual([], found["app-3"])
+        self.assertEqual([call(Owners=["123456789012"],
+                               Filters=[{"Name": "tag:ArtifactID", "Values": ["app-1", "app-2", "app-3"]}]),
+                          call(Owners=["123456789012"],
+                               Filters=[{"Name": "tag:ArtifactID", "Values": ["app-1", "app-2", "app-3"]}],
+                               NextToken="page-2")],
+                         ec2_client.describe_images.mock_calls)
+
+    def test_repeat_lookups_use_index(self):
+        ec2_client = MagicMock()
+        ec2_client.describe_images = MagicMock(return_value={"Images": [self.image("ami-1", "app-1")]})
+
+        resolver = cf_utils.AMIResolver(ec2_client)
+        resolver.find_by_artifact_ids(["app-1"])
+        image = resolver.find_one_by_artifact_id("app-1")
+
+        self.assertEqual("ami-1", image["ImageId"])
+        self.assertEqual(1, ec2_client.describe_images.call_count)
+
+    def test_index_entries_expire(self):
+        ec2_client = MagicMock()
+        ec2_client.describe_images = MagicMock(return_value={"Images": [self.image("ami-1", "app-1")]})
+
+        resolver = cf_utils.AMIResolver(ec2_client, ttl=0)
+        resolver.find_one_by_artifact_id("app-1")
+        resolver.find_one_by_artifact_id("app-1")
+
+        self.assertEqual(2, ec2_client.describe_images.call_count)
+
+    def test_misses_are_not_remembered(self):
+        ec2_client = MagicMock()
+        ec2_client.describe_images = MagicMock(side_effect=[{"Images": []},
+                                                            {"Images": [self.image("ami-1", "app-1")]}])
+
+        resolver = cf_utils.AMIResolver(ec2_client)
+        with pytest.raises(cf_utils.DeployException):
+            resolver.find_one_by_artifact_id("app-1")
+
+        self.assertEqual("ami-1", resolver.find_one_by_artifact_id("app-1")["ImageId"])
+
+
+class AMIExecutorBatchTest(TestCase):
+
+    def test_execute_many_prints_json_lines(self):
+        executor = ami.AMIExecutor(None)
+        executor.ec2_client = MagicMock()
+        executor.ec2_client.describe_images = MagicMock(side_effect=[
+            {"Images": [{"ImageId": "ami-1", "Name": "app-1", "CreationDate": "today",
+                         "Tags": [{"Key": "ArtifactID", "Value": "app-1"}]}]},
+            {"Images": [{"ImageId": "ami-2", "Name": "app-2", "CreationDate": "today"}]}])
+
+        output = StringIO()
+        with patch('sys.stdout', output):
+            all_found = executor.execute_many(artifact_ids=["app-1", "app-9"], ami_ids=["ami-2", "ami-3"])
+
+        self.assertFalse(all_found)
+        self.assertEqual([{"Search": "app-1", "SearchType": "artifact-id",
+                           "ImageId": "ami-1", "Name": "app-1", "CreationDate": "today"},
+                          {"Search": "app-9", "SearchType": "artifact-id",
+                           "Error": "No images found for search 'app-9'"},
+                          {"Search": "ami-2", "SearchType": "ami-id",
+                           "ImageId": "ami-2", "Name": "app-2", "CreationDate": "today"},
+                          {"Search": "ami-3", "SearchType": "ami-id",
+                           "Error": "No images found for search 'ami-3'"}],
+                         [json.loads(line) for line in output.getvalue().splitlines()])
+        self.assertEqual([call.describe_images(Filters=[{'Name': 'tag:ArtifactID', 'Values': ['app-1', 'app-9']}]),
+                          call.describe_images(Filters=[{'Name': 'image-id', 'Values': ['ami-2', 'ami-3']}])],
+                         executor.ec2_client.mock_calls)
+
+    def test_read_ami_searches_from_file(self):
+        searches = tempfile.NamedTemporaryFile(suffix='.txt', delete=False)
+        searches.write("ami-0abc123\n# a comment\n\napp-1\n  app-2  \n")
+        searches.close()
+
+        try:
+            ami_ids, artifact_ids = stacker.read_ami_searches(searches.name)
+        finally:
+            os.remove(searches.name)
+
+        self.assertEqual(["ami-0abc123"], ami_ids)
+        self.assertEqual(["app-1", "app-2"], artifact_ids)
+
+    def test_shared_resolver_per_client_and_owners(self):
+        ec2_client = MagicMock()
+
+        resolver = cf_utils.AMIResolver.shared(ec2_client)
+
+        self.assertIs(resolver, cf_utils.AMIResolver.shared(ec2_client, owners=[]))
+        self.assertIsNot(resolver, cf_utils.AMIResolver.shared(ec2_client, owners=["self"]))
+        self.assertIsNot(resolver, cf_utils.AMIResolver.shared(ec2_client, owners=["amazon"]))
+        self.assertIsNot(resolver, cf_utils.AMIResolver.shared(MagicMock()))
+
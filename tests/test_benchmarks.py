@@ -0,0 +1,35 @@
+from unittest import TestCase
+
+import json
+import os
+import shutil
+import tempfile
+
+from benchmarks import run
+
+
+class BenchmarksTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_quick_run_reports_every_benchmark(self):
+        output = os.path.join(self.directory, "results.json")
+
+        self.assertEqual(0, run.main(['--quick', '--latency', '0', '--output', output]))
+
+        with open(output) as output_file:
+            results = json.load(output_file)['results']
+        self.assertEqual(['cli_startup', 'deploy_execute', 'deploy_many_coroutines', 'deploy_many_threads',
+                          'parse_json_template', 'parse_yaml_template', 'resolve_secrets'], sorted(results.keys()))
+        for result in results.values():
+            self.assertLessEqual(result['min'], result['median'])
+
+    def test_compare_flags_regressions(self):
+        baseline = {'slow': {'median': 1.0}, 'steady': {'median': 1.0}}
+        results = {'slow': {'median': 1.5}, 'steady': {'median': 1.1}, 'new': {'median': 1.0}}
+
+        self.assertEqual(['slow'], run.compare(results, baseline, tolerance=0.25))
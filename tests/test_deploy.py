@@ -1,9 +1,31 @@
 from unittest import TestCase
 
+import json
 import pytest
 import os
-from mock import MagicMock
+from datetime import datetime
+from StringIO import StringIO
+
+import botocore
+from mock import MagicMock, patch
 from stacker import deploy
+from stacker.cf_helper.engine import Engine
+
+
+def mock_cf_client():
+    # Change sets have a single page, with no changes
+    cf_client = MagicMock()
+    cf_client.wait_for_change_set_to_complete = MagicMock(return_value={"Status": "CREATE_COMPLETE", "Changes": []})
+    return cf_client
+
+
+def run_coroutine(coroutine):
+    return Engine(max_concurrency=1).run_until_complete(coroutine)
+
+
+def sent_fingerprint(cf_client):
+    body = json.loads(cf_client.create_change_set.call_args[1]["TemplateBody"])
+    return body["Outputs"]["StackerFingerprint"]["Value"]
 
 
 class DeployExecutorTest(TestCase):
@@ -25,20 +47,18 @@ class DeployExecutorTest(TestCase):
     def test_deploy_with_no_config_file(self):
         executor = deploy.DeployExecutor()
 
-        executor.cf_client = MagicMock()
+        executor.cf_client = mock_cf_client()
 
         executor.cf_client.create_change_set = MagicMock()
-        executor.cf_client.wait_for_change_set_to_complete = MagicMock()
 
         executor.execute(stack_name="test-stack",template_name=self.cf_json)
 
     def test_deploy_with_json_config(self):
         executor = deploy.DeployExecutor()
 
-        executor.cf_client = MagicMock()
+        executor.cf_client = mock_cf_client()
 
         executor.cf_client.create_change_set = MagicMock()
-        executor.cf_client.wait_for_change_set_to_complete = MagicMock()
 
         executor.execute(stack_name="test-stack",template_name=self.cf_json, config_filename=self.config_json, create=True)
 
@@ -50,26 +70,359 @@ class DeployExecutorTest(TestCase):
     def test_deploy_yaml_cf_with_functions(self):
         executor = deploy.DeployExecutor()
 
-        executor.cf_client = MagicMock()
+        executor.cf_client = mock_cf_client()
 
         executor.cf_client.create_change_set = MagicMock()
-        executor.cf_client.wait_for_change_set_to_complete = MagicMock()
 
         executor.execute(stack_name="test-stack", template_name=self.cf_yaml_functions, config_filename=self.config_json, create=True)
 
         executor.cf_client.create_change_set.assert_called()
         executor.cf_client.wait_for_change_set_to_complete.assert_called()
 
+        body = json.loads(executor.cf_client.create_change_set.call_args[1]["TemplateBody"])
+        self.assertEqual({"Ref": "NewSecurityGroup"}, body["Outputs"]["SecurityGroupId"]["Value"]["Fn::If"][1])
+
     # Tests that we can parse json containing Cloudformation functions
     def test_deploy_json_cf_with_functions(self):
         executor = deploy.DeployExecutor()
 
-        executor.cf_client = MagicMock()
+        executor.cf_client = mock_cf_client()
 
         executor.cf_client.create_change_set = MagicMock()
-        executor.cf_client.wait_for_change_set_to_complete = MagicMock()
 
         executor.execute(stack_name="test-stack",template_name=self.cf_json_functions, config_filename=self.config_json, create=True)
 
         executor.cf_client.create_change_set.assert_called()
-        executor.cf_client.wait_for_change_set_to_complete.assert_called()
\ No newline at end of file
+        executor.cf_client.wait_for_change_set_to_complete.assert_called()
+
+    def test_completed_change_set_is_printed_without_describing_it_again(self):
+        executor = deploy.DeployExecutor()
+        executor.cf_client = mock_cf_client()
+
+        executor.execute(stack_name="test-stack", template_name=self.cf_json, config_filename=self.config_json,
+                         create=True)
+
+        executor.cf_client.describe_change_set.assert_not_called()
+
+    def test_small_template_sent_inline(self):
+        executor = deploy.DeployExecutor()
+        executor.cf_client = mock_cf_client()
+
+        run_coroutine(executor.get_change_set("test-stack", '{"Resources": {}}', [], "Update-1"))
+
+        executor.cf_client.create_change_set.assert_called_once_with(StackName="test-stack",
+                                                                     TemplateBody='{"Resources": {}}',
+                                                                     Parameters=[],
+                                                                     Capabilities=['CAPABILITY_IAM'],
+                                                                     ChangeSetName="Update-1")
+
+    def test_large_template_needs_bucket(self):
+        executor = deploy.DeployExecutor()
+        executor.cf_client = mock_cf_client()
+
+        with pytest.raises(deploy.DeployException):
+            run_coroutine(executor.get_change_set("test-stack", "x" * 60000, [], "Update-1"))
+
+    def test_large_template_staged_in_s3(self):
+        executor = deploy.DeployExecutor()
+        executor.cf_client = mock_cf_client()
+        executor.s3_client = MagicMock()
+        executor.s3_client.get_bucket_location = MagicMock(return_value={"LocationConstraint": None})
+        executor.template_bucket = "templates"
+        deploy.TemplateStager._regions.clear()
+
+        run_coroutine(executor.get_change_set("test-stack", "x" * 60000, [], "Create-1", create=True))
+
+        args = executor.cf_client.create_change_set.call_args[1]
+        self.assertNotIn("TemplateBody", args)
+        self.assertTrue(args["TemplateURL"].startswith("https://templates.s3.amazonaws.com/stacker/templates/"))
+        self.assertEqual("CREATE", args["ChangeSetType"])
+
+    def mock_existing_stack(self, executor, fingerprint, status="UPDATE_COMPLETE"):
+        executor.cf_client = mock_cf_client()
+        executor.cf_client.describe_stacks = MagicMock(return_value={"Stacks": [{
+            "StackName": "test-stack",
+            "StackStatus": status,
+            "Tags": [{"Key": "team", "Value": "platform"}],
+            "Outputs": [{"OutputKey": "StackerFingerprint", "OutputValue": fingerprint}]}]})
+
+    def current_fingerprint(self):
+        executor = deploy.DeployExecutor()
+        executor.cf_client = mock_cf_client()
+        executor.execute(stack_name="test-stack", template_name=self.cf_json, config_filename=self.config_json)
+        return sent_fingerprint(executor.cf_client)
+
+    def test_up_to_date_stack_is_skipped(self):
+        executor = deploy.DeployExecutor()
+        self.mock_existing_stack(executor, self.current_fingerprint())
+
+        executor.execute(stack_name="test-stack", template_name=self.cf_json, config_filename=self.config_json)
+
+        executor.cf_client.describe_stacks.assert_called_once_with(StackName="test-stack")
+        executor.cf_client.create_change_set.assert_not_called()
+
+    def test_force_deploys_up_to_date_stack(self):
+        executor = deploy.DeployExecutor()
+        self.mock_existing_stack(executor, self.current_fingerprint())
+
+        executor.execute(stack_name="test-stack", template_name=self.cf_json, config_filename=self.config_json,
+                         force=True)
+
+        executor.cf_client.create_change_set.assert_called()
+
+    def test_rolled_back_stack_is_not_skipped(self):
+        executor = deploy.DeployExecutor()
+        self.mock_existing_stack(executor, self.current_fingerprint(), status="UPDATE_ROLLBACK_COMPLETE")
+
+        executor.execute(stack_name="test-stack", template_name=self.cf_json, config_filename=self.config_json)
+
+        executor.cf_client.create_change_set.assert_called()
+
+    def test_fingerprint_hashes_ciphertexts_not_plaintexts(self):
+        deploy.KMSSecretResolver.clear()
+        self.addCleanup(deploy.KMSSecretResolver.clear)
+
+        def fingerprint(ciphertext, plaintext):
+            executor = deploy.DeployExecutor()
+            executor.cf_client = mock_cf_client()
+            executor.kms_client = MagicMock()
+            executor.kms_client.decrypt = MagicMock(return_value={"Plaintext": plaintext})
+            executor.execute(stack_name="test-stack", template_name=self.cf_json, config_filename=self.config_json,
+                             add_parameters=["DBPassword=KMSEncrypted{}/KMSEncrypted".format(ciphertext)])
+            return sent_fingerprint(executor.cf_client)
+
+        self.assertEqual(fingerprint("YWJjZGVm", "secret-one"), fingerprint("YWJjZGVm", "secret-two"))
+        self.assertNotEqual(fingerprint("YWJjZGVm", "secret-one"), fingerprint("Z2hpamts", "secret-one"))
+
+    def test_fingerprint_is_sent_as_an_output_not_a_tag(self):
+        executor = deploy.DeployExecutor()
+        self.mock_existing_stack(executor, "stale")
+
+        executor.execute(stack_name="test-stack", template_name=self.cf_json, config_filename=self.config_json)
+
+        # Stack tags are copied onto every resource, and passing them would replace the ones the stack has
+        args = executor.cf_client.create_change_set.call_args[1]
+        self.assertNotIn("Tags", args)
+        self.assertNotEqual("stale", sent_fingerprint(executor.cf_client))
+        body = json.loads(args["TemplateBody"])
+        self.assertIn("WebsiteURL", body["Outputs"])
+
+    def test_stack_output_references_are_resolved(self):
+        deploy.StackOutputIndex.clear()
+        self.addCleanup(deploy.StackOutputIndex.clear)
+        executor = deploy.DeployExecutor()
+        executor.cf_client = mock_cf_client()
+        executor.cf_client.cf_client.describe_stacks = MagicMock(return_value={"Stacks": [{
+            "StackName": "shared",
+            "Outputs": [{"OutputKey": "KeyName", "OutputValue": "shared-key"},
+                        {"OutputKey": "InstanceType", "OutputValue": "t2.large"}]}]})
+        # Outputs of the stack being deployed, read before by something else
+        index = executor.stack_output_index()
+        index._outputs["test-stack"] = {"Url": "https://old"}
+
+        executor.execute(stack_name="test-stack", template_name=self.cf_json, config_filename=self.config_json,
+                         add_parameters=["KeyName=StackOutput:shared.KeyName",
+                                         "InstanceType=StackOutput:shared.InstanceType",
+                                         "Unused=StackOutput:elsewhere.Value"], create=True)
+
+        parameters = dict((parameter["ParameterKey"], parameter["ParameterValue"])
+                          for parameter in executor.cf_client.create_change_set.call_args[1]["Parameters"])
+        self.assertEqual(("shared-key", "t2.large"), (parameters["KeyName"], parameters["InstanceType"]))
+        executor.cf_client.cf_client.describe_stacks.assert_called_once_with(StackName="shared")
+
+        # Anything deployed after it reads the deployed stack's new outputs
+        self.assertNotIn("test-stack", index._outputs)
+
+    def region_executors(self, executor, failing=()):
+        executors = {}
+
+        def for_region(region):
+            regional = deploy.DeployExecutor()
+            regional.region = region
+            regional.cf_client = mock_cf_client()
+            regional.ec2_client = MagicMock()
+            regional.kms_client = MagicMock()
+            if region in failing:
+                regional.cf_client.create_change_set = MagicMock(side_effect=deploy.DeployException("Access denied"))
+            executors[region] = regional
+            return regional
+
+        executor.kms_client = MagicMock()
+        executor.for_region = for_region
+        return executors
+
+    def test_deploy_to_many_regions(self):
+        executor = deploy.DeployExecutor()
+        executors = self.region_executors(executor)
+
+        results = executor.deploy_regions(["us-east-1", "eu-west-1"], stack_name="test-stack",
+                                          template_name=self.cf_json, config_filename=self.config_json, create=True)
+
+        self.assertEqual(["us-east-1", "eu-west-1"], [result['region'] for result in results])
+        self.assertEqual(["COMPLETE", "COMPLETE"], [result['status'] for result in results])
+        for region in ["us-east-1", "eu-west-1"]:
+            executors[region].cf_client.create_change_set.assert_called()
+            executors[region].cf_client.wait_for_deploy_to_complete.assert_called()
+
+    def test_failed_region_does_not_stop_others(self):
+        executor = deploy.DeployExecutor()
+        executors = self.region_executors(executor, failing=["eu-west-1"])
+
+        with pytest.raises(deploy.DeployException) as error:
+            executor.deploy_regions(["us-east-1", "eu-west-1"], stack_name="test-stack",
+                                    template_name=self.cf_json, config_filename=self.config_json, create=True)
+
+        self.assertIn("1 of 2 regions were not deployed: eu-west-1", str(error.value))
+        executors["us-east-1"].cf_client.wait_for_deploy_to_complete.assert_called()
+
+    def test_lines_say_which_region_they_are_from(self):
+        executor = deploy.DeployExecutor()
+        executors = self.region_executors(executor)
+
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            executor.deploy_regions(["us-east-1", "eu-west-1"], stack_name="test-stack",
+                                    template_name=self.cf_json, config_filename=self.config_json, create=True)
+
+        lines = stdout.getvalue().splitlines()
+        for region in ["us-east-1", "eu-west-1"]:
+            label = "test-stack@{}".format(region)
+            self.assertIn("[{}] Using stack parameters".format(label), lines)
+            self.assertIn("[{}] No CloudFormation changes detected".format(label), lines)
+            self.assertEqual(label, executors[region].cf_client.wait_for_deploy_to_complete.call_args[1]["label"])
+
+    def test_lines_are_not_labelled_for_a_single_deployment(self):
+        executor = deploy.DeployExecutor()
+        executor.cf_client = mock_cf_client()
+
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            executor.execute(stack_name="test-stack", template_name=self.cf_json, config_filename=self.config_json,
+                             create=True)
+
+        self.assertIn("Using stack parameters", stdout.getvalue().splitlines())
+        self.assertIsNone(executor.cf_client.wait_for_deploy_to_complete.call_args[1]["label"])
+
+    def test_for_region_copies_settings(self):
+        executor = deploy.DeployExecutor()
+        executor.role = "arn:aws:iam::123456789012:role/deploy"
+        executor.template_bucket = "templates"
+        executor.stack_timeout = 60
+
+        regional = executor.for_region("eu-west-1")
+
+        self.assertEqual("eu-west-1", regional.region)
+        self.assertEqual("arn:aws:iam::123456789012:role/deploy", regional.role)
+        self.assertEqual("templates", regional.template_bucket)
+        self.assertEqual(60, regional.stack_timeout)
+        self.assertIsNone(regional.cf_client)
+
+    def kept_change_set_executor(self, existing=None, summaries=()):
+        executor = deploy.DeployExecutor()
+        executor.keep_change_sets = True
+        executor.change_set_retention = 2
+        executor.cf_client = mock_cf_client()
+        executor.cf_client.describe_stacks = MagicMock(side_effect=botocore.exceptions.ClientError(
+            {"Error": {"Code": "ValidationError", "Message": "Stack with id test-stack does not exist"}},
+            "DescribeStacks"))
+        created = {"Status": "CREATE_COMPLETE", "ExecutionStatus": "AVAILABLE", "Changes": []}
+        if existing is None:
+            existing = botocore.exceptions.ClientError(
+                {"Error": {"Code": "ChangeSetNotFound", "Message": "ChangeSet does not exist"}}, "DescribeChangeSet")
+        else:
+            existing = dict(existing, Changes=[])
+        executor.cf_client.describe_change_set = MagicMock(side_effect=[existing])
+        executor.cf_client.wait_for_change_set_to_complete = MagicMock(return_value=created)
+        executor.cf_client.list_change_sets = MagicMock(return_value={"Summaries": list(summaries)})
+        return executor
+
+    def test_dry_run_keeps_change_set_named_from_fingerprint(self):
+        executor = self.kept_change_set_executor()
+
+        executor.execute(stack_name="test-stack", template_name=self.cf_json, config_filename=self.config_json,
+                         dry_run=True)
+
+        args = executor.cf_client.create_change_set.call_args[1]
+        self.assertEqual("Stacker-Update-" + sent_fingerprint(executor.cf_client), args["ChangeSetName"])
+        executor.cf_client.delete_change_set.assert_not_called()
+        executor.cf_client.execute_change_set.assert_not_called()
+
+    def test_deploy_executes_kept_change_set(self):
+        executor = self.kept_change_set_executor(existing={"Status": "CREATE_COMPLETE", "ExecutionStatus": "AVAILABLE"})
+
+        executor.execute(stack_name="test-stack", template_name=self.cf_json, config_filename=self.config_json)
+
+        executor.cf_client.create_change_set.assert_not_called()
+        name = executor.cf_client.describe_change_set.call_args[1]["ChangeSetName"]
+        self.assertTrue(name.startswith("Stacker-Update-"))
+        self.assertEqual(name, executor.cf_client.execute_change_set.call_args[1]["ChangeSetName"])
+
+    def test_obsolete_kept_change_set_is_replaced(self):
+        executor = self.kept_change_set_executor(existing={"Status": "CREATE_COMPLETE", "ExecutionStatus": "OBSOLETE"})
+
+        executor.execute(stack_name="test-stack", template_name=self.cf_json, config_filename=self.config_json)
+
+        name = executor.cf_client.describe_change_set.call_args[1]["ChangeSetName"]
+        executor.cf_client.delete_change_set.assert_called_once_with(ChangeSetName=name, StackName="test-stack")
+        executor.cf_client.create_change_set.assert_called()
+
+    def test_only_newest_kept_change_sets_are_retained(self):
+        summaries = [{"ChangeSetName": "Stacker-Update-{}".format(day), "CreationTime": datetime(2017, 1, day)}
+                     for day in [1, 3, 2]]
+        summaries.append({"ChangeSetName": "Update-1-0-0", "CreationTime": datetime(2016, 1, 1)})
+        executor = self.kept_change_set_executor(summaries=summaries)
+
+        executor.execute(stack_name="test-stack", template_name=self.cf_json, config_filename=self.config_json,
+                         dry_run=True)
+
+        deleted = [call[1]["ChangeSetName"] for call in executor.cf_client.delete_change_set.call_args_list]
+        self.assertEqual(["Stacker-Update-2", "Stacker-Update-1"], deleted)
+
+    def change_pages(self):
+        def change(name, action, replacement=None):
+            resource_change = {"Action": action, "LogicalResourceId": name, "ResourceType": "AWS::SNS::Topic"}
+            if replacement is not None:
+                resource_change["Replacement"] = replacement
+            return {"ResourceChange": resource_change}
+
+        yield {"StackName": "test-stack", "ChangeSetName": "Update-1", "NextToken": "page-2",
+               "Changes": [change("Topic1", "Add"), change("Topic2", "Modify", "True")]}
+        yield {"StackName": "test-stack", "ChangeSetName": "Update-1", "Changes": [change("Topic3", "Remove")]}
+
+    def printed(self, executor, pages):
+        # The first page comes with the change set, and the rest are fetched as the ones before are printed
+        pages = list(pages)
+        executor.cf_client = MagicMock()
+        executor.cf_client.describe_change_set = MagicMock(side_effect=pages[1:])
+
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            run_coroutine(executor.print_change_set("test-stack", "Update-1", pages[0]))
+
+        self.assertEqual(len(pages) - 1, executor.cf_client.describe_change_set.call_count)
+        return stdout.getvalue().splitlines()
+
+    def test_every_page_of_change_set_is_printed(self):
+        executor = deploy.DeployExecutor()
+
+        lines = self.printed(executor, self.change_pages())
+
+        self.assertEqual(1, lines.count("CloudFormation changes to apply"))
+        self.assertIn("[Modify - Full replacement]", lines[4])
+        self.assertIn("Topic3", lines[5])
+
+    def test_change_set_printed_as_json_lines(self):
+        executor = deploy.DeployExecutor()
+        executor.change_set_format = 'json'
+
+        lines = self.printed(executor, self.change_pages())
+
+        changes = [json.loads(line) for line in lines]
+        self.assertEqual(["Topic1", "Topic2", "Topic3"], [change["LogicalResourceId"] for change in changes])
+        self.assertEqual(set(["change"]), set(change["event"] for change in changes))
+        self.assertEqual("test-stack", changes[2]["stack"])
+
+    def test_empty_change_set(self):
+        executor = deploy.DeployExecutor()
+
+        lines = self.printed(executor, [{"Changes": []}])
+
+        self.assertEqual(["No CloudFormation changes detected"], lines)
+
@@ -0,0 +1,203 @@
+from unittest import TestCase
+
+import botocore
+import os
+import pytest
+from mock import MagicMock, patch
+from StringIO import StringIO
+
+from stacker import deploy_many
+from stacker.cf_helper import utils as cf_utils
+
+
+class DeployManyExecutorTest(TestCase):
+
+    cf_json = os.path.join(os.path.dirname(__file__), 'resources/cloudformation.json')
+    manifest_yaml = os.path.join(os.path.dirname(__file__), 'resources/manifest.yaml')
+
+    def create_executor(self):
+        executor = deploy_many.DeployManyExecutor(max_workers=2)
+        executor.clients.cf_client = MagicMock()
+        executor.clients.ec2_client = MagicMock()
+        executor.clients.kms_client = MagicMock()
+        return executor
+
+    def stack(self, name, depends_on=None):
+        return deploy_many.StackDefinition(name=name, template=self.cf_json, depends_on=depends_on)
+
+    def test_load_manifest_resolves_paths_relative_to_manifest(self):
+        executor = self.create_executor()
+
+        stacks = executor.load_manifest(self.manifest_yaml)
+
+        self.assertEqual(["network", "database", "app"], [stack.name for stack in stacks])
+        self.assertEqual(self.cf_json, stacks[0].template)
+        self.assertEqual(["network", "database"], stacks[2].depends_on)
+
+    def test_build_graph_orders_dependencies_first(self):
+        executor = self.create_executor()
+
+        order = executor.build_graph([self.stack("app", ["db", "network"]),
+                                      self.stack("db", ["network"]),
+                                      self.stack("network")])
+
+        self.assertEqual(["network", "db", "app"], order)
+
+    def test_build_graph_unknown_dependency(self):
+        executor = self.create_executor()
+
+        with pytest.raises(cf_utils.DeployException) as ex:
+            executor.build_graph([self.stack("app", ["missing"])])
+
+        self.assertEqual("Stack 'app' depends on 'missing' which is not in the manifest", ex.value.message)
+
+    def test_build_graph_circular_dependency(self):
+        executor = self.create_executor()
+
+        with pytest.raises(cf_utils.DeployException) as ex:
+            executor.build_graph([self.stack("a", ["b"]), self.stack("b", ["a"]), self.stack("c")])
+
+        self.assertEqual("Circular dependency between stacks: a, b", ex.value.message)
+
+    def test_stacks_share_clients_and_deploy_in_dependency_order(self):
+        executor = self.create_executor()
+        deployed = []
+
+        def record(self_, stack_name, **kwargs):
+            assert self_.cf_client is executor.clients.cf_client
+            deployed.append(stack_name)
+
+        with patch.object(deploy_many.DeployExecutor, 'deploy', autospec=True, side_effect=record):
+            results = executor.execute(self.manifest_yaml)
+
+        self.assertEqual("network", deployed[0])
+        self.assertEqual("app", deployed[-1])
+        self.assertEqual(set(["COMPLETE"]), set(result['status'] for result in results.values()))
+
+    def test_pool_sized_for_workers_without_changing_the_default(self):
+        executor = deploy_many.DeployManyExecutor(max_workers=25)
+        executor.clients.cf_client = MagicMock()
+        executor.clients.kms_client = MagicMock()
+        ec2_client = MagicMock()
+
+        with patch.object(deploy_many.DeployExecutor, 'deploy', autospec=True), \
+                patch.object(cf_utils.CredentialProvider, 'client', autospec=True, return_value=ec2_client) as client:
+            executor.execute(self.manifest_yaml)
+
+        self.assertEqual(25, client.call_args[0][0].max_pool_connections)
+        self.assertEqual(10, cf_utils.CredentialProvider.max_pool_connections)
+        self.assertEqual(25, executor._create_executor().max_pool_connections)
+
+    def test_zero_timeouts_are_kept(self):
+        executor = deploy_many.DeployManyExecutor(change_set_timeout=0, stack_timeout=0)
+
+        self.assertEqual((0, 0), (executor.change_set_timeout, executor.stack_timeout))
+        self.assertEqual(600, deploy_many.DeployManyExecutor().change_set_timeout)
+
+    def test_failed_stack_skips_dependants(self):
+        executor = self.create_executor()
+
+        def fail_network(self_, stack_name, **kwargs):
+            if stack_name == "network":
+                raise cf_utils.DeployException("boom")
+
+        with patch.object(deploy_many.DeployExecutor, 'deploy', autospec=True, side_effect=fail_network):
+            with pytest.raises(cf_utils.DeployException) as ex:
+                executor.execute(self.manifest_yaml)
+
+        self.assertEqual("3 of 3 stacks were not deployed: network, database, app", ex.value.message)
+
+    def test_coroutines_deploy_in_dependency_order(self):
+        executor = self.create_executor()
+        executor.coroutines = True
+        executor.clients.cf_client.describe_stacks = MagicMock(side_effect=botocore.exceptions.ClientError(
+            {"Error": {"Code": "ValidationError", "Message": "Stack does not exist"}}, "DescribeStacks"))
+        executor.clients.cf_client.describe_change_set = MagicMock(return_value={"Status": "CREATE_COMPLETE",
+                                                                                 "Changes": []})
+        created = []
+        executor.clients.cf_client.create_change_set = MagicMock(
+            side_effect=lambda **kwargs: created.append(kwargs["StackName"]))
+
+        def finished(*args, **kwargs):
+            yield deploy_many.Call(lambda: None)
+
+        with patch.object(deploy_many.AsyncCloudFormationUtil, 'wait_for_deploy_to_complete', side_effect=finished):
+            results = executor.execute(self.manifest_yaml)
+
+        self.assertEqual(["network", "database", "app"], created)
+        self.assertEqual(set(["COMPLETE"]), set(result['status'] for result in results.values()))
+
+    def test_coroutines_skip_dependants_of_failed_stack(self):
+        executor = self.create_executor()
+        executor.coroutines = True
+        executor.clients.cf_client.create_change_set = MagicMock(side_effect=cf_utils.DeployException("boom"))
+
+        with pytest.raises(cf_utils.DeployException) as ex:
+            executor.execute(self.manifest_yaml)
+
+        self.assertEqual("3 of 3 stacks were not deployed: network, database, app", ex.value.message)
+
+    def test_coroutines_execute_kept_change_sets(self):
+        executor = self.create_executor()
+        executor.coroutines = True
+        executor.keep_change_sets = True
+        executor.clients.cf_client.describe_stacks = MagicMock(side_effect=botocore.exceptions.ClientError(
+            {"Error": {"Code": "ValidationError", "Message": "Stack does not exist"}}, "DescribeStacks"))
+        executor.clients.cf_client.describe_change_set = MagicMock(return_value={"Status": "CREATE_COMPLETE",
+                                                                                 "ExecutionStatus": "AVAILABLE",
+                                                                                 "Changes": []})
+
+        def finished(*args, **kwargs):
+            yield deploy_many.Call(lambda: None)
+
+        with patch.object(deploy_many.AsyncCloudFormationUtil, 'wait_for_deploy_to_complete', side_effect=finished):
+            executor.execute(self.manifest_yaml)
+
+        executor.clients.cf_client.create_change_set.assert_not_called()
+        executed = [call[1]["ChangeSetName"] for call in executor.clients.cf_client.execute_change_set.call_args_list]
+        self.assertEqual(3, len(executed))
+        self.assertTrue(all(name.startswith("Stacker-Update-") for name in executed))
+
+    def test_coroutines_say_which_stack_lines_are_from(self):
+        executor = self.create_executor()
+        executor.coroutines = True
+        executor.clients.cf_client.describe_stacks = MagicMock(side_effect=botocore.exceptions.ClientError(
+            {"Error": {"Code": "ValidationError", "Message": "Stack does not exist"}}, "DescribeStacks"))
+        executor.clients.cf_client.describe_change_set = MagicMock(return_value={"Status": "CREATE_COMPLETE",
+                                                                                 "Changes": []})
+
+        def finished(*args, **kwargs):
+            yield deploy_many.Call(lambda: None)
+
+        with patch.object(deploy_many.AsyncCloudFormationUtil, 'wait_for_deploy_to_complete',
+                          side_effect=finished) as wait, patch('sys.stdout', new_callable=StringIO) as stdout:
+            executor.execute(self.manifest_yaml)
+
+        lines = stdout.getvalue().splitlines()
+        for name in ["network", "database", "app"]:
+            self.assertIn("[{}] Using stack parameters".format(name), lines)
+            self.assertIn("[{}] No CloudFormation changes detected".format(name), lines)
+        self.assertEqual(set(["network", "database", "app"]), set(call[1]["label"] for call in wait.call_args_list))
+
+    def test_coroutines_print_every_page_of_change_sets(self):
+        executor = self.create_executor()
+        executor.coroutines = True
+        executor.clients.cf_client.describe_stacks = MagicMock(side_effect=botocore.exceptions.ClientError(
+            {"Error": {"Code": "ValidationError", "Message": "Stack does not exist"}}, "DescribeStacks"))
+
+        def describe_change_set(**kwargs):
+            if "NextToken" in kwargs:
+                return {"Status": "CREATE_COMPLETE", "Changes": []}
+            return {"Status": "CREATE_COMPLETE", "Changes": [], "NextToken": "page-2"}
+
+        executor.clients.cf_client.describe_change_set = MagicMock(side_effect=describe_change_set)
+
+        def finished(*args, **kwargs):
+            yield deploy_many.Call(lambda: None)
+
+        with patch.object(deploy_many.AsyncCloudFormationUtil, 'wait_for_deploy_to_complete', side_effect=finished):
+            executor.execute(self.manifest_yaml)
+
+        pages = [call for call in executor.clients.cf_client.describe_change_set.call_args_list
+                 if call[1].get("NextToken") == "page-2"]
+        self.assertEqual(3, len(pages))
@@ -0,0 +1,170 @@
+from unittest import TestCase
+
+import threading
+import time
+
+import botocore
+import pytest
+from mock import MagicMock
+
+from stacker.cf_helper import engine as cf_engine
+from stacker.cf_helper import utils as cf_utils
+
+
+class EngineTest(TestCase):
+
+    def test_coroutines_get_call_results_and_return_values(self):
+        def add(a, b):
+            total = yield cf_engine.Call(lambda: a + b)
+            raise cf_engine.Return(total)
+
+        def main():
+            first = yield add(1, 2)
+            second = yield add(first, 3)
+            raise cf_engine.Return(second)
+
+        self.assertEqual(6, cf_engine.Engine().run_until_complete(main()))
+
+    def test_call_errors_are_raised_in_the_coroutine(self):
+        def fail():
+            raise ValueError("boom")
+
+        def main():
+            try:
+                yield cf_engine.Call(fail)
+            except ValueError as error:
+                raise cf_engine.Return("caught {}".format(error))
+
+        self.assertEqual("caught boom", cf_engine.Engine().run_until_complete(main()))
+
+    def test_sleeping_coroutines_wake_in_order(self):
+        woken = []
+
+        def sleeper(name, delay):
+            yield cf_engine.Sleep(delay)
+            woken.append(name)
+
+        engine = cf_engine.Engine()
+        engine.spawn(sleeper("slow", 0.05))
+        engine.spawn(sleeper("fast", 0.01))
+        engine.run()
+
+        self.assertEqual(["fast", "slow"], woken)
+
+    def test_tasks_wait_for_other_tasks(self):
+        engine = cf_engine.Engine()
+
+        def first():
+            yield cf_engine.Sleep(0.01)
+            raise cf_engine.Return("network")
+
+        def second(dependency):
+            name = yield dependency
+            raise cf_engine.Return(name + " then app")
+
+        dependency = engine.spawn(first())
+        task = engine.spawn(second(dependency))
+        engine.run()
+
+        self.assertEqual("network then app", task.get())
+
+    def test_failed_task_keeps_its_error(self):
+        def fail():
+            yield cf_engine.Sleep(0)
+            raise cf_utils.DeployException("boom")
+
+        engine = cf_engine.Engine()
+        task = engine.spawn(fail())
+        engine.run()
+
+        with pytest.raises(cf_utils.DeployException) as ex:
+            task.get()
+        self.assertEqual("boom", ex.value.message)
+
+    def test_calls_in_flight_are_limited(self):
+        lock = threading.Lock()
+        running = [0]
+        most = [0]
+
+        def slow_call():
+            with lock:
+                running[0] += 1
+                most[0] = max(most[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        def worker():
+            for _ in range(3):
+                yield cf_engine.Call(slow_call)
+
+        engine = cf_engine.Engine(max_concurrency=2)
+        tasks = [engine.spawn(worker()) for _ in range(10)]
+        engine.run()
+
+        self.assertTrue(all(task.done for task in tasks))
+        self.assertEqual(2, most[0])
+
+    def test_tasks_waiting_on_each_other_are_reported(self):
+        engine = cf_engine.Engine()
+        tasks = []
+
+        def wait_for_next(index):
+            yield tasks[(index + 1) % 2]
+
+        tasks.append(engine.spawn(wait_for_next(0)))
+        tasks.append(engine.spawn(wait_for_next(1)))
+
+        with pytest.raises(cf_utils.DeployException) as ex:
+            engine.run()
+        self.assertEqual("2 tasks are waiting on each other and can never finish", ex.value.message)
+
+
+class AsyncCloudFormationUtilTest(TestCase):
+
+    throttled = botocore.exceptions.ClientError({"Error": {"Code": "Throttling", "Message": "Rate exceeded"}},
+                                                "DescribeChangeSet")
+
+    def test_wait_for_change_set_returns_completed_change_set(self):
+        cf_client = MagicMock()
+        cf_client.describe_change_set = MagicMock(side_effect=[{"Status": "CREATE_PENDING"},
+                                                               self.throttled,
+                                                               {"Status": "CREATE_COMPLETE", "Changes": []}])
+        util = cf_engine.AsyncCloudFormationUtil(cf_client)
+
+        change_set = cf_engine.Engine().run_until_complete(
+            util.wait_for_change_set_to_complete("test-stack", "Update-1", min_delay=0.001, max_delay=0.01,
+                                                 debug=False))
+
+        self.assertEqual("CREATE_COMPLETE", change_set["Status"])
+        self.assertEqual(3, cf_client.describe_change_set.call_count)
+
+    def test_wait_for_deploy_raises_on_rollback(self):
+        cf_client = MagicMock()
+        cf_client.describe_stack_events = MagicMock(return_value={"StackEvents": [{
+            "EventId": "1",
+            "StackId": "stack-1",
+            "PhysicalResourceId": "stack-1",
+            "LogicalResourceId": "test-stack",
+            "ResourceType": "AWS::CloudFormation::Stack",
+            "ResourceStatus": "UPDATE_ROLLBACK_COMPLETE",
+            "ClientRequestToken": "token-1",
+            "Timestamp": cf_utils.datetime.now(cf_utils.tzutc())}]})
+        util = cf_engine.AsyncCloudFormationUtil(cf_client)
+
+        with pytest.raises(cf_utils.DeployException) as ex:
+            cf_engine.Engine().run_until_complete(
+                util.wait_for_deploy_to_complete("test-stack", client_request_token="token-1"))
+
+        self.assertEqual("Stack 'test-stack' modification failed, last status was 'UPDATE_ROLLBACK_COMPLETE'",
+                         ex.value.message)
+
+    def test_client_methods_are_proxied_as_coroutines(self):
+        cf_client = MagicMock()
+        cf_client.execute_change_set = MagicMock(return_value={"ResponseMetadata": {}})
+        util = cf_engine.AsyncCloudFormationUtil(cf_client)
+
+        result = cf_engine.Engine().run_until_complete(util.execute_change_set(ChangeSetName="Update-1"))
+
+        self.assertEqual({"ResponseMetadata": {}}, result)
+        cf_client.execute_change_set.assert_called_once_with(ChangeSetName="Update-1")
@@ -0,0 +1,112 @@
+from unittest import TestCase
+
+import json
+import os
+from StringIO import StringIO
+
+import pytest
+from mock import MagicMock, patch
+
+from stacker import deploy
+from stacker.cf_helper import output, redaction
+
+
+class OutputSinkTest(TestCase):
+
+    def setUp(self):
+        self.stream = StringIO()
+        self.stream.flush = MagicMock()
+
+    def tearDown(self):
+        output.OutputSink.current = None
+
+    def events(self):
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_text_is_passed_on_without_flushing(self):
+        sink = output.OutputSink(self.stream)
+
+        sink.write("Creating stack\n")
+        sink.event('phase', phase="load_template")
+
+        self.assertEqual("Creating stack\n", self.stream.getvalue())
+        self.stream.flush.assert_not_called()
+
+        sink.flush()
+        self.stream.flush.assert_called_once_with()
+
+    def test_labelled_text_starts_every_line_with_the_label(self):
+        self.assertEqual("[app@eu-west-1] Stack Outputs\n[app@eu-west-1]\n[app@eu-west-1]   Url: x",
+                         output.labelled("Stack Outputs\n\n  Url: x", "app@eu-west-1"))
+        self.assertEqual("Stack Outputs\n", output.labelled("Stack Outputs\n", None))
+
+    def test_json_mode_turns_lines_into_message_events(self):
+        sink = output.OutputSink(self.stream, format='json')
+
+        sink.write("first line\nsecond ")
+        sink.write("line\nunfinished")
+        sink.release()
+
+        self.assertEqual(["first line", "second line", "unfinished"],
+                         [event['message'] for event in self.events()])
+        self.assertEqual(set(['message']), set(event['event'] for event in self.events()))
+
+    def test_events_are_redacted(self):
+        sink = output.OutputSink(self.stream, format='json', redactor=redaction.Redactor(["hunter2"]))
+
+        sink.event('stack_event', stack="app", reason="Password hunter2 is too short")
+
+        self.assertEqual("Password ***** is too short", self.events()[0]['reason'])
+
+    def test_report_prints_text_or_sends_event(self):
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            output.report("Stack app is up to date", 'stack', stack="app")
+        self.assertEqual("Stack app is up to date\n", stdout.getvalue())
+
+        output.OutputSink.current = output.OutputSink(self.stream, format='json')
+        output.report("Stack app is up to date", 'stack', stack="app")
+        self.assertEqual("app", self.events()[0]['stack'])
+
+    def test_failed_phase_is_reported(self):
+        output.OutputSink.current = output.OutputSink(self.stream, format='json')
+
+        with pytest.raises(ValueError):
+            with output.phase('wait_stack', stack="app", region=None):
+                raise ValueError("boom")
+
+        event = self.events()[0]
+        self.assertEqual(("phase", "wait_stack", "FAILED", "app"),
+                         (event['event'], event['phase'], event['status'], event['stack']))
+        self.assertNotIn('region', event)
+
+
+class DeployOutputTest(TestCase):
+
+    cf_json = os.path.join(os.path.dirname(__file__), 'resources/cloudformation.json')
+    config_json = os.path.join(os.path.dirname(__file__), 'resources/config.json')
+
+    def tearDown(self):
+        output.OutputSink.current = None
+
+    def test_deploy_reports_events(self):
+        stream = StringIO()
+        output.OutputSink.current = output.OutputSink(stream, format='json')
+        executor = deploy.DeployExecutor()
+        executor.cf_client = MagicMock()
+        executor.kms_client = MagicMock()
+        executor.cf_client.wait_for_change_set_to_complete = MagicMock(return_value={
+            "StackName": "test-stack", "ChangeSetName": "Create-1", "Status": "CREATE_COMPLETE",
+            "Changes": [{"ResourceChange": {"Action": "Add", "LogicalResourceId": "Topic",
+                                            "ResourceType": "AWS::SNS::Topic"}}]})
+
+        with patch('sys.stdout', new_callable=StringIO):
+            executor.deploy(stack_name="test-stack", template_name=self.cf_json, config_filename=self.config_json,
+                            create=True)
+
+        events = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(["load_config", "kms_decrypt", "load_template", "create_change_set", "wait_change_set"],
+                         [event['phase'] for event in events if event['event'] == 'phase'][:5])
+        change = [event for event in events if event['event'] == 'change'][0]
+        self.assertEqual(("test-stack", "Topic"), (change['stack'], change['LogicalResourceId']))
+        self.assertEqual({"event": "stack", "stack": "test-stack", "status": "COMPLETE"},
+                         dict((key, value) for key, value in events[-1].items() if key != 'time'))
@@ -0,0 +1,90 @@
+from unittest import TestCase
+
+from StringIO import StringIO
+
+from stacker.cf_helper import redaction, secure_print
+
+
+class RedactorTest(TestCase):
+
+    def test_all_secrets_are_masked(self):
+        redactor = redaction.Redactor(["hunter2", "s3cr3t", ""])
+
+        self.assertEqual("password=***** key=***** ok", redactor.redact("password=hunter2 key=s3cr3t ok"))
+
+    def test_longest_secret_wins_when_secrets_overlap(self):
+        redactor = redaction.Redactor(["abc", "abcdef"])
+
+        self.assertEqual("x*****y", redactor.redact("xabcdefy"))
+
+    def test_secrets_are_matched_literally(self):
+        redactor = redaction.Redactor(["a.b*c"])
+
+        self.assertEqual("*****, axbbc", redactor.redact("a.b*c, axbbc"))
+
+    def test_no_secrets_leaves_text_alone(self):
+        self.assertEqual("nothing to hide", redaction.Redactor().redact("nothing to hide"))
+
+    def test_secure_print(self):
+        self.assertEqual('{"Password": "*****"}', secure_print('{"Password": "hunter2"}', ["hunter2"]))
+
+
+class RedactingStreamTest(TestCase):
+
+    def stream(self, secrets):
+        output = StringIO()
+        return output, redaction.RedactingStream(output, redaction.Redactor(secrets))
+
+    def test_secret_split_across_writes_is_masked(self):
+        output, stream = self.stream(["hunter2"])
+
+        for chunk in ["pass", "word=hun", "te", "r2 and more", " text\n"]:
+            stream.write(chunk)
+
+        self.assertEqual("password=***** and more text\n", output.getvalue())
+
+    def test_complete_lines_are_written_straight_away(self):
+        output, stream = self.stream(["hunter2"])
+
+        stream.write("first hunter2 line\nsecond hunt")
+
+        # Only as much as could be the start of a secret is held back
+        self.assertEqual("first ***** line\nsecon", output.getvalue())
+
+        stream.write("er2\n")
+        self.assertEqual("first ***** line\nsecond *****\n", output.getvalue())
+
+    def test_release_writes_held_back_text(self):
+        output, stream = self.stream(["hunter2"])
+
+        stream.write("no newline, hunter")
+        stream.release()
+
+        self.assertEqual("no newline, hunter", output.getvalue())
+
+    def test_secrets_spanning_lines_are_held_across_newlines(self):
+        output, stream = self.stream(["line one\nline two"])
+
+        stream.write("line one\n")
+        stream.write("line two\n")
+        stream.release()
+
+        self.assertEqual("*****\n", output.getvalue())
+
+    def test_print_goes_through_the_stream(self):
+        output, stream = self.stream(["hunter2"])
+
+        print >>stream, "the password is", "hunter2"
+
+        self.assertEqual("the password is *****\n", output.getvalue())
+
+    def test_secrets_added_later_are_masked(self):
+        redactor = redaction.Redactor()
+        output = StringIO()
+        stream = redaction.RedactingStream(output, redactor)
+
+        stream.write("before hunter2\n")
+        redactor.add(["hunter2"])
+        stream.write("after hunter2\n")
+
+        self.assertEqual("before hunter2\nafter *****\n", output.getvalue())
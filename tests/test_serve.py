@@ -0,0 +1,179 @@
+from unittest import TestCase
+
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+from StringIO import StringIO
+
+import pytest
+from mock import patch
+
+from stacker import serve, stacker
+from stacker.cf_helper import redaction
+
+
+class StackerServerTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, "sockets", "server.sock")
+        self.commands = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def command(self, argv):
+        self.commands.append((argv, os.getcwd(), sys.stdin.read() if "-" in argv else None))
+        if argv[0] == "fail":
+            raise ValueError("boom")
+        print "ran", " ".join(argv)
+        if argv[0] == "exit":
+            sys.exit(3)
+
+    def start(self):
+        server = serve.StackerServer(self.socket_path, self.command)
+        thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.01})
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            thread.join()
+            server.close()
+
+        self.addCleanup(stop)
+        return server
+
+    def forward(self, argv, stdin=None):
+        # The server runs in this process and swaps sys.stdout while it runs a command, so don't write there
+        output = StringIO()
+        code = serve.forward(self.socket_path, argv, stdin=stdin, output=output)
+        return code, output.getvalue()
+
+    def test_command_output_and_exit_code_are_sent_back(self):
+        self.start()
+
+        self.assertEqual((0, "ran deploy --name app\n"), self.forward(["deploy", "--name", "app"]))
+        self.assertEqual((3, "ran exit\n"), self.forward(["exit"]))
+
+    def test_command_runs_in_the_clients_directory_with_its_stdin(self):
+        self.start()
+
+        self.forward(["ami", "--from-file", "-"], stdin="ami-12345678\n")
+
+        self.assertEqual([(["ami", "--from-file", "-"], os.getcwd(), "ami-12345678\n")], self.commands)
+
+    def test_failed_command_reports_error(self):
+        self.start()
+
+        code, output = self.forward(["fail"])
+
+        self.assertEqual(1, code)
+        self.assertIn("ERROR: boom", output)
+
+    def test_secrets_are_masked_in_output(self):
+        self.start()
+        redaction.REDACTOR.add(["deploy-many-secret"])
+
+        code, output = self.forward(["deploy", "deploy-many-secret"])
+
+        self.assertEqual("ran deploy *****\n", output)
+
+    def test_secrets_are_forgotten_after_each_command(self):
+        def decrypting_command(argv):
+            redaction.REDACTOR.add([argv[1]])
+            print "ran", " ".join(argv)
+
+        self.command = decrypting_command
+        self.start()
+
+        self.assertEqual((0, "ran deploy *****\n"), self.forward(["deploy", "secret-a"]))
+        self.assertNotIn("secret-a", redaction.REDACTOR.secrets)
+        self.assertEqual((0, "ran deploy *****\n"), self.forward(["deploy", "secret-b"]))
+        self.assertEqual(set(), redaction.REDACTOR.secrets)
+        self.assertIsNone(redaction.REDACTOR.pattern)
+
+    def test_command_runs_with_the_senders_aws_environment(self):
+        server = serve.StackerServer(self.socket_path, lambda argv: self.commands.append(
+            (os.environ.get('AWS_PROFILE'), os.environ.get('AWS_REGION'))))
+        self.addCleanup(server.close)
+
+        with patch.dict(os.environ, {'AWS_PROFILE': 'dev', 'AWS_REGION': 'us-east-1'}):
+            server.run({'argv': ["deploy"], 'cwd': os.getcwd(), 'environment': {'AWS_PROFILE': 'prod'}}, StringIO())
+
+            self.assertEqual([('prod', None)], self.commands)
+            self.assertEqual(('dev', 'us-east-1'), (os.environ['AWS_PROFILE'], os.environ['AWS_REGION']))
+
+    def test_socket_is_private(self):
+        self.start()
+
+        self.assertEqual(0, os.stat(self.socket_path).st_mode & 0077)
+
+    def test_stale_socket_is_replaced(self):
+        stale = serve.StackerServer(self.socket_path, self.command)
+        stale.server_close()
+
+        self.start()
+
+        self.assertEqual(0, self.forward(["deploy"])[0])
+
+    def test_second_server_is_refused(self):
+        self.start()
+
+        with pytest.raises(socket.error):
+            serve.StackerServer(self.socket_path, self.command)
+
+    def test_unreachable_server(self):
+        code, output = self.forward(["deploy"])
+
+        self.assertEqual(1, code)
+        self.assertIn("Can't reach a stacker server", output)
+
+
+class RunForwardedTest(TestCase):
+
+    def test_global_flags_do_not_carry_over(self):
+        from stacker import deploy
+        from stacker.cf_helper.utils import CredentialProvider
+        applied = []
+
+        def execute_deploy(args):
+            applied.append((CredentialProvider.retry_mode, CredentialProvider.max_pool_connections,
+                            deploy.DeployExecutor.template_cache is not None))
+
+        with patch.object(stacker, 'execute_deploy', side_effect=execute_deploy):
+            stacker.run_forwarded(["--retry-mode", "adaptive", "--max-pool-connections", "50", "--template-cache",
+                                   "deploy", "--name", "app", "--template", "app.yaml"])
+
+        self.assertEqual([("adaptive", 50, True)], applied)
+        self.assertEqual(("standard", 10, None), (CredentialProvider.retry_mode,
+                                                  CredentialProvider.max_pool_connections,
+                                                  deploy.DeployExecutor.template_cache))
+
+    def test_only_deploy_and_ami_are_forwarded(self):
+        with pytest.raises(ValueError):
+            stacker.run_forwarded(["deploy-many", "--manifest", "manifest.yaml"])
+
+
+class ServerOptionTest(TestCase):
+
+    def parse(self, *argv):
+        return stacker.build_parser().parse_args(list(argv) + ['deploy', '--name', 'app', '--template', 'app.yaml'])
+
+    def test_server_flag_before_sub_command(self):
+        args = self.parse('--server')
+
+        self.assertEqual('app', args.name)
+        with patch.dict(os.environ, clear=True):
+            self.assertEqual(stacker.DEFAULT_SOCKET, stacker.server_socket(args))
+
+    def test_server_socket(self):
+        with patch.dict(os.environ, {'STACKER_SERVER': '/tmp/env.sock'}):
+            self.assertEqual('/tmp/other.sock', stacker.server_socket(self.parse('--server-socket', '/tmp/other.sock')))
+            self.assertEqual('/tmp/env.sock', stacker.server_socket(self.parse()))
+
+    def test_runs_here_by_default(self):
+        with patch.dict(os.environ, clear=True):
+            self.assertIsNone(stacker.server_socket(self.parse()))
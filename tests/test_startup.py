@@ -0,0 +1,48 @@
+from unittest import TestCase
+
+import json
+import os
+import subprocess
+import sys
+
+
+class StartupTest(TestCase):
+
+    # Slow to import, so only the sub-commands that need them should. Checking for them rather than timing the
+    # import keeps the test reliable on slow or busy machines.
+    HEAVY_MODULES = ['boto3', 'botocore', 'yaml', 'pkg_resources']
+
+    def run_cli(self, *argv):
+        script = "\n".join([
+            "import json, sys",
+            "from stacker import main",
+            "imported = [m for m in %r if m in sys.modules]" % self.HEAVY_MODULES,
+            "try:",
+            "    main(%r)" % list(argv),
+            "except SystemExit:",
+            "    pass",
+            "modules = [m for m in %r if m in sys.modules]" % self.HEAVY_MODULES,
+            "sys.stderr.write(json.dumps({'imported': imported, 'modules': modules}))",
+        ])
+
+        process = subprocess.Popen([sys.executable, '-c', script],
+                                   cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+
+        return stdout + stderr, json.loads(stderr.splitlines()[-1])
+
+    def test_version_does_not_import_sub_commands(self):
+        output, result = self.run_cli('--version')
+
+        self.assertIn("0.1.0", output)
+        self.assertEqual([], result['imported'])
+        self.assertEqual([], result['modules'])
+
+    def test_help_does_not_import_sub_commands(self):
+        output, result = self.run_cli('deploy', '--help')
+
+        self.assertIn("--template", output)
+        self.assertEqual([], result['imported'])
+        self.assertEqual([], result['modules'])
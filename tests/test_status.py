@@ -0,0 +1,118 @@
+from unittest import TestCase
+
+import json
+from datetime import datetime
+from StringIO import StringIO
+
+import botocore
+import pytest
+from mock import call, MagicMock, patch
+
+from stacker import status
+from stacker.cf_helper import output
+from stacker.cf_helper import utils as cf_utils
+
+
+def mock_stack(name, stack_status="UPDATE_COMPLETE", tags=None, outputs=None):
+    return {"StackId": "arn:aws:cloudformation:us-east-1:12345:stack/{}/1".format(name),
+            "StackName": name,
+            "StackStatus": stack_status,
+            "CreationTime": datetime(2026, 1, 1, 9, 30),
+            "LastUpdatedTime": datetime(2026, 10, 1, 12, 0, 5),
+            "Tags": [{"Key": key, "Value": value} for key, value in sorted((tags or {}).items())],
+            "Outputs": [{"OutputKey": key, "OutputValue": value} for key, value in sorted((outputs or {}).items())]}
+
+
+class StatusExecutorTest(TestCase):
+
+    def setUp(self):
+        self.stacks = [mock_stack("app-web", tags={"team": "web"}, outputs={"Url": "https://app"}),
+                       mock_stack("app-db", "UPDATE_ROLLBACK_FAILED", tags={"team": "data"}),
+                       mock_stack("other")]
+
+        self.cf_client = MagicMock()
+        self.cf_client.list_stacks = MagicMock(return_value={"StackSummaries": [
+            dict((key, stack[key]) for key in ("StackId", "StackName", "StackStatus")) for stack in self.stacks]})
+        self.cf_client.describe_stacks = MagicMock(side_effect=self.describe_stacks)
+        self.executor = status.StatusExecutor()
+        self.executor.client = MagicMock(return_value=cf_utils.CloudFormationUtil(self.cf_client))
+
+    def tearDown(self):
+        output.OutputSink.current = None
+
+    def describe_stacks(self, StackName=None, NextToken=None):
+        if StackName:
+            return {"Stacks": [stack for stack in self.stacks if stack["StackId"] == StackName]}
+        if NextToken is None:
+            return {"Stacks": self.stacks[:2], "NextToken": "page-2"}
+        return {"Stacks": self.stacks[2:]}
+
+    def test_every_stack_is_described_a_page_at_a_time(self):
+        stacks = self.executor.snapshot(self.executor.client())
+
+        self.assertEqual(["app-db", "app-web", "other"], [stack['stack'] for stack in stacks])
+        self.assertEqual({"stack": "app-web", "status": "UPDATE_COMPLETE", "region": None, "reason": None,
+                          "last_updated": "2026-10-01T12:00:05", "outputs": {"Url": "https://app"},
+                          "tags": {"team": "web"}}, stacks[1])
+        self.assertEqual([call(), call(NextToken="page-2")], self.cf_client.describe_stacks.mock_calls)
+        self.cf_client.list_stacks.assert_not_called()
+
+    def test_prefix_matching_few_stacks_describes_only_those(self):
+        stacks = self.executor.snapshot(self.executor.client(), prefixes=["app-"])
+
+        self.assertEqual(["app-db", "app-web"], [stack['stack'] for stack in stacks])
+        self.assertEqual([call(StackName=self.stacks[0]["StackId"]), call(StackName=self.stacks[1]["StackId"])],
+                         self.cf_client.describe_stacks.mock_calls)
+
+    def test_prefix_matching_many_stacks_pages_through_them_all(self):
+        self.executor.MAX_SINGLE_DESCRIBES = 1
+
+        stacks = self.executor.snapshot(self.executor.client(), prefixes=["app-"])
+
+        self.assertEqual(["app-db", "app-web"], [stack['stack'] for stack in stacks])
+        self.assertEqual([call(), call(NextToken="page-2")], self.cf_client.describe_stacks.mock_calls)
+
+    def test_prefix_matching_nothing_describes_nothing(self):
+        self.assertEqual([], self.executor.snapshot(self.executor.client(), prefixes=["missing-"]))
+        self.cf_client.describe_stacks.assert_not_called()
+
+    def test_stack_deleted_after_it_was_listed_is_skipped(self):
+        missing = botocore.exceptions.ClientError(
+            {"Error": {"Code": "ValidationError", "Message": "Stack with id app-db does not exist"}}, "DescribeStacks")
+        self.cf_client.describe_stacks = MagicMock(side_effect=[{"Stacks": [self.stacks[0]]}, missing])
+
+        stacks = self.executor.snapshot(self.executor.client(), prefixes=["app-"])
+
+        self.assertEqual(["app-web"], [stack['stack'] for stack in stacks])
+
+    def test_tags_filter_stacks(self):
+        self.assertEqual(["app-db"], [stack['stack'] for stack in
+                                      self.executor.snapshot(self.executor.client(), tags={"team": "data"})])
+        self.assertEqual(["app-db", "app-web"], [stack['stack'] for stack in
+                                                 self.executor.snapshot(self.executor.client(), tags={"team": None})])
+
+    def test_tag_filters_are_parsed(self):
+        self.assertEqual({"team": "web", "env": None, "note": "a=b"},
+                         status.parse_tag_filters(["team=web", "env", "note=a=b"]))
+
+        with pytest.raises(cf_utils.DeployException):
+            status.parse_tag_filters(["=web"])
+
+    def test_text_output(self):
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            self.executor.execute(prefixes=["app-"])
+
+        self.assertEqual("app-db   UPDATE_ROLLBACK_FAILED  2026-10-01 12:00:05\n"
+                         "app-web  UPDATE_COMPLETE         2026-10-01 12:00:05\n"
+                         "    Url: https://app\n", stdout.getvalue())
+
+    def test_json_output(self):
+        stream = StringIO()
+        output.OutputSink.current = output.OutputSink(stream, format='json')
+
+        self.executor.execute(tags=["team=web"], regions=["us-east-1", "eu-west-1"])
+
+        events = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([("stack_status", "us-east-1", "app-web"), ("stack_status", "eu-west-1", "app-web")],
+                         [(event['event'], event['region'], event['stack']) for event in events])
+        self.assertEqual({"Url": "https://app"}, events[0]['outputs'])
@@ -0,0 +1,151 @@
+from unittest import TestCase
+
+import json
+import os
+import shutil
+import stat
+import tempfile
+
+from mock import MagicMock
+
+from stacker.cf_helper import templates
+
+
+class TemplateLoaderTest(TestCase):
+
+    cf_yaml_functions = os.path.join(os.path.dirname(__file__), 'resources/cf_functions.yaml')
+
+    def test_load_yaml_with_short_form_functions(self):
+        with open(self.cf_yaml_functions) as template_file:
+            cloudformation = templates.load_yaml(template_file)
+
+        self.assertEqual(["ExistingSecurityGroup"], cloudformation["Parameters"].keys())
+        self.assertIn("NewSecurityGroup", cloudformation["Resources"])
+
+    def test_short_form_functions_become_long_form(self):
+        with open(self.cf_yaml_functions) as template_file:
+            cloudformation = templates.load_yaml(template_file)
+
+        self.assertEqual({"Fn::If": ["CreateNewSecurityGroup", {"Ref": "NewSecurityGroup"},
+                                     {"Ref": "ExistingSecurityGroup"}]},
+                         cloudformation["Outputs"]["SecurityGroupId"]["Value"])
+        self.assertEqual({"Fn::Or": [{"Fn::Equals": [{"Ref": "ASecurityGroup"}, "sg-123456"]},
+                                     {"Condition": "CreateNewSecurityGroup"}]},
+                         cloudformation["Conditions"]["MyOrCondition"])
+
+    def test_get_att_short_form_split_into_resource_and_attribute(self):
+        cloudformation = templates.load_yaml("Value: !GetAtt Database.Endpoint.Address\n"
+                                             "Zones: !GetAZs ''\n"
+                                             "Name: !Sub\n  - '${Name}-db'\n  - Name: !Ref Name\n")
+
+        self.assertEqual({"Fn::GetAtt": ["Database", "Endpoint.Address"]}, cloudformation["Value"])
+        self.assertEqual({"Fn::GetAZs": ""}, cloudformation["Zones"])
+        self.assertEqual({"Fn::Sub": ["${Name}-db", {"Name": {"Ref": "Name"}}]}, cloudformation["Name"])
+
+
+class SerializeTest(TestCase):
+
+    def test_compact_json_with_sorted_keys(self):
+        self.assertEqual('{"A":[1,{"Ref":"B"}],"B":"x"}', templates.serialize({"B": "x", "A": [1, {"Ref": "B"}]}))
+
+    def test_yaml_dates_sent_as_strings(self):
+        cloudformation = templates.load_yaml("AWSTemplateFormatVersion: 2010-09-09\n")
+
+        self.assertEqual('{"AWSTemplateFormatVersion":"2010-09-09"}', templates.serialize(cloudformation))
+
+    def test_same_source_parsed_once(self):
+        templates.Template.clear()
+        parse = MagicMock(return_value={"Resources": {}})
+
+        first = templates.Template.load('{"Resources": {}}', parse)
+        second = templates.Template.load('{"Resources": {}}', parse)
+
+        self.assertIs(first, second)
+        self.assertEqual('{"Resources":{}}', first.body)
+        self.assertEqual(1, parse.call_count)
+
+
+class TemplateCacheTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = templates.TemplateCache(path=os.path.join(self.directory, 'cache'))
+        self.template = os.path.join(self.directory, 'template.json')
+        self.write_template('{"Resources": {}}')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_template(self, content, mtime=1000):
+        with open(self.template, 'w') as template_file:
+            template_file.write(content)
+        os.utime(self.template, (mtime, mtime))
+
+    def parser(self):
+        return MagicMock(side_effect=lambda content: templates.Template(json.loads(content)))
+
+    def entry_files(self):
+        return [os.path.join(self.cache.path, name) for name in os.listdir(self.cache.path)]
+
+    def test_unchanged_template_not_parsed_again(self):
+        parse = self.parser()
+
+        first = self.cache.load(self.template, parse)
+        second = templates.TemplateCache(path=self.cache.path).load(self.template, parse)
+
+        self.assertEqual({"Resources": {}}, first.data)
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(first.body, second.body)
+        self.assertEqual(1, parse.call_count)
+
+    def test_entries_are_json(self):
+        self.cache.load(self.template, self.parser())
+
+        with open(self.entry_files()[0]) as entry_file:
+            entry = json.load(entry_file)
+        self.assertEqual('{"Resources":{}}', entry['body'])
+        self.assertEqual(templates.TemplateCache.VERSION, entry['version'])
+
+    def test_entries_that_are_not_json_are_ignored(self):
+        parse = self.parser()
+        self.cache.load(self.template, parse)
+        with open(self.entry_files()[0], 'wb') as entry_file:
+            entry_file.write("cos\nsystem\n(S'exit 1'\ntR.")
+
+        self.assertEqual({"Resources": {}}, self.cache.load(self.template, parse).data)
+        self.assertEqual(2, parse.call_count)
+
+    def test_existing_cache_directory_made_private(self):
+        os.makedirs(self.cache.path, 0777)
+        os.chmod(self.cache.path, 0777)
+
+        self.cache.load(self.template, self.parser())
+
+        self.assertEqual(0700, stat.S_IMODE(os.stat(self.cache.path).st_mode))
+
+    def test_touched_template_with_same_content_not_parsed_again(self):
+        parse = self.parser()
+
+        self.cache.load(self.template, parse)
+        self.write_template('{"Resources": {}}', mtime=2000)
+        self.cache.load(self.template, parse)
+
+        self.assertEqual(1, parse.call_count)
+
+    def test_changed_template_parsed_again(self):
+        parse = self.parser()
+
+        self.cache.load(self.template, parse)
+        self.write_template('{"Resources": {"Queue": {}}}', mtime=2000)
+
+        self.assertEqual({"Resources": {"Queue": {}}}, self.cache.load(self.template, parse).data)
+        self.assertEqual(2, parse.call_count)
+
+    def test_changed_template_with_same_time_and_size_parsed_again(self):
+        parse = self.parser()
+
+        self.cache.load(self.template, parse)
+        self.write_template('{"Resources": []}')
+
+        self.assertEqual({"Resources": []}, self.cache.load(self.template, parse).data)
+        self.assertEqual(2, parse.call_count)
@@ -0,0 +1,129 @@
+from unittest import TestCase
+
+import json
+import os
+import shutil
+import tempfile
+
+import pytest
+from botocore.hooks import HierarchicalEmitter
+from mock import MagicMock
+
+from stacker import deploy, stacker
+from stacker.cf_helper import timings as cf_timings
+
+
+class TimingsTest(TestCase):
+
+    def emit(self, client, event, operation="DescribeStacks", **kwargs):
+        client.meta.events.emit("{}.cloudformation.{}".format(event, operation), **kwargs)
+
+    def test_spans_are_recorded_with_labels(self):
+        timings = cf_timings.Timings()
+
+        with timings.span('load_template', template="app.yaml", region=None):
+            pass
+        with pytest.raises(ValueError):
+            with timings.span('wait_stack', stack="app"):
+                raise ValueError("boom")
+
+        report = timings.report()
+        self.assertEqual(["load_template", "wait_stack"], [entry['phase'] for entry in report['phases']])
+        self.assertEqual("app.yaml", report['phases'][0]['template'])
+        self.assertNotIn("region", report['phases'][0])
+        self.assertEqual(set(["load_template", "wait_stack"]), set(report['phase_totals'].keys()))
+
+    def test_calls_retries_and_throttles_are_counted_per_operation(self):
+        timings = cf_timings.Timings()
+        client = MagicMock()
+        client.meta.events = HierarchicalEmitter()
+        timings.attach(client)
+        timings.attach(client)
+
+        context = {}
+        self.emit(client, 'before-call', context=context)
+        self.emit(client, 'before-send')
+        self.emit(client, 'needs-retry', response=(None, {'Error': {'Code': 'Throttling'}}))
+        self.emit(client, 'before-send')
+        self.emit(client, 'needs-retry', response=(None, {}))
+        self.emit(client, 'after-call', context=context)
+
+        self.emit(client, 'before-call', operation="CreateChangeSet", context={})
+        self.emit(client, 'before-send', operation="CreateChangeSet")
+        self.emit(client, 'after-call-error', operation="CreateChangeSet", context={})
+
+        create, describe = timings.report()['operations']
+        self.assertEqual(("cloudformation", "DescribeStacks", 1, 1, 1, 0),
+                         (describe['service'], describe['operation'], describe['calls'], describe['retries'],
+                          describe['throttles'], describe['errors']))
+        self.assertEqual(("CreateChangeSet", 1, 0, 1), (create['operation'], create['calls'], create['retries'],
+                                                        create['errors']))
+
+    def test_detached_timings_stop_counting(self):
+        timings = cf_timings.Timings()
+        client = MagicMock()
+        client.meta.events = HierarchicalEmitter()
+        timings.attach(client)
+        timings.detach()
+
+        later = cf_timings.Timings()
+        later.attach(client)
+        self.emit(client, 'before-call', context={})
+
+        self.assertEqual([], timings.report()['operations'])
+        self.assertEqual(1, later.report()['operations'][0]['calls'])
+
+    def test_write_report_to_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "timings.json")
+            timings = cf_timings.Timings()
+            with timings.span('load_config'):
+                pass
+
+            timings.write(filename)
+
+            with open(filename) as report_file:
+                self.assertEqual("load_config", json.load(report_file)['phases'][0]['phase'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_span_without_timings_does_nothing(self):
+        with cf_timings.span(None, 'load_config'):
+            pass
+
+
+class DeployTimingsTest(TestCase):
+
+    cf_json = os.path.join(os.path.dirname(__file__), 'resources/cloudformation.json')
+    config_json = os.path.join(os.path.dirname(__file__), 'resources/config.json')
+
+    def test_deploy_phases_are_timed(self):
+        executor = deploy.DeployExecutor()
+        executor.timings = cf_timings.Timings()
+        executor.cf_client = MagicMock()
+        executor.cf_client.wait_for_change_set_to_complete = MagicMock(return_value={"Status": "CREATE_COMPLETE", "Changes": []})
+        executor.kms_client = MagicMock()
+
+        executor.deploy(stack_name="test-stack", template_name=self.cf_json, config_filename=self.config_json,
+                        create=True)
+
+        phases = [entry['phase'] for entry in executor.timings.report()['phases']]
+        self.assertEqual(["load_config", "kms_decrypt", "load_template", "create_change_set", "wait_change_set",
+                          "execute_change_set", "wait_stack"], phases)
+
+
+class TimingsOptionTest(TestCase):
+
+    def test_timings_flag_before_sub_command(self):
+        args = stacker.build_parser().parse_args(['--timings', 'deploy', '--name', 'app', '--template', 'app.yaml'])
+
+        self.assertTrue(args.timings)
+        self.assertIsNone(args.timings_file)
+        self.assertEqual('app', args.name)
+
+    def test_timings_file(self):
+        args = stacker.build_parser().parse_args(['--timings-file', 'timings.json', 'deploy', '--name', 'app',
+                                                  '--template', 'app.yaml'])
+
+        self.assertEqual('timings.json', args.timings_file)
@@ -0,0 +1,561 @@
+from unittest import TestCase
+
+import base64
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+from datetime import datetime, timedelta
+from StringIO import StringIO
+
+import botocore
+import pytest
+from dateutil.tz import tzutc
+from mock import call, MagicMock, patch
+
+from stacker.cf_helper import utils as cf_utils
+
+
+def mock_assume_role_response(expires_in=timedelta(hours=1)):
+    return {"Credentials": {"AccessKeyId": "AKIAEXAMPLE",
+                            "SecretAccessKey": "secret",
+                            "SessionToken": "token",
+                            "Expiration": datetime.now(tzutc()) + expires_in}}
+
+
+class LRUCacheTest(TestCase):
+
+    def test_least_recently_used_entry_is_forgotten(self):
+        cache = cf_utils.LRUCache(max_entries=2)
+        cache["a"] = 1
+        cache["b"] = 2
+
+        self.assertEqual(1, cache.get("a"))
+        cache["c"] = 3
+
+        self.assertNotIn("b", cache)
+        self.assertEqual([1, 3], cache.values())
+        self.assertEqual(2, len(cache))
+
+
+class CredentialProviderTest(TestCase):
+
+    role = "arn:aws:iam::12345:role/deploy"
+
+    def setUp(self):
+        cf_utils.CredentialProvider.clear()
+
+    def tearDown(self):
+        cf_utils.CredentialProvider.clear()
+
+    def test_role_is_assumed_once_for_all_clients(self):
+        with patch.object(cf_utils.STSUtil, 'authenticate_role', return_value=mock_assume_role_response()) as assume:
+            cf_utils.CredentialProvider(role=self.role).client('ec2', region_name='us-east-1')
+            cf_utils.CredentialProvider(role=self.role).client('cloudformation', region_name='us-east-1')
+            kms = cf_utils.CredentialProvider(role=self.role).client('kms', region_name='us-east-1')
+
+        self.assertEqual(1, assume.call_count)
+        self.assertEqual("AKIAEXAMPLE", kms._request_signer._credentials.access_key)
+
+    def test_sessions_are_cached_per_role(self):
+        with patch.object(cf_utils.STSUtil, 'authenticate_role', return_value=mock_assume_role_response()) as assume:
+            first = cf_utils.CredentialProvider(role=self.role).session()
+            second = cf_utils.CredentialProvider(role="arn:aws:iam::12345:role/other").session()
+
+            self.assertIsNot(first, second)
+            self.assertIs(first, cf_utils.CredentialProvider(role=self.role).session())
+
+        self.assertEqual(2, assume.call_count)
+
+    def test_credentials_are_refreshed_before_expiry(self):
+        responses = [mock_assume_role_response(timedelta(minutes=5)), mock_assume_role_response()]
+        with patch.object(cf_utils.STSUtil, 'authenticate_role', side_effect=responses) as assume:
+            session = cf_utils.CredentialProvider(role=self.role).session()
+            session.get_credentials().get_frozen_credentials()
+
+        self.assertEqual(2, assume.call_count)
+
+    def test_clients_are_shared_per_service_and_region(self):
+        provider = cf_utils.CredentialProvider()
+
+        client = provider.client('cloudformation', region_name='us-east-1')
+
+        self.assertIs(client, cf_utils.CredentialProvider().client('cloudformation', region_name='us-east-1'))
+        self.assertIs(client, provider.client('cloudformation'))
+        self.assertIsNot(client, provider.client('cloudformation', region_name='eu-west-1'))
+        self.assertIsNot(client, provider.client('ec2', region_name='us-east-1'))
+
+    def test_clients_use_tuned_config(self):
+        with patch.object(cf_utils.CredentialProvider, 'max_pool_connections', 50):
+            client = cf_utils.CredentialProvider().client('ec2', region_name='us-east-1')
+
+        self.assertEqual(50, client.meta.config.max_pool_connections)
+        self.assertEqual(60, client.meta.config.read_timeout)
+        self.assertEqual('standard', client.meta.config.retries['mode'])
+
+    def test_retry_mode_left_out_for_botocore_without_it(self):
+        with patch.object(cf_utils.botocore, '__version__', '1.14.17'):
+            config = cf_utils.CredentialProvider().config()
+
+        self.assertEqual({'max_attempts': 5}, config.retries)
+        self.assertEqual('standard', cf_utils.CredentialProvider().config().retries['mode'])
+
+        # The retries option itself only arrived in botocore 1.6
+        with patch.object(cf_utils.botocore, '__version__', '1.5.95'):
+            config = cf_utils.CredentialProvider().config()
+
+        self.assertIsNone(config.retries)
+        self.assertEqual(10, config.max_pool_connections)
+
+    def test_clients_are_made_again_when_settings_change(self):
+        client = cf_utils.CredentialProvider().client('ec2', region_name='us-east-1')
+
+        with patch.object(cf_utils.CredentialProvider, 'max_pool_connections', 50):
+            bigger = cf_utils.CredentialProvider().client('ec2', region_name='us-east-1')
+
+        self.assertIsNot(client, bigger)
+        self.assertEqual(50, bigger.meta.config.max_pool_connections)
+        self.assertIs(client, cf_utils.CredentialProvider().client('ec2', region_name='us-east-1'))
+
+    def test_sessions_are_kept_per_aws_environment(self):
+        with patch.dict(os.environ, {'AWS_DEFAULT_REGION': 'us-east-1'}):
+            first = cf_utils.CredentialProvider().session()
+        with patch.dict(os.environ, {'AWS_DEFAULT_REGION': 'eu-west-1'}):
+            second = cf_utils.CredentialProvider().session()
+            client = cf_utils.CredentialProvider().client('cloudformation')
+
+        self.assertIsNot(first, second)
+        self.assertEqual('eu-west-1', client.meta.region_name)
+
+    def test_clients_with_extra_arguments_are_not_shared(self):
+        provider = cf_utils.CredentialProvider()
+
+        client = provider.client('s3', region_name='us-east-1', endpoint_url='http://localhost:9000')
+
+        self.assertEqual('http://localhost:9000', client.meta.endpoint_url)
+        self.assertIsNot(client, provider.client('s3', region_name='us-east-1'))
+
+    def test_no_role_uses_default_session(self):
+        with patch.object(cf_utils.STSUtil, 'authenticate_role') as assume:
+            session = cf_utils.CredentialProvider().session()
+
+        self.assertIs(session, cf_utils.CredentialProvider().session())
+        assume.assert_not_called()
+
+
+class CredentialFileCacheTest(TestCase):
+
+    role = "arn:aws:iam::12345:role/deploy"
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'credentials')
+        self.cache = cf_utils.CredentialFileCache(path=self.path)
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def test_round_trip(self):
+        credentials = mock_assume_role_response()['Credentials']
+
+        self.cache.put(self.role, "deploy@user", credentials)
+
+        self.assertEqual(credentials, self.cache.get(self.role, "deploy@user"))
+        self.assertIsNone(self.cache.get(self.role, "deploy@someone-else"))
+
+    def test_entries_are_private(self):
+        self.cache.put(self.role, "deploy@user", mock_assume_role_response()['Credentials'])
+
+        self.assertEqual(0700, stat.S_IMODE(os.stat(self.path).st_mode))
+        for filename in os.listdir(self.path):
+            self.assertEqual(0600, stat.S_IMODE(os.stat(os.path.join(self.path, filename)).st_mode))
+
+    def test_nearly_expired_entries_are_evicted(self):
+        self.cache.put(self.role, "deploy@user", mock_assume_role_response(timedelta(minutes=5))['Credentials'])
+
+        self.assertIsNone(self.cache.get(self.role, "deploy@user"))
+        self.assertEqual([], os.listdir(self.path))
+
+    def test_sts_skipped_when_cached(self):
+        sts = cf_utils.STSUtil(sts_arn=self.role, cache=self.cache)
+        sts_client = MagicMock()
+        sts_client.assume_role = MagicMock(return_value=mock_assume_role_response())
+
+        with patch.object(cf_utils.boto3, 'client', return_value=sts_client):
+            first = sts.authenticate_role()
+            second = cf_utils.STSUtil(sts_arn=self.role, cache=self.cache).authenticate_role()
+
+        self.assertEqual(1, sts_client.assume_role.call_count)
+        self.assertEqual(first['Credentials'], second['Credentials'])
+
+
+def mock_stack_event(event_id, status, logical_id="test-stack", token="token-1", seconds=0):
+    stack_id = "arn:aws:cloudformation:us-east-1:12345:stack/test-stack/1"
+    return {"EventId": event_id,
+            "StackId": stack_id,
+            "StackName": "test-stack",
+            "LogicalResourceId": logical_id,
+            "PhysicalResourceId": stack_id if logical_id == "test-stack" else "physical-" + logical_id,
+            "ResourceType": "AWS::CloudFormation::Stack" if logical_id == "test-stack" else "AWS::EC2::Instance",
+            "ResourceStatus": status,
+            "ClientRequestToken": token,
+            "Timestamp": datetime.now(tzutc()) + timedelta(seconds=seconds)}
+
+
+class StackEventTrackerTest(TestCase):
+
+    def test_poll_only_pages_back_to_last_seen_event(self):
+        cf_client = MagicMock()
+        tracker = cf_utils.StackEventTracker(cf_client, "test-stack", client_request_token="token-1")
+
+        first = mock_stack_event("1", "UPDATE_IN_PROGRESS")
+        second = mock_stack_event("2", "UPDATE_IN_PROGRESS", logical_id="Instance", seconds=1)
+        third = mock_stack_event("3", "UPDATE_COMPLETE", logical_id="Instance", seconds=2)
+
+        cf_client.describe_stack_events = MagicMock(return_value={"StackEvents": [second, first]})
+        self.assertEqual([first, second], tracker.poll())
+        self.assertEqual("UPDATE_IN_PROGRESS", tracker.stack_status)
+
+        cf_client.describe_stack_events = MagicMock(side_effect=[{"StackEvents": [third], "NextToken": "page-2"},
+                                                                 {"StackEvents": [second, first]}])
+        self.assertEqual([third], tracker.poll())
+        self.assertEqual(2, cf_client.describe_stack_events.call_count)
+
+    def test_poll_ignores_events_from_other_operations(self):
+        cf_client = MagicMock()
+        tracker = cf_utils.StackEventTracker(cf_client, "test-stack", client_request_token="token-2")
+
+        previous = mock_stack_event("1", "UPDATE_COMPLETE", token="token-1", seconds=-1)
+        current = mock_stack_event("2", "UPDATE_IN_PROGRESS", token="token-2")
+        cf_client.describe_stack_events = MagicMock(return_value={"StackEvents": [current, previous]})
+
+        self.assertEqual([current], tracker.poll())
+        self.assertEqual("UPDATE_IN_PROGRESS", tracker.stack_status)
+
+    def test_events_start_with_the_label(self):
+        tracker = cf_utils.StackEventTracker(MagicMock(), "test-stack", label="test-stack@eu-west-1")
+        event = mock_stack_event("1", "CREATE_IN_PROGRESS", logical_id="Instance")
+
+        self.assertTrue(tracker.format_event(event).startswith("[test-stack@eu-west-1] "))
+        self.assertIn("CREATE_IN_PROGRESS", tracker.format_event(event))
+
+    def test_outputs_start_with_the_label(self):
+        stack = {"StackName": "test-stack", "Outputs": [{"OutputKey": "Url", "OutputValue": "http://example.com"}]}
+
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            cf_utils.print_stack_outputs(stack, label="test-stack")
+
+        lines = stdout.getvalue().splitlines()
+        self.assertIn("[test-stack] Stack Outputs", lines)
+        self.assertIn("[test-stack]   Url: http://example.com", lines)
+        self.assertTrue(all(line.startswith("[test-stack]") for line in lines))
+
+
+class CloudFormationUtilTest(TestCase):
+
+    def create_util(self, event_pages):
+        cf_client = MagicMock()
+        cf_client.describe_stack_events = MagicMock(side_effect=event_pages)
+        cf_client.describe_stacks = MagicMock(return_value={"Stacks": [{"StackStatus": "UPDATE_COMPLETE"}]})
+        return cf_utils.CloudFormationUtil(cf_client)
+
+    def test_wait_for_deploy_backs_off_until_complete(self):
+        started = mock_stack_event("1", "UPDATE_IN_PROGRESS")
+        done = mock_stack_event("2", "UPDATE_COMPLETE", seconds=1)
+        util = self.create_util([{"StackEvents": [started]},
+                                 {"StackEvents": [started]},
+                                 {"StackEvents": [done, started]}])
+
+        with patch.object(cf_utils.time, 'sleep') as sleep, patch.object(cf_utils.random, 'random', return_value=0):
+            util.wait_for_deploy_to_complete("test-stack", client_request_token="token-1")
+
+        self.assertEqual([call(2), call(3.0)], sleep.mock_calls)
+        util.cf_client.describe_stacks.assert_called_once_with(StackName="test-stack")
+
+    def test_wait_for_deploy_raises_on_rollback(self):
+        util = self.create_util([{"StackEvents": [mock_stack_event("1", "UPDATE_ROLLBACK_COMPLETE")]}])
+
+        with pytest.raises(cf_utils.DeployException) as ex:
+            util.wait_for_deploy_to_complete("test-stack", client_request_token="token-1")
+
+        self.assertEqual("Stack 'test-stack' modification failed, last status was 'UPDATE_ROLLBACK_COMPLETE'",
+                         ex.value.message)
+
+    def test_wait_for_deploy_slows_down_when_throttled(self):
+        throttled = botocore.exceptions.ClientError({"Error": {"Code": "Throttling", "Message": "Rate exceeded"}},
+                                                    "DescribeStackEvents")
+        util = self.create_util([throttled, {"StackEvents": [mock_stack_event("1", "UPDATE_COMPLETE")]}])
+
+        with patch.object(cf_utils.time, 'sleep') as sleep, patch.object(cf_utils.random, 'random', return_value=0):
+            util.wait_for_deploy_to_complete("test-stack", client_request_token="token-1", show_outputs=False)
+
+        self.assertEqual([call(4)], sleep.mock_calls)
+
+    def test_wait_for_change_set_returns_completed_change_set(self):
+        util = self.create_util([])
+        util.cf_client.describe_change_set = MagicMock(side_effect=[{"Status": "CREATE_PENDING"},
+                                                                    {"Status": "CREATE_IN_PROGRESS"},
+                                                                    {"Status": "CREATE_COMPLETE", "Changes": []}])
+
+        with patch.object(cf_utils.time, 'sleep') as sleep, patch.object(cf_utils.random, 'random', return_value=0):
+            change_set = util.wait_for_change_set_to_complete("test-stack", "Update-1", debug=False)
+
+        self.assertEqual("CREATE_COMPLETE", change_set["Status"])
+        self.assertEqual([call(1), call(1.5)], sleep.mock_calls)
+
+    def test_stack_summaries_page_through_live_stacks(self):
+        util = self.create_util([])
+        util.cf_client.list_stacks = MagicMock(side_effect=[
+            {"StackSummaries": [{"StackName": "app"}], "NextToken": "page-2"},
+            {"StackSummaries": [{"StackName": "db"}]}])
+
+        with patch.object(cf_utils, 'Waiter', wraps=cf_utils.Waiter) as waiter:
+            self.assertEqual(["app", "db"], [summary["StackName"] for summary in util.stack_summaries()])
+
+        self.assertEqual(2, waiter.call_count)
+        self.assertNotIn("DELETE_COMPLETE", cf_utils.LIVE_STACK_STATUSES)
+        self.assertEqual([call(StackStatusFilter=cf_utils.LIVE_STACK_STATUSES),
+                          call(StackStatusFilter=cf_utils.LIVE_STACK_STATUSES, NextToken="page-2")],
+                         util.cf_client.list_stacks.mock_calls)
+
+    def test_wait_for_change_set_times_out_on_deadline(self):
+        util = self.create_util([])
+        util.cf_client.describe_change_set = MagicMock(return_value={"Status": "CREATE_IN_PROGRESS"})
+
+        with patch.object(cf_utils.time, 'sleep'):
+            with pytest.raises(cf_utils.DeployException) as ex:
+                util.wait_for_change_set_to_complete("test-stack", "Update-1", timeout=0, debug=False)
+
+        self.assertEqual("Timeout waiting for stack 'test-stack' ChangeSet to be created, "
+                         "last status was 'CREATE_IN_PROGRESS'", ex.value.message)
+
+
+class WaiterTest(TestCase):
+
+    throttled = botocore.exceptions.ClientError({"Error": {"Code": "Throttling", "Message": "Rate exceeded"}},
+                                                "DescribeImages")
+
+    def test_delay_grows_with_jitter_up_to_max(self):
+        waiter = cf_utils.Waiter(timeout=600, min_delay=10, max_delay=20, multiplier=2, jitter=0.5)
+
+        with patch.object(cf_utils.time, 'sleep') as sleep, patch.object(cf_utils.random, 'random', return_value=1):
+            for _ in range(3):
+                self.assertTrue(waiter.wait())
+
+        self.assertEqual([call(5.0), call(10.0), call(10.0)], sleep.mock_calls)
+
+    def test_wait_stops_at_deadline(self):
+        waiter = cf_utils.Waiter(timeout=5, min_delay=10)
+
+        with patch.object(cf_utils.time, 'sleep') as sleep, patch.object(cf_utils.random, 'random', return_value=0):
+            self.assertFalse(waiter.wait())
+
+        sleep.assert_not_called()
+
+    def test_call_retries_throttling(self):
+        function = MagicMock(side_effect=[self.throttled, {"Images": []}])
+
+        with patch.object(cf_utils.time, 'sleep'):
+            self.assertEqual({"Images": []}, cf_utils.Waiter(timeout=60).call(function, ImageIds=["ami-1234"]))
+
+        self.assertEqual([call(ImageIds=["ami-1234"]), call(ImageIds=["ami-1234"])], function.mock_calls)
+
+    def test_call_gives_up_on_deadline(self):
+        function = MagicMock(side_effect=self.throttled)
+
+        with patch.object(cf_utils.time, 'sleep'):
+            with pytest.raises(botocore.exceptions.ClientError):
+                cf_utils.Waiter(timeout=0).call(function)
+
+    def test_call_does_not_retry_other_errors(self):
+        error = botocore.exceptions.ClientError({"Error": {"Code": "ValidationError", "Message": "Bad"}}, "DescribeImages")
+        function = MagicMock(side_effect=error)
+
+        with pytest.raises(botocore.exceptions.ClientError):
+            cf_utils.Waiter(timeout=60).call(function)
+
+        self.assertEqual(1, function.call_count)
+
+
+class LocalS3(object):
+    """
+    A minimal in-memory stand in for the parts of the S3 client used to stage templates.
+    """
+
+    def __init__(self, location='ap-southeast-2', region_name='us-west-2'):
+        self.objects = {}
+        self.meta = MagicMock(region_name=region_name)
+        self.put_object = MagicMock(side_effect=self._put_object)
+        self.head_object = MagicMock(side_effect=self._head_object)
+        self.get_bucket_location = MagicMock(return_value={"LocationConstraint": location})
+
+    def _put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+        return {}
+
+    def _head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise botocore.exceptions.ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        return {"ContentLength": len(self.objects[(Bucket, Key)])}
+
+
+class TemplateStagerTest(TestCase):
+
+    def setUp(self):
+        cf_utils.TemplateStager._staged.clear()
+        cf_utils.TemplateStager._regions.clear()
+
+    def test_template_uploaded_once_by_content_hash(self):
+        s3 = LocalS3()
+        body = '{"Resources": {}}'
+
+        url = cf_utils.TemplateStager(s3, "templates").stage(body)
+        self.assertEqual(url, cf_utils.TemplateStager(s3, "templates").stage(body))
+
+        key = "stacker/templates/{}.template".format(hashlib.sha256(body).hexdigest())
+        self.assertEqual("https://templates.s3.ap-southeast-2.amazonaws.com/" + key, url)
+        self.assertEqual({("templates", key): body}, s3.objects)
+        self.assertEqual(1, s3.put_object.call_count)
+        self.assertEqual(1, s3.head_object.call_count)
+
+    def test_existing_template_not_uploaded(self):
+        s3 = LocalS3(location=None)
+        body = '{"Resources": {}}'
+        s3.objects[("templates", cf_utils.TemplateStager(s3, "templates").key(body))] = body
+
+        url = cf_utils.TemplateStager(s3, "templates").stage(body)
+
+        self.assertTrue(url.startswith("https://templates.s3.amazonaws.com/stacker/templates/"))
+        s3.put_object.assert_not_called()
+
+    def test_url_names_the_buckets_region_not_the_clients(self):
+        s3 = LocalS3(location='EU', region_name='ap-southeast-2')
+        stager = cf_utils.TemplateStager(s3, "templates")
+
+        self.assertEqual("https://templates.s3.eu-west-1.amazonaws.com/a", stager.url("a"))
+        self.assertEqual("https://templates.s3.eu-west-1.amazonaws.com/b", stager.url("b"))
+        s3.get_bucket_location.assert_called_once_with(Bucket="templates")
+
+
+class KMSSecretResolverTest(TestCase):
+
+    def setUp(self):
+        cf_utils.KMSSecretResolver.clear()
+
+    def tearDown(self):
+        cf_utils.KMSSecretResolver.clear()
+
+    def encrypted(self, plaintext):
+        return "KMSEncrypted{}/KMSEncrypted".format(base64.b64encode("cipher-" + plaintext))
+
+    def mock_kms(self):
+        kms_client = MagicMock()
+        kms_client.decrypt = MagicMock(side_effect=lambda CiphertextBlob: {"Plaintext": CiphertextBlob[7:]})
+        return kms_client
+
+    def test_distinct_ciphertexts_decrypted_once(self):
+        kms_client = self.mock_kms()
+        config_params = {"DBPassword": self.encrypted("hunter2"),
+                         "ReplicaPassword": self.encrypted("hunter2"),
+                         "ApiKey": self.encrypted("abc123"),
+                         "InstanceType": "t2.micro",
+                         "Port": 5432}
+
+        resolved, secrets = cf_utils.KMSSecretResolver(kms_client).resolve(config_params)
+
+        self.assertEqual({"DBPassword": "hunter2",
+                          "ReplicaPassword": "hunter2",
+                          "ApiKey": "abc123",
+                          "InstanceType": "t2.micro",
+                          "Port": 5432}, resolved)
+        self.assertEqual(["abc123", "hunter2", "hunter2"], sorted(secrets))
+        self.assertEqual(2, kms_client.decrypt.call_count)
+        self.assertEqual(self.encrypted("hunter2"), config_params["DBPassword"])
+
+    def test_plaintexts_cached_for_process(self):
+        kms_client = self.mock_kms()
+
+        cf_utils.KMSSecretResolver(kms_client).resolve({"DBPassword": self.encrypted("hunter2")})
+        resolved, secrets = cf_utils.KMSSecretResolver(kms_client).resolve({"Other": self.encrypted("hunter2")})
+
+        self.assertEqual({"Other": "hunter2"}, resolved)
+        self.assertEqual(1, kms_client.decrypt.call_count)
+
+    def test_plaintexts_are_not_shared_between_clients(self):
+        kms_client = self.mock_kms()
+        other_role_client = MagicMock()
+        other_role_client.decrypt = MagicMock(side_effect=botocore.exceptions.ClientError(
+            {"Error": {"Code": "AccessDeniedException", "Message": "Not authorized"}}, "Decrypt"))
+
+        cf_utils.KMSSecretResolver(kms_client).resolve({"DBPassword": self.encrypted("hunter2")})
+
+        with pytest.raises(botocore.exceptions.ClientError):
+            cf_utils.KMSSecretResolver(other_role_client).resolve({"DBPassword": self.encrypted("hunter2")})
+
+
+class StackOutputIndexTest(TestCase):
+
+    def setUp(self):
+        cf_utils.StackOutputIndex.clear()
+
+    def tearDown(self):
+        cf_utils.StackOutputIndex.clear()
+
+    def mock_cf(self):
+        outputs = {"network": {"VpcId": "vpc-1234", "SubnetIds": "subnet-1,subnet-2"},
+                   "database": {"Url": "postgres://db"}}
+
+        def describe_stacks(StackName):
+            if StackName not in outputs:
+                raise botocore.exceptions.ClientError(
+                    {"Error": {"Code": "ValidationError", "Message": "Stack with id {} does not exist".format(StackName)}},
+                    "DescribeStacks")
+            return {"Stacks": [{"StackName": StackName,
+                                "Outputs": [{"OutputKey": key, "OutputValue": value}
+                                            for key, value in outputs[StackName].items()]}]}
+
+        cf_client = MagicMock()
+        cf_client.describe_stacks = MagicMock(side_effect=describe_stacks)
+        return cf_client
+
+    def test_each_referenced_stack_is_described_once(self):
+        cf_client = self.mock_cf()
+        config_params = {"VpcId": "StackOutput:network.VpcId",
+                         "SubnetIds": "StackOutput:network.SubnetIds",
+                         "DatabaseUrl": "StackOutput:database.Url",
+                         "Note": "StackOutput: not a reference",
+                         "Port": 5432}
+
+        resolved = cf_utils.StackOutputIndex(cf_client).resolve(config_params)
+
+        self.assertEqual({"VpcId": "vpc-1234",
+                          "SubnetIds": "subnet-1,subnet-2",
+                          "DatabaseUrl": "postgres://db",
+                          "Note": "StackOutput: not a reference",
+                          "Port": 5432}, resolved)
+        self.assertEqual([call(StackName="database"), call(StackName="network")],
+                         sorted(cf_client.describe_stacks.mock_calls))
+        self.assertEqual("StackOutput:network.VpcId", config_params["VpcId"])
+
+    def test_outputs_are_shared_per_client_until_forgotten(self):
+        cf_client = self.mock_cf()
+
+        cf_utils.StackOutputIndex.shared(cf_client).resolve({"VpcId": "StackOutput:network.VpcId"})
+        cf_utils.StackOutputIndex.shared(cf_client).resolve({"Subnets": "StackOutput:network.SubnetIds"})
+        self.assertEqual(1, cf_client.describe_stacks.call_count)
+
+        cf_utils.StackOutputIndex.shared(cf_client).forget("network")
+        cf_utils.StackOutputIndex.shared(cf_client).resolve({"VpcId": "StackOutput:network.VpcId"})
+        self.assertEqual(2, cf_client.describe_stacks.call_count)
+
+    def test_missing_stack_or_output(self):
+        index = cf_utils.StackOutputIndex(self.mock_cf())
+
+        with pytest.raises(cf_utils.DeployException) as ex:
+            index.resolve({"VpcId": "StackOutput:missing.VpcId"})
+        self.assertEqual("Cannot find stack 'missing' to read its outputs", ex.value.message)
+        self.assertEqual({}, index._fetching)
+
+        with pytest.raises(cf_utils.DeployException) as ex:
+            index.resolve({"VpcId": "StackOutput:network.Missing"})
+        self.assertEqual("Stack 'network' has no output 'Missing' for parameter VpcId", ex.value.message)